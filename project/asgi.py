@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# the progress events (server-sent events) are streamed by their own ASGI app, everything else goes to django
+from store.events import match, project_events
+
+
+async def application(scope, receive, send):
+    project_id = match(scope)
+    if project_id is not None:
+        await project_events(scope, receive, send, project_id)
+    else:
+        await django_application(scope, receive, send)
@@ -1,5 +1,7 @@
 import os
+import time
 from celery import Celery
+from celery.signals import worker_process_init, before_task_publish, task_prerun
 
 # set an env variable
 # we set "DJANGO_SETTINGS_MODULE" mapping to "project.settings"
@@ -20,4 +22,36 @@ celery.config_from_object("django.conf:settings", namespace="CELERY")
 # the celery can auto discover tasks:
 celery.autodiscover_tasks()
 
+
+# every (prefork) worker process loads the AI models once, all the tasks of this process reuse them
+# and opens its own HTTP connections to the AI chain modules
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    from store.utility.ai_utils import warm_up_model_pool
+    from store.utility import http_client, redis_client
+    http_client.clear()
+    redis_client.clear()
+    warm_up_model_pool()
+
+
+# queue wait metric: the publish time travels in the message headers, the wait is measured when the task starts
+@before_task_publish.connect
+def add_enqueued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
+
+
+@task_prerun.connect
+def measure_queue_wait(task=None, **kwargs):
+    enqueued_at = getattr(task.request, "enqueued_at", None)
+    if enqueued_at is None or task.request.is_eager:
+        return
+    queue = (task.request.delivery_info or {}).get("routing_key") or "unknown"
+    try:
+        from store.utility.queue_metrics import record_queue_wait
+        record_queue_wait(queue, time.time() - enqueued_at)
+    except Exception as e:
+        print(f"queue wait metric failed: {e}")
+
+
 # to let the celery code work, you need to load the code into '__init__.py' model, otherwise, python will not execute these code.
\ No newline at end of file
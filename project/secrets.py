@@ -0,0 +1,5 @@
+DATABASE_NAME = "x"
+DATABASE_USER = "x"
+DATABASE_PASSWORD = "x"
+DATABASE_HOST = "localhost"
+DATABASE_PORT = "3306"
@@ -168,6 +168,18 @@ MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 MEDIA_URL = '/media/'
 # define Localhost:port
 LOCALHOST_PORT_URL = 'http://127.0.0.1:8000'
+# max. size of an uploaded image, accounted while it is received (store/validators.py)
+IMAGE_MAX_SIZE_MB = 5
+# max. size of an image uploaded in chunks (resumable uploads, for the big scans of technical drawings)
+IMAGE_RESUMABLE_MAX_SIZE_MB = 100
+# a resumable upload without a new chunk for this long is removed with its part file (store/utility/image_upload.py)
+IMAGE_UPLOAD_EXPIRY_HOURS = 24
+# derivatives of the uploaded images, made by a celery task after the upload (store/utility/derivatives.py):
+# longest side in pixels of the thumbnails (lists, admin) and of the previews (gallery, viewer)
+IMAGE_THUMBNAIL_SIZE = 256
+IMAGE_PREVIEW_SIZE = 1600
+# the working copy the AI chain modules get is the full image as png, in RGB or (if True) in grayscale
+IMAGE_WORKING_COPY_GRAYSCALE = False
 
 # the decimal format data will still be decinal, won't be string
 REST_FRAMEWORK= {
@@ -256,6 +268,121 @@ redis specifies that the Redis protocol should be used for communication with th
 """
 CELERY_BROKER_URL = "redis://localhost:6379/1"
 
+# queues: small runs go to the fast "interactive" lane, everything else to "bulk" (see "dispatch_processing" in store/views.py).
+# start the workers of each lane with "-Q interactive" / "-Q bulk"
+CELERY_TASK_DEFAULT_QUEUE = "bulk"
+# a worker only reserves the task it runs, so tasks queued later are not stuck behind prefetched ones
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ACKS_LATE = True
+# redis hands a task not acknowledged within the visibility timeout to another worker, with acks_late it has to be longer
+# than the longest task: a module call (CHAIN_MODULE_READ_TIMEOUT) with its waits for a free slot (CHAIN_MODULE_BUSY_WAIT).
+# "processing_batch" runs longer and is acknowledged when it starts instead
+CELERY_BROKER_TRANSPORT_OPTIONS = {"visibility_timeout": 4 * 60 * 60}
+# periodic tasks, run by "celery -A project beat"
+CELERY_BEAT_SCHEDULE = {
+    "remove-abandoned-uploads": {"task": "store.tasks.remove_abandoned_uploads", "schedule": 60 * 60},
+}
+
+# integrated AI models (YOLOv7, PARSeq):
+# if True, every celery worker process loads the models at start up ("worker_process_init"), otherwise the first task loads them
+AI_MODEL_POOL_PRELOAD = True
+# torch device the pooled models are loaded on, e.g. "cpu" or "cuda:0"
+AI_MODEL_DEVICE = "cpu"
+# how the Localizer runs YOLOv7: "inprocess" (pooled model, in-memory tiles) or "subprocess" (src/yolov7/detect.py, fallback)
+AI_DETECTION_BACKEND = "inprocess"
+# number of 640x640 tiles the in-process backend stacks into one YOLOv7 forward pass
+AI_DETECTION_BATCH_SIZE = 8
+# in-process backend only: hand tiles, detections and processed tiles from the Tiler to the Merger in memory
+# instead of writing/reading them as PNG and txt files in the text_detection cache dirs
+AI_DETECTION_IN_MEMORY = True
+
+# number of images of a project processed by one "processing_batch" task when the AI chain is started,
+# 1 keeps one task per image; can be overridden per request with the "batch_size" query param
+CHAIN_BATCH_SIZE = 1
+
+# reuse the result of a module for an input it already processed (same file content and module version)
+# instead of calling the module again, see store/utility/result_cache.py
+CHAIN_RESULT_CACHE = True
+
+# redis database of the processing bookkeeping (fair scheduler, queue wait metric)
+PROCESSING_REDIS_URL = "redis://localhost:6379/2"
+# runs of up to this many images go to the interactive queue right away
+CHAIN_INTERACTIVE_MAX_IMAGES = 3
+CHAIN_INTERACTIVE_QUEUE = "interactive"
+CHAIN_BULK_QUEUE = "bulk"
+# the derivatives of new uploads are made in the interactive lane, not behind the runs of the bulk lane
+CELERY_TASK_ROUTES = {
+    "store.tasks.generate_image_derivatives": {"queue": CHAIN_INTERACTIVE_QUEUE},
+}
+# bulk runs are handed out round-robin per customer (store/utility/fair_scheduler.py), at most this many at a time
+CHAIN_BULK_MAX_IN_FLIGHT = 8
+# runs per round-robin turn by customer plan
+CHAIN_PLAN_WEIGHTS = {"BASIC": 1, "PRO": 2, "ENTERPRISE": 4}
+# seconds after which the slot of a run that never finished is given to the next one
+CHAIN_FAIR_SLOT_TIMEOUT = 3600
+
+# "processing_batch" writes the chain results in bulk, at the latest after this many results
+CHAIN_RESULT_FLUSH_SIZE = 50
+
+# a chain stage failing on a network error (after the HTTP retries) is retried this many times, with growing delays
+CHAIN_STAGE_MAX_RETRIES = 3
+
+# seconds between the keep-alive comments of an idle progress events stream (store/events.py)
+PROGRESS_EVENTS_KEEPALIVE = 15
+
+# side in pixels of the cells of the spatial index over the detected elements (store/utility/spatial_index.py),
+# about the size of a room stamp on the drawings. indexes already built keep their cell size
+ELEMENT_INDEX_CELL_SIZE = 256
+# an item over more cells than this is not put into the grid, but into one row read by every query
+ELEMENT_INDEX_MAX_CELLS_PER_ITEM = 64
+
+# Cache-Control of the result endpoints, which answer with ETags (store/utility/conditional.py)
+RESULTS_CACHE_CONTROL = {"private": True, "no_cache": True}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # rendered chain result payloads (store/utility/result_payloads.py), written by the API processes and
+    # outdated by the celery workers, so it has to be shared. give the redis database a maxmemory and
+    # "maxmemory-policy allkeys-lru" to keep only the hot payloads
+    "results": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://localhost:6379/3",
+        "TIMEOUT": 24 * 60 * 60,
+    },
+}
+RESULT_PAYLOAD_CACHE = "results"
+
+# HTTP calls to the AI chain modules (store/utility/http_client.py), one keep-alive connection pool per module URL and worker process
+# seconds to wait for the connection to a module / for its response (the module processes the file before answering)
+CHAIN_MODULE_CONNECT_TIMEOUT = 5
+CHAIN_MODULE_READ_TIMEOUT = 600
+# retries on connection errors and 502/503/504 answers, waiting backoff * 2^(retry - 1) seconds in between
+CHAIN_MODULE_MAX_RETRIES = 3
+CHAIN_MODULE_RETRY_BACKOFF = 0.5
+# a module with all its "max_concurrency" slots taken (or answering 429/503) is tried again later instead of failing the stage:
+# the module tasks are requeued after 1-2x this many seconds, up to this many times
+CHAIN_MODULE_BUSY_RETRY_DELAY = 10
+CHAIN_MODULE_BUSY_MAX_RETRIES = 60
+# "processing_batch" waits for a free slot instead, up to this many seconds, checking every poll interval
+CHAIN_MODULE_BUSY_WAIT = 600
+CHAIN_MODULE_SLOT_POLL_INTERVAL = 1
+# seconds after which the slot of a call that never released it is free again,
+# longer than a module call can take with its HTTP retries, a running call never loses its slot
+CHAIN_MODULE_SLOT_TIMEOUT = (CHAIN_MODULE_CONNECT_TIMEOUT + CHAIN_MODULE_READ_TIMEOUT) * (1 + CHAIN_MODULE_MAX_RETRIES) + 60
+# modules with replicas (AiChainModuleReplica): a replica failing this many times in a row is left out for this many seconds
+CHAIN_REPLICA_EJECT_AFTER_FAILURES = 3
+CHAIN_REPLICA_EJECT_SECONDS = 30
+# hedging: a call slower than this percentile of the module's last CHAIN_REPLICA_LATENCY_WINDOW calls is sent to a
+# second replica as well (costs extra module work), None = no hedging
+CHAIN_REPLICA_HEDGE_PERCENTILE = None
+CHAIN_REPLICA_HEDGE_MIN_SAMPLES = 20
+CHAIN_REPLICA_LATENCY_WINDOW = 100
+CHAIN_REPLICA_HEDGE_THREADS = 4
+# max. kept-alive connections per module URL, should be >= the worker concurrency when a worker uses threads
+CHAIN_MODULE_POOL_SIZE = 4
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
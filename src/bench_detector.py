@@ -0,0 +1,91 @@
+'''Throughput comparison of the text localization paths:
+
+- "subprocess": the original path, tiles are written as PNGs and
+  src/yolov7/detect.py runs as a child process (one tile per forward pass)
+- "inprocess bs=N": src/detector.py with an already loaded model and N tiles
+  stacked into one forward pass
+
+Usage (from the repository root):
+    python -m src.bench_detector --weights store/ai/model_weights/weights/best.pt --source store/ai/papier.png --batch-sizes 1 4 8 16
+'''
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tiler import Tiler
+
+from .detector import Detector
+
+
+def make_tiles(source, num_random, tile_size):
+    if source is None:
+        rng = np.random.default_rng(0)
+        return [rng.integers(0, 255, (tile_size, tile_size, 3), dtype=np.uint8)
+                for _ in range(num_random)]
+
+    img = cv2.imread(source)
+    tiler = Tiler(data_shape=img.shape,
+                  tile_shape=(tile_size, tile_size, 3),
+                  channel_dimension=2)
+    return [tile for _, tile in tiler(img)]
+
+
+def bench_subprocess(weights, tiles, tile_size):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tiled_path = Path(tmp_dir, "tiled")
+        tiled_path.mkdir()
+        for i, tile in enumerate(tiles):
+            cv2.imwrite(str(Path(tiled_path, f"tile_{i}.png")), tile)
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, str(Path(__file__).parent / "yolov7" / "detect.py"),
+                        '--weights', weights,
+                        '--source', str(tiled_path),
+                        '--project', tmp_dir,
+                        '--name', 'processed',
+                        '--img-size', str(tile_size),
+                        '--save-txt', '--save-conf', '--augment', '--exist-ok', '--no-trace'],
+                       check=True, stdout=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+
+def bench_inprocess(detector, tiles, batch_size, repeats):
+    detector.detect(tiles[:batch_size], batch_size=batch_size)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        detector.detect(tiles, batch_size=batch_size)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, required=True, help='model.pt path')
+    parser.add_argument('--source', type=str, default=None, help='image to tile, random tiles if not given')
+    parser.add_argument('--num-random', type=int, default=32, help='number of random tiles without --source')
+    parser.add_argument('--tile-size', type=int, default=640)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 8, 16])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--skip-subprocess', action='store_true', help='do not run the detect.py path')
+    opt = parser.parse_args()
+
+    tiles = make_tiles(opt.source, opt.num_random, opt.tile_size)
+    print(f"{len(tiles)} tiles of {opt.tile_size}x{opt.tile_size}")
+
+    if not opt.skip_subprocess:
+        seconds = bench_subprocess(opt.weights, tiles, opt.tile_size)
+        print(f"subprocess     : {seconds:8.2f}s  {len(tiles) / seconds:8.2f} tiles/s")
+
+    detector = Detector(opt.weights, device=opt.device, img_size=opt.tile_size)
+    for batch_size in opt.batch_sizes:
+        seconds = bench_inprocess(detector, tiles, batch_size, opt.repeats)
+        print(f"inprocess bs={batch_size:<3}: {seconds:8.2f}s  {len(tiles) / seconds:8.2f} tiles/s")
+
+
+if __name__ == '__main__':
+    main()
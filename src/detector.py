@@ -0,0 +1,125 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+from numpy import random
+
+# the yolov7 code base imports its own packages as top level packages ("models", "utils"),
+# and the pickled weights reference them as well, so the folder has to be on the sys.path
+YOLOV7_PATH = str(Path(__file__).resolve().parent / "yolov7")
+if YOLOV7_PATH not in sys.path:
+    sys.path.insert(0, YOLOV7_PATH)
+
+from models.experimental import attempt_load
+from utils.datasets import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_coords, xyxy2xywh
+from utils.plots import plot_one_box
+
+
+class Detector:
+    '''In-process YOLOv7 text detection, the library counterpart of
+    src/yolov7/detect.py. The weights are loaded (and kept) once, images are
+    passed in as in-memory BGR arrays (as read by cv2) and detections are
+    returned as tensors instead of label files.
+    '''
+
+    def __init__(self, weights, device="cpu", img_size=640,
+                 conf_thres=0.25, iou_thres=0.45, augment=True):
+
+        self.device = torch.device(device)
+        # half precision only supported on CUDA
+        self.half = self.device.type != "cpu"
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.augment = augment
+
+        # load FP32 model
+        self.model = attempt_load(weights, map_location=self.device)
+        self.stride = int(self.model.stride.max())
+        self.img_size = check_img_size(img_size, s=self.stride)
+        if self.half:
+            self.model.half()
+
+        self.names = (self.model.module.names if hasattr(self.model, "module")
+                      else self.model.names)
+        self.colors = [[random.randint(0, 255) for _ in range(3)]
+                       for _ in self.names]
+
+    def preprocess(self, image):
+        '''Letterboxes a BGR image and converts it to a RGB CHW array.'''
+        img = letterbox(image, self.img_size, stride=self.stride)[0]
+        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3xHxW
+        return np.ascontiguousarray(img)
+
+    def detect(self, images, batch_size=1):
+        '''Runs detection on a list of BGR images. Returns one (n, 6) tensor
+        per image with rows x1, y1, x2, y2, confidence, class, the box
+        coordinates given in pixels of the respective input image.
+
+        Up to batch_size images of the same (letterboxed) shape are stacked
+        into one forward pass, e.g. the equally sized tiles of a Tiler. The
+        detections are returned in the order of the input images.
+        '''
+        detections = [None] * len(images)
+        for batch in self.make_batches(images, batch_size):
+            img = torch.from_numpy(np.stack([self.preprocess(images[i]) for i in batch]))
+            img = img.to(self.device)
+            img = img.half() if self.half else img.float()  # uint8 to fp16/32
+            img /= 255.0  # 0 - 255 to 0.0 - 1.0
+
+            # calculating gradients would cause a GPU memory leak
+            with torch.no_grad():
+                pred = self.model(img, augment=self.augment)[0]
+
+            # demultiplex the batch back to its images, NMS runs per image
+            # so that its time limit applies per image and not per batch
+            for xi, i in enumerate(batch):
+                det = non_max_suppression(pred[xi:xi + 1], self.conf_thres, self.iou_thres)[0]
+                if len(det):
+                    # rescale boxes from img_size to image size
+                    det[:, :4] = scale_coords(img.shape[2:], det[:, :4], images[i].shape).round()
+                detections[i] = det.cpu()
+
+        return detections
+
+    def make_batches(self, images, batch_size):
+        '''Groups the image indices into batches of at most batch_size
+        images sharing the same shape (only those can be stacked).
+        '''
+        batches = {}
+        for i, image in enumerate(images):
+            batches.setdefault(image.shape, []).append(i)
+
+        for indices in batches.values():
+            for start in range(0, len(indices), max(batch_size, 1)):
+                yield indices[start:start + max(batch_size, 1)]
+
+    def draw(self, image, detections):
+        '''Returns a copy of the image with the detections plotted on it,
+        the same way detect.py saves its processed images.
+        '''
+        image = image.copy()
+        for *xyxy, conf, cls in reversed(detections):
+            label = f'{self.names[int(cls)]} {conf:.2f}'
+            plot_one_box(xyxy, image, label=label,
+                         color=self.colors[int(cls)], line_thickness=1)
+        return image
+
+    @staticmethod
+    def to_labels(detections, shape):
+        '''Converts detections to detect.py's "--save-txt --save-conf"
+        labels: class, normalized x_center, y_center, w, h, confidence.
+        '''
+        gn = torch.tensor(shape)[[1, 0, 1, 0]]  # normalization gain whwh
+        labels = []
+        for *xyxy, conf, cls in reversed(detections):
+            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()
+            labels.append((float(cls), *xywh, float(conf)))
+        return labels
+
+    @staticmethod
+    def to_label_lines(detections, shape):
+        '''Formats the labels of to_labels() as lines of a label file.'''
+        return [('%g ' * len(label)).rstrip() % label + '\n'
+                for label in Detector.to_labels(detections, shape)]
@@ -10,34 +10,67 @@ import torch
 
 class Localizer:
     
-    def __init__(self, config):
+    def __init__(self, config, detector=None):
         
         self.config = config
         print(config)
         self.model = self.config["input"]["model"]
 
+        # "inprocess": run YOLOv7 through src/detector.py inside this process
+        # "subprocess": run src/yolov7/detect.py as a child process (fallback)
+        self.backend = self.config["input"].get("detection_backend", "subprocess")
+        # number of tiles stacked into one forward pass by the in-process backend
+        self.batch_size = self.config["input"].get("detection_batch_size", 1)
+        # keep tiles, detections and processed tiles in memory from the Tiler to the Merger
+        # instead of passing them through PNG/txt files in the cache dirs (in-process backend only)
+        self.in_memory = (self.backend == "inprocess"
+                          and self.config["input"].get("in_memory_tiles", False))
+        self.detector = detector
+        if self.backend == "inprocess" and self.detector is None:
+            from .detector import Detector
+            self.detector = Detector(self.model)
+
     def inference(self, filenames, tile_size=640):
 
         # ---------------------------- PREPROCESSING --------------------------- #
+        tilers_dict, tiles_dict, images_dict = self.tile_images(filenames, tile_size)
+
+        # ---------------------------- INFERENCE ------------------------------- #
+        # modified by shipanliu because no navdia gpu installed on mac-mini
+        # print("Device = ", torch.cuda.get_device_name())
+        if torch.cuda.is_available():
+            print("Device = ", torch.cuda.get_device_name())
+        else:
+            print("CUDA not available, using CPU")
+
+        if self.backend == "inprocess":
+            # all tiles of all images in batches instead of one tile per forward pass
+            detections = self.detector.detect(list(tiles_dict.values()), batch_size=self.batch_size)
+            detections_dict = self.save_detections(tiles_dict, detections)
+        else:
+            self.detect_subprocess(tile_size)
+            detections_dict = None
+
+        # ---------------------------- POSTPROCESSING -------------------------- #
+        self.postprocess(filenames, tilers_dict, images_dict, detections_dict)
+
+    def tile_images(self, filenames, tile_size=640):
         # dirs
-        cache_path = self.config["paths"]["text_detection"]["cache_path"]
         cache_tiled_path = self.config["paths"]["text_detection"]["cache_tiled_path"]
-        cache_processed_path = self.config["paths"]["text_detection"]["cache_processed_path"]
-        cache_processed_labels_path = self.config["paths"]["text_detection"]["cache_processed_labels_path"]
-        final_output_path = self.config["paths"]["text_detection"]["final_path"]
-        final_output_path_visual_results = self.config["paths"]["text_detection"]["final_visual_path"]
         final_output_path_original_images = self.config["paths"]["text_detection"]["final_original_path"]
         
-        model = self.config["input"]["model"]
-        
         # tile images
         tilers_dict = {}
+        tiles_dict = {}  # tile filename -> tile, for the in-process backend
+        images_dict = {}  # image filename -> image, kept for the postprocessing in in-memory mode
         for filename in filenames:
             
             # read and tile image
             img = cv2.imread(filename)
             
             filename = filename.split("/")[-1]
+            if self.in_memory:
+                images_dict[filename] = img
 
             tiler = Tiler(data_shape=img.shape,
                         tile_shape=(tile_size, tile_size, 3),
@@ -47,8 +80,10 @@ class Localizer:
             for tile_id, tile in tiler(img):
                 filename_tile = (Path(filename).stem
                                 + "_tile_" + str(tile_id) + ".png")
-                save_path_tile = Path(cache_tiled_path, filename_tile)
-                cv2.imwrite(str(save_path_tile), tile)
+                if not self.in_memory:
+                    save_path_tile = Path(cache_tiled_path, filename_tile)
+                    cv2.imwrite(str(save_path_tile), tile)
+                tiles_dict[filename_tile] = tile
             
             # save original image for later services in output dir
             original_image_filename_img = str(Path(
@@ -57,16 +92,14 @@ class Localizer:
             ))
             cv2.imwrite(original_image_filename_img, img)
 
-        # ---------------------------- INFERENCE ------------------------------- #
-        # modified by shipanliu because no navdia gpu installed on mac-mini
-        # print("Device = ", torch.cuda.get_device_name())
-        if torch.cuda.is_available():
-            print("Device = ", torch.cuda.get_device_name())
-        else:
-            print("CUDA not available, using CPU")
+        return tilers_dict, tiles_dict, images_dict
+
+    def detect_subprocess(self, tile_size):
+        cache_path = self.config["paths"]["text_detection"]["cache_path"]
+        cache_tiled_path = self.config["paths"]["text_detection"]["cache_tiled_path"]
 
         subprocess.run(['python3', 'src/yolov7/detect.py',
-            '--weights', model,
+            '--weights', self.model,
             '--source', str(cache_tiled_path),
             '--project', str(cache_path),
             '--augment',
@@ -82,7 +115,37 @@ class Localizer:
             '--no-trace'
         ])
 
-        # ---------------------------- POSTPROCESSING -------------------------- #
+    def save_detections(self, tiles_dict, detections):
+        '''Same outputs as detect.py (processed tiles and label files) for
+        the detections of the in-process backend, one per tile of tiles_dict.
+        In in-memory mode nothing is written, the detections are returned per
+        tile filename for the postprocessing instead.
+        '''
+        if self.in_memory:
+            return dict(zip(tiles_dict.keys(), detections))
+
+        cache_processed_path = self.config["paths"]["text_detection"]["cache_processed_path"]
+        cache_processed_labels_path = self.config["paths"]["text_detection"]["cache_processed_labels_path"]
+
+        for (filename_tile, tile), det in zip(tiles_dict.items(), detections):
+            cv2.imwrite(str(Path(cache_processed_path, filename_tile)),
+                        self.detector.draw(tile, det))
+
+            if not len(det):
+                continue  # detect.py writes no label file for tiles without preds
+
+            save_path_tile_txt = Path(cache_processed_labels_path,
+                                      Path(filename_tile).stem + ".txt")
+            with open(save_path_tile_txt, 'w') as out_file:
+                out_file.writelines(self.detector.to_label_lines(det, tile.shape))
+
+        return None
+
+    def postprocess(self, filenames, tilers_dict, images_dict=None, detections_dict=None):
+        cache_processed_path = self.config["paths"]["text_detection"]["cache_processed_path"]
+        cache_processed_labels_path = self.config["paths"]["text_detection"]["cache_processed_labels_path"]
+        final_output_path = self.config["paths"]["text_detection"]["final_path"]
+        final_output_path_visual_results = self.config["paths"]["text_detection"]["final_visual_path"]
 
         # setup output dictionary with the following structure
         output = {}
@@ -90,8 +153,12 @@ class Localizer:
         # merge processed tiles
         for filename in filenames:
             
-            img = cv2.imread(filename)
+            filename_path = filename
             filename = filename.split("/")[-1]
+            if images_dict:
+                img = images_dict[filename]
+            else:
+                img = cv2.imread(filename_path)
             
 
             elements = []
@@ -103,80 +170,92 @@ class Localizer:
             # loop (processed) tiles of the original file
             for tile_id, tile in tiler(img):
 
-                # get processed tile and add to merger
                 filename_tile = (Path(filename).stem
                                 + "_tile_" + str(tile_id) + ".png")
-                save_path_tile = Path(cache_processed_path, filename_tile)
-                img_processed = cv2.imread(str(save_path_tile))
-                merger.add(tile_id, img_processed)
 
-                # get labels from txt file and add to global labels file
-                filename_tile_txt = (Path(filename).stem
-                                    + "_tile_" + str(tile_id) + ".txt")
-                save_path_tile_txt = Path(cache_processed_labels_path,
-                                        filename_tile_txt)
+                if detections_dict is not None:
+                    # in-memory mode: draw the processed tile and format the labels
+                    # exactly like they would have been read from the txt file
+                    det = detections_dict[filename_tile]
+                    img_processed = self.detector.draw(tile, det)
+                    labels_txt = [" ".join('%g' % value for value in label)
+                                  for label in self.detector.to_labels(det, tile.shape)]
+                else:
+                    # get processed tile
+                    save_path_tile = Path(cache_processed_path, filename_tile)
+                    img_processed = cv2.imread(str(save_path_tile))
+
+                    # get labels from txt file
+                    filename_tile_txt = (Path(filename).stem
+                                        + "_tile_" + str(tile_id) + ".txt")
+                    save_path_tile_txt = Path(cache_processed_labels_path,
+                                            filename_tile_txt)
+
+                    labels_txt = []
+                    if os.path.isfile(save_path_tile_txt):
+                        with open(save_path_tile_txt, 'r') as in_file:
+                            labels_txt = in_file.readlines()
+
+                # add processed tile to merger
+                merger.add(tile_id, img_processed)
 
-                if not os.path.isfile(save_path_tile_txt):
+                if not labels_txt:
                     continue  # no preds found in this tile, move on
 
-                with open(save_path_tile_txt, 'r') as in_file:
-                    labels_txt = in_file.readlines()
-
-
-                    # test stuff
-                    print(tiler.get_tile_bbox(tile_id))
-                    print(tiler.get_mosaic_shape())
-                    print(tiler.get_tile_mosaic_position(tile_id))
-
-                    # transform to global coords 
-                    # get bottom-left coords (attention: tiler uses different origin)
-                    x_min = min(
-                        tiler.get_tile_bbox(tile_id)[0][1],
-                        tiler.get_tile_bbox(tile_id)[1][1]
-                    )
-
-                    x_max = max(
-                        tiler.get_tile_bbox(tile_id)[0][1],
-                        tiler.get_tile_bbox(tile_id)[1][1]
-                    )
-
-                    y_min = min(
-                        tiler.get_tile_bbox(tile_id)[0][0],
-                        tiler.get_tile_bbox(tile_id)[1][0]
-                    )
-
-                    y_max = max(
-                        tiler.get_tile_bbox(tile_id)[0][0],
-                        tiler.get_tile_bbox(tile_id)[1][0]
-                    )
-
-                    # get width and height of tile
-                    w = x_max - x_min
-                    h = y_max - y_min
+                # test stuff
+                print(tiler.get_tile_bbox(tile_id))
+                print(tiler.get_mosaic_shape())
+                print(tiler.get_tile_mosaic_position(tile_id))
+
+                # transform to global coords 
+                # get bottom-left coords (attention: tiler uses different origin)
+                x_min = min(
+                    tiler.get_tile_bbox(tile_id)[0][1],
+                    tiler.get_tile_bbox(tile_id)[1][1]
+                )
+
+                x_max = max(
+                    tiler.get_tile_bbox(tile_id)[0][1],
+                    tiler.get_tile_bbox(tile_id)[1][1]
+                )
+
+                y_min = min(
+                    tiler.get_tile_bbox(tile_id)[0][0],
+                    tiler.get_tile_bbox(tile_id)[1][0]
+                )
+
+                y_max = max(
+                    tiler.get_tile_bbox(tile_id)[0][0],
+                    tiler.get_tile_bbox(tile_id)[1][0]
+                )
+
+                # get width and height of tile
+                w = x_max - x_min
+                h = y_max - y_min
+                
+                print(x_min, y_min, x_max, y_max)
+                print(w, h)
+
+                for line in labels_txt:
+                    fields = line.split()
+                    class_id = fields[0]
+                    confidence = fields[5]
+
+                    if float(confidence) < 0.5:
+                        continue
+
+                    x1 = int(((float(fields[1]) - float(fields[3])/2.0) * w) + x_min)
+                    y1 = int(((float(fields[2]) - float(fields[4])/2.0) * h) + y_min)
+                    x2 = int(((float(fields[1]) + float(fields[3])/2.0) * w) + x_min)
+                    y2 = int(((float(fields[2]) + float(fields[4])/2.0) * h) + y_min)
                     
-                    print(x_min, y_min, x_max, y_max)
-                    print(w, h)
-
-                    for line in labels_txt:
-                        fields = line.split()
-                        class_id = fields[0]
-                        confidence = fields[5]
-
-                        if float(confidence) < 0.5:
-                            continue
-
-                        x1 = int(((float(fields[1]) - float(fields[3])/2.0) * w) + x_min)
-                        y1 = int(((float(fields[2]) - float(fields[4])/2.0) * h) + y_min)
-                        x2 = int(((float(fields[1]) + float(fields[3])/2.0) * w) + x_min)
-                        y2 = int(((float(fields[2]) + float(fields[4])/2.0) * h) + y_min)
-                        
-                        # add line to global labels file
-                        elements.append({
-                            "guid": str(uuid4()),
-                            "class_id": class_id,
-                            "confidence": confidence,
-                            "bbox_xyxy_abs": [x1, y1, x2, y2]
-                        })
+                    # add line to global labels file
+                    elements.append({
+                        "guid": str(uuid4()),
+                        "class_id": class_id,
+                        "confidence": confidence,
+                        "bbox_xyxy_abs": [x1, y1, x2, y2]
+                    })
 
             # save final merge
             final_image = merger.merge(unpad=True)
@@ -202,4 +281,25 @@ class Localizer:
             json.dump(output, out_file)
         out_file.close()
 
-        return
\ No newline at end of file
+        return
+
+
+def inference_batched(localizers, filenames, detector, batch_size, tile_size=640):
+    '''Localizes the images of several Localizers (e.g. one per image of a
+    project, each with its own output dirs) with the in-process backend,
+    batching the tiles across all of them. filenames holds the list of image
+    files for each Localizer.
+    '''
+    prepared = [localizer.tile_images(localizer_filenames, tile_size)
+                for localizer, localizer_filenames in zip(localizers, filenames)]
+
+    tiles = [tile for _, tiles_dict, _ in prepared for tile in tiles_dict.values()]
+    detections = detector.detect(tiles, batch_size=batch_size)
+
+    # demultiplex the detections back to the tiles of each Localizer
+    start = 0
+    for localizer, localizer_filenames, (tilers_dict, tiles_dict, images_dict) in zip(localizers, filenames, prepared):
+        end = start + len(tiles_dict)
+        detections_dict = localizer.save_detections(tiles_dict, detections[start:end])
+        localizer.postprocess(localizer_filenames, tilers_dict, images_dict, detections_dict)
+        start = end
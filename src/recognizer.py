@@ -12,15 +12,20 @@ from .parseq.strhub.data.module import SceneTextDataModule
 
 class Recognizer:
     
-    def __init__(self, config):
+    def __init__(self, config, parseq=None):
         
         self.config = config
 
         # Load model and image transforms
         # self.device = "cuda:0" #modified by shipan
-        self.device = torch.device('cpu')
-        self.parseq = torch.hub.load('baudm/parseq', 'parseq', pretrained=True).eval()
-        self.parseq.to(self.device)
+        # an already loaded model (e.g. from a worker's model pool) can be passed in to skip loading
+        if parseq is None:
+            self.device = torch.device('cpu')
+            self.parseq = torch.hub.load('baudm/parseq', 'parseq', pretrained=True).eval()
+            self.parseq.to(self.device)
+        else:
+            self.parseq = parseq
+            self.device = next(parseq.parameters()).device
         self.img_transform = SceneTextDataModule.get_transform(self.parseq.hparams.img_size)
 
         # dirs
@@ -10,7 +10,7 @@ EOF
 # Open a new terminal window and start a celery worker
 osascript <<EOF
 tell application "Terminal"
-    do script "cd $(pwd); celery -A project worker -l info"
+    do script "cd $(pwd); celery -A project worker -l info -Q interactive,bulk"
 end tell
 EOF
 
@@ -30,7 +30,7 @@ class ProjectInline(admin.TabularInline):
 
 @admin.register(models.Customer)
 class CustomerAdmin(admin.ModelAdmin):
-    list_display = ['id', 'username', 'first_name', 'last_name', 'phone', 'email', "is_staff"]
+    list_display = ['id', 'username', 'first_name', 'last_name', 'phone', 'email', 'plan', "is_staff"]
 
     readonly_fields = ['id', "user", 'username', 'first_name', 'last_name', "birth_date", "email", "is_staff"]
     inlines = [ProjectInline]
@@ -75,7 +75,7 @@ class ImageInline(admin.TabularInline):
     def thumbnail(self, instance):
         if instance.image_file:
             # Display the image file name with a thumbnail if possible
-            return format_html('<img src="{}" style="max-width: 100px; max-height: 100px;" />', instance.image_file.url)
+            return format_html('<img src="{}" style="max-width: 100px; max-height: 100px;" />', instance.thumbnail_url())
         return "No Image"
 
     # you cannot add new image(normally in admin page, you can add new instance)
@@ -167,7 +167,7 @@ class ImageAdmin(admin.ModelAdmin):
     def thumbnail1(self, instance):
         if instance.image_file:
             return format_html('<img src="{}" style="max-width: 100px; max-height: 100px;" />',
-                instance.image_file.url)
+                instance.thumbnail_url())
         return "No Image"
 
     thumbnail1.short_description = 'Thumbnail'
@@ -177,7 +177,7 @@ class ImageAdmin(admin.ModelAdmin):
             return format_html('<a href="{}" target="_blank">'
                 '<img src="{}" style="max-width: 100px; max-height: 100px;" /> (click to view)'
                 '</a>',
-                instance.image_file.url, instance.image_file.url)
+                instance.image_file.url, instance.thumbnail_url())
         return "No Image"
 
     thumbnail2.short_description = 'Thumbnail'
@@ -264,7 +264,7 @@ class ResultSetAdmin(admin.ModelAdmin):
             return format_html(
                 '<a href="{}" target="_blank">'
                 '<img src="{}" style="max-width: 100px; max-height: 100px;" />'
-                '</a>',obj.image.image_file.url, obj.image.image_file.url)
+                '</a>',obj.image.image_file.url, obj.image.thumbnail_url())
         return "No Image"
 
     display_original_image.short_description = 'Original Image'
@@ -319,12 +319,19 @@ class AiModelAdmin(admin.ModelAdmin):
     # fields = ['name', 'description', ...]
     # readonly_fields = ['created_at', 'updated_at']
 
+class AiChainModuleReplicaInline(admin.TabularInline):
+    model = models.AiChainModuleReplica
+    fields = ['url', 'is_active', 'created_at']
+    readonly_fields = ['created_at']
+    extra = 0
+
 @admin.register(models.AiChainModule)
 class AiChainModuleAdmin(admin.ModelAdmin):
-    list_display = ['name', 'module_url', 'description', 'updated_at']
+    list_display = ['name', 'module_url', 'description', 'version', 'max_batch_size', 'max_concurrency', 'updated_at']
     list_filter = ['created_at', 'updated_at']
     search_fields = ['name', 'description', 'module_url']
     ordering = ['updated_at']
+    inlines = [AiChainModuleReplicaInline]
 
 class ChainModuleResultInline(admin.TabularInline):
     model = models.ChainModuleResult
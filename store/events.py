@@ -0,0 +1,125 @@
+"""
+server-sent events endpoint of the processing progress, served by the ASGI entry point (project/asgi.py):
+
+    GET /store/projects/{project_id}/events/?token={JWT access token}
+
+the browser's EventSource cannot send an Authorization header, so the access token is passed as query param.
+every progress event of the project (see utility/progress_events.py) is sent as one "data:" message,
+instead of the frontend polling the project.
+"""
+import asyncio
+import re
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from .utility.progress_events import channel_name
+
+
+PATH_PATTERN = re.compile(r"^/store/projects/(?P<project_id>\d+)/events/?$")
+
+
+def match(scope):
+    if scope["type"] != "http":
+        return None
+    found = PATH_PATTERN.match(scope["path"])
+    return int(found.group("project_id")) if found else None
+
+
+# runs outside of django's request handling, which closes the connections that are too old or broken (e.g. after
+# the database's wait_timeout) before and after every request: done here instead
+@sync_to_async
+def can_access(token, project_id):
+    close_old_connections()
+    try:
+        return user_can_access(token, project_id)
+    finally:
+        close_old_connections()
+
+
+def user_can_access(token, project_id):
+    from rest_framework_simplejwt.tokens import AccessToken
+    from rest_framework_simplejwt.exceptions import TokenError
+    from django.contrib.auth import get_user_model
+    from .models import Project
+
+    try:
+        user_id = AccessToken(token)[settings.SIMPLE_JWT.get("USER_ID_CLAIM", "user_id")]
+    except (TokenError, KeyError):
+        return False
+
+    user = get_user_model().objects.filter(id=user_id, is_active=True).first()
+    if user is None:
+        return False
+    projects = Project.objects.filter(id=project_id)
+    if not user.is_staff:
+        projects = projects.filter(customer__user=user)
+    return projects.exists()
+
+
+async def send_response_start(send, status, content_type):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+
+async def project_events(scope, receive, send, project_id):
+    query = parse_qs(scope.get("query_string", b"").decode())
+    token = query.get("token", [""])[0]
+    if not token or not await can_access(token, project_id):
+        await send_response_start(send, 403, b"text/plain")
+        await send({"type": "http.response.body", "body": b"Forbidden"})
+        return
+
+    import redis.asyncio as aioredis
+
+    client = aioredis.Redis.from_url(settings.PROCESSING_REDIS_URL)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(channel_name(project_id))
+    except Exception as e:
+        # the progress can still be polled (see "progress" in views.py)
+        print(f"progress events of project {project_id} not available: {e}")
+        await pubsub.aclose()
+        await client.aclose()
+        await send_response_start(send, 503, b"text/plain")
+        await send({"type": "http.response.body", "body": b"Service Unavailable"})
+        return
+
+    async def wait_for_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await send_response_start(send, 200, b"text/event-stream")
+        await send({"type": "http.response.body", "body": b": connected\n\n", "more_body": True})
+
+        last_sent = asyncio.get_event_loop().time()
+        while not disconnected.done():
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            now = asyncio.get_event_loop().time()
+            if message is not None:
+                body = b"data: " + message["data"] + b"\n\n"
+            elif now - last_sent >= settings.PROGRESS_EVENTS_KEEPALIVE:
+                # keeps proxies from closing the idle connection
+                body = b": keep-alive\n\n"
+            else:
+                continue
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+            last_sent = now
+    finally:
+        disconnected.cancel()
+        await pubsub.unsubscribe(channel_name(project_id))
+        await pubsub.aclose()
+        await client.aclose()
@@ -1,21 +1,29 @@
 from django.core.validators import MinValueValidator
 from django.db import models
 from .utility.utilities import project_image_directory_path
+from .utility import progress_counters, derivatives, result_payloads
 from django.conf import settings
 from django.contrib import admin
 import os
 import shutil
+from uuid import uuid4
 
 
-from .validators import simgle_image_size_vsalidator
-
 
 
 # Create your models here.
 # here define the profile
 class Customer(models.Model):
+    # the plan weighs the customer's share of the bulk processing queue (CHAIN_PLAN_WEIGHTS)
+    PLAN_CHOICES = [
+        ('BASIC', 'Basic'),
+        ('PRO', 'Pro'),
+        ('ENTERPRISE', 'Enterprise'),
+    ]
+
     phone = models.CharField(max_length=255, null=True, blank=True)
     birth_date = models.DateField(null=True, blank=True)
+    plan = models.CharField(max_length=20, choices=PLAN_CHOICES, default='BASIC')
     # if a user is deleted, then the customer should also be deleted
     # but if this customer has projects, then this customer can not be deleted.
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="customer")
@@ -81,6 +89,9 @@ class Project(models.Model):
     status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='PENDING')  # Example: pending, processing, completed, failed
     # if you delete a custiomer. and this customer has projects related, then you can not delete
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name="projects")
+    # the current processing run (see utility/project_runs.py): its id, passed to all its tasks, and the modules it runs
+    run_id = models.CharField(max_length=32, null=True, blank=True)
+    run_modules = models.JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -103,21 +114,30 @@ class Project(models.Model):
         except ResultSet.DoesNotExist:
             pass  # If ResultSet does not exist, no action needed
 
+        progress_counters.clear(self.id)
+
         # Call the "real" delete() method to delete the object from the database
         super().delete(*args, **kwargs)
 
+    # reads the progress counters of the project (see utility/progress_counters.py) instead of scanning its images
     def update_status_based_on_images(self):
-        unprocessed_images_exist = Image.objects.filter(project=self, has_result=False).exists()
-        if unprocessed_images_exist and self.status == 'PROCESSING':  # Use named constants or direct string if STATUS_CHOICES is not an enum
+        counts = progress_counters.get(self)
+        unprocessed_images_exist = counts['done'] < counts['total']
+        # the images of a failed run are left unprocessed, the run is over once every image is done or failed
+        run_over = counts['done'] + counts['failed'] >= counts['total']
+        if unprocessed_images_exist and not run_over and self.status == 'PROCESSING':  # Use named constants or direct string if STATUS_CHOICES is not an enum
             return
 
         if self.status == 'FAILED':  # Use named constants or direct string if STATUS_CHOICES is not an enum
             return
         elif unprocessed_images_exist:
-            self.status = 'PENDING'  # 'PENDING'
+            status = 'PENDING'  # 'PENDING'
         else:
-            self.status = 'COMPLETED'  # 'COMPLETED'
-        self.save()
+            status = 'COMPLETED'  # 'COMPLETED'
+        # polled by the frontend, only written when it changes
+        if status != self.status:
+            self.status = status
+            self.save(update_fields=['status', 'updated_at'])
 
 
     def __str__(self) -> str:
@@ -133,13 +153,15 @@ class Image(models.Model):
     old_name = models.CharField(max_length=200)
     type = models.CharField(max_length=20, blank=True, null=True)
     # In the Database: The ImageField or FileField stores the path relative to MEDIA_ROOT, like project_2/p2_1.png.
-    # a single image can not be bigger than 5MB
+    # a single image can not be bigger than IMAGE_MAX_SIZE_MB, accounted while it is uploaded (see validators.py)
     # image_files has 2 subfield:
     # image_file.name = project_7/c99016bc-5344-44cd-9480-5759c09693cb.jpg
     # image_file.url = /media/project_7/c99016bc-5344-44cd-9480-5759c09693cb.jpg, almost same as the following defined method image_url()
 
-    image_file = models.ImageField(upload_to=project_image_directory_path, validators=[simgle_image_size_vsalidator])
+    image_file = models.ImageField(upload_to=project_image_directory_path)
     has_result = models.BooleanField(default=False)
+    # thumbnail, preview and working copy are made (see utility/derivatives.py)
+    derivatives_ready = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -156,6 +178,7 @@ class Image(models.Model):
             image_path = os.path.join(settings.MEDIA_ROOT, self.image_file.name)
             if os.path.isfile(image_path):
                 os.remove(image_path)
+            derivatives.remove(self)
 
             # Delete corresponding output directory
             image_base_name = os.path.splitext(self.name)[0]
@@ -184,16 +207,62 @@ class Image(models.Model):
         # /Volumes/D/Z_Frond_Back_workplace/10_BA/ba_server/store/imagesproject_1/p1_1.png
         return f"{settings.MEDIA_ROOT}/{self.image_file}"
 
+    # the derivatives, the original until they are made
+    def thumbnail_url(self):
+        return derivatives.derivative_url(self, 'thumbnail') if self.derivatives_ready else self.image_url()
+
+    def preview_url(self):
+        return derivatives.derivative_url(self, 'preview') if self.derivatives_ready else self.image_url()
+
+    # the file the AI chain modules get, always the working copy: a run does not depend on the derivatives being ready
+    def processing_path(self):
+        return derivatives.working_copy_path(self)
+
     def __str__(self) -> str:
         return f"image id: {self.id}, name: {self.name}, belonged project: {self.project}"
 
     class Meta:
         db_table = "image"
 
+
+# a resumable (chunked) upload of an image: the chunks are appended to part_path() until "length" bytes are received,
+# the Image is only created when the upload is finalized (see "upload_detail" and "upload_finalize" in views.py)
+class ImageUpload(models.Model):
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='uploads')
+    token = models.UUIDField(default=uuid4, unique=True, editable=False)
+    old_name = models.CharField(max_length=200)
+    type = models.CharField(max_length=20)
+    # bytes of the complete file (announced when the upload is created) and bytes received so far
+    length = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def part_path(self):
+        return os.path.join(settings.MEDIA_ROOT, f'project_{self.project_id}', 'uploads', f'{self.token}.part')
+
+    def delete(self, *args, **kwargs):
+        if os.path.isfile(self.part_path()):
+            os.remove(self.part_path())
+        super().delete(*args, **kwargs)
+
+    def __str__(self) -> str:
+        return f"upload: {self.token}, name: {self.old_name}, {self.offset}/{self.length} bytes, belonged project: {self.project}"
+
+    class Meta:
+        db_table = "image_upload"
+
 class AiChainModule(models.Model):
     module_url = models.CharField(max_length=200)
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True)
+    # how many images the module accepts in one request (see "AI-modules requirements" in the README), 1 = no batching
+    max_batch_size = models.PositiveIntegerField(default=1)
+    # how many calls the module gets at the same time from all the workers (see utility/module_limits.py), 0 = no limit
+    max_concurrency = models.PositiveIntegerField(default=0)
+    # part of the result cache key (see ChainModuleCacheEntry): change it whenever the module's model or config changes,
+    # so its cached results are not reused anymore
+    version = models.CharField(max_length=100, blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -219,6 +288,7 @@ class ChainModuleResultSet(models.Model):
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)  # Save the ResultSet first
+        result_payloads.invalidate(self.project_id)
 
         # Check if there is a related image and update its has_result field
         """  if self.image:
@@ -242,6 +312,11 @@ class ChainModuleResult(models.Model):
     image = models.ForeignKey(Image, on_delete=models.SET_NULL, blank=True, null=True)
     result = models.JSONField()
     result_set = models.ForeignKey(ChainModuleResultSet, on_delete=models.CASCADE, related_name='results')
+    # checkpoint of the chain: index of the module in the chain and its .zip output, the input of the next stage
+    stage_index = models.PositiveIntegerField(blank=True, null=True)
+    artifact_path = models.CharField(max_length=500, blank=True, null=True)
+    # cell size of the spatial index of the detected elements, None while not indexed (see utility/spatial_index.py)
+    element_index_cell_size = models.PositiveIntegerField(blank=True, null=True)
 
     # def save(self, *args, **kwargs):
     #    super().save(*args, **kwargs)  # Save the ResultSet first
@@ -253,12 +328,64 @@ class ChainModuleResult(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
     # No updates, since every module run will create a new ChainModuleResult entry
+    # (the results written by ResultBuffer.flush skip save(), it outdates the cached payloads itself)
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        result_payloads.invalidate(self.project_id)
+
     def __str__(self) -> str:
         return f"ID: {self.id}"
     class Meta:
         db_table = "ai_chain_module_result"
 
 
+# cell of the spatial index of the detected elements of a result: the elements and fields (room stamps)
+# whose boxes intersect the cell cx, cy (see utility/spatial_index.py)
+class ElementIndexCell(models.Model):
+    result = models.ForeignKey(ChainModuleResult, on_delete=models.CASCADE, related_name='index_cells')
+    cx = models.IntegerField()
+    cy = models.IntegerField()
+    elements = models.JSONField()
+
+    class Meta:
+        db_table = "element_index_cell"
+        indexes = [models.Index(fields=['result', 'cx', 'cy'])]
+
+
+# further endpoint of an AI chain module serving the same API as its module_url,
+# the module calls are balanced over all of them (see utility/replicas.py)
+class AiChainModuleReplica(models.Model):
+    module = models.ForeignKey(AiChainModule, on_delete=models.CASCADE, related_name='replicas')
+    url = models.CharField(max_length=200)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f"{self.url}"
+
+    class Meta:
+        db_table = "ai_chain_module_replica"
+
+
+# result of a module for an input file, reused instead of calling the module again for the same input
+# (e.g. when a project is started again after adding an image), see utility/result_cache.py
+class ChainModuleCacheEntry(models.Model):
+    input_sha256 = models.CharField(max_length=64)
+    module = models.ForeignKey(AiChainModule, on_delete=models.CASCADE, related_name='cache_entries')
+    module_version = models.CharField(max_length=100, blank=True, default="")
+    result = models.JSONField()
+    # the module's .zip output, the input of the next module
+    output_path = models.CharField(max_length=500)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f"{self.module_id}:{self.module_version}:{self.input_sha256}"
+
+    class Meta:
+        db_table = "ai_chain_module_cache_entry"
+        unique_together = [['input_sha256', 'module', 'module_version']]
+
+
 class ResultSet(models.Model):
     image = models.OneToOneField(Image, on_delete=models.CASCADE)
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='resultSets')
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+# pages of the project list (see "ProjectsViewSet" in views.py), only used when the request asks for them
+# with "?page_size=N" or follows a "next"/"previous" link ("?cursor=...").
+# a cursor page is read with one "WHERE id < ... LIMIT N" query however many projects come before it
+class ProjectCursorPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    # the id is unique and grows with the creation time: newest projects first, stable under inserts
+    ordering = '-id'
+
+    def is_requested(self, request):
+        return self.page_size_query_param in request.query_params or self.cursor_query_param in request.query_params
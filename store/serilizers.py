@@ -2,6 +2,7 @@ from rest_framework import serializers
 from .models import ChainModuleResult, ChainModuleResultSet, Customer, AiModel, Project, Image, ResultSet, AiChainModule
 from django.db import transaction
 from core.serializers import UserSerializer, DetailUserSerializer
+from .utility.element_filters import ElementFilter
 
 
 # SLizer for AI
@@ -13,20 +14,29 @@ class AisModelSerilizer(serializers.ModelSerializer):
 class AiChainModuleSerializer(serializers.ModelSerializer):
     class Meta:
         model = AiChainModule
-        fields = ["id", "module_url", "name", "description"]
+        fields = ["id", "module_url", "name", "description", "version", "max_batch_size", "max_concurrency"]
 
 class ImageModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = Image
-        fields = ["id", "project_id", "name", "old_name", "type", "image_url", "has_result", "created_at", "updated_at"]
+        fields = ["id", "project_id", "name", "old_name", "type", "image_url", "thumbnail_url", "preview_url", "has_result", "created_at", "updated_at"]
 
     project_id = serializers.IntegerField()
     image_url = serializers.SerializerMethodField()
+    # the original until the derivatives are made
+    thumbnail_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
     # image_local_path = serializers.SerializerMethodField()
 
     def get_image_url(self, obj):
         return obj.image_url()
 
+    def get_thumbnail_url(self, obj):
+        return obj.thumbnail_url()
+
+    def get_preview_url(self, obj):
+        return obj.preview_url()
+
     # def get_image_local_path(self, obj):
     #     return obj.image_local_path()
 
@@ -62,6 +72,31 @@ class ProjectsModelSerilizer(serializers.ModelSerializer):
 
 
 
+# only the fields asked for with "?fields=id,name,status" (all of them without "fields")
+class SparseFieldsMixin:
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        fields = request.query_params.get("fields") if request is not None else None
+        if fields:
+            requested = set(fields.split(","))
+            for field_name in set(self.fields) - requested:
+                self.fields.pop(field_name)
+
+
+# for the pages of the project list: without the images, the number of images is counted by the query
+class ProjectListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Project
+        fields = ["id", "name", "description", "ai_model_id", "customer_id", "customer_username", "status", "images_nr", "created_at", "updated_at"]
+
+    ai_model_id = serializers.IntegerField()
+    customer_id = serializers.IntegerField()
+    customer_username = serializers.CharField(source="customer.user.username", read_only=True)
+    images_nr = serializers.IntegerField(read_only=True)
+
+
 # for creating a project
 class CreateProjectsModelSerilizer(serializers.ModelSerializer):
     class Meta:
@@ -104,7 +139,8 @@ class UpdateProjectsModelSerilizer(serializers.ModelSerializer):
 class CustomerModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = Customer
-        fields = ["id", "phone", "birth_date", "user_id", "user"]
+        fields = ["id", "phone", "birth_date", "plan", "user_id", "user"]
+        read_only_fields = ["plan"]
 
     user_id = serializers.IntegerField()
     user = DetailUserSerializer(read_only=True)
@@ -115,8 +151,31 @@ class PatchCustomerModelSerilizer(serializers.ModelSerializer):
         fields = ["phone", "birth_date"]
 
 
+# filters the detected elements in the json results by the query params of the request (see utility/element_filters.py),
+# element_result_fields are the json results of the model
+class ElementFilterMixin:
+    element_result_fields = []
+
+    def get_element_filter(self):
+        # parsed once per request, the context is shared with the nested and listed serializers
+        if "element_filter" not in self.context:
+            request = self.context.get("request")
+            self.context["element_filter"] = ElementFilter.from_query_params(request.query_params) if request is not None else ElementFilter()
+        return self.context["element_filter"]
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        element_filter = self.get_element_filter()
+        for field_name in self.element_result_fields:
+            if field_name in data:
+                data[field_name] = element_filter.apply(data[field_name])
+        return data
+
+
 # for ResultSet
-class ResultSetModelSerializer(serializers.ModelSerializer):
+class ResultSetModelSerializer(ElementFilterMixin, serializers.ModelSerializer):
+    element_result_fields = ['result_detection', 'result_recognition', 'result_interpretation']
+
     text_detection_image_url = serializers.SerializerMethodField()
     text_recognition_image_url = serializers.SerializerMethodField()
     text_interpretation_image_url = serializers.SerializerMethodField()
@@ -144,7 +203,9 @@ class ResultSetModelSerializer(serializers.ModelSerializer):
         return obj.get_full_interpretation_image_url()
     
 
-class ChainModuleResultModelSerializer(serializers.ModelSerializer):
+class ChainModuleResultModelSerializer(ElementFilterMixin, serializers.ModelSerializer):
+    element_result_fields = ['result']
+
     module_name = serializers.CharField(source='module.name', read_only=True)
     image_url = serializers.SerializerMethodField()
     image_id = serializers.SerializerMethodField()
@@ -4,122 +4,589 @@ for the celery tasks
 """
 
 # tasks.py
-from celery import shared_task, chain
-from .utility.ai_utils import prepare_cfg, run_ai_model
+from celery import shared_task, chain, group
+from celery.utils.log import get_task_logger
+from celery.utils.time import get_exponential_backoff_interval
+from .utility.ai_utils import prepare_cfg, run_ai_model, run_ai_models
+from .utility.chain_utils import (chain_artifact_path, read_zip_jsons, first_json_result,
+                                  batch_upload_name, split_batch_zip, merge_zips,
+                                  module_context, module_from_context, image_info)
+from .utility.result_buffer import ResultBuffer
+from .utility import (result_cache, fair_scheduler, replicas, progress_events, project_runs, derivatives, spatial_index,
+                      image_upload, result_payloads)
+from .utility.module_limits import module_slot, ModuleBusy
 from .models import Image, ResultSet, Project, ChainModuleResult, ChainModuleResultSet, AiChainModule
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from pathlib import Path
+from uuid import uuid4
+import io
 import os
+import random
 import requests
 import json
 from zipfile import ZipInfo, ZipFile
 
+logger = get_task_logger(__name__)
 
-@shared_task
-def process_file_in_module(parameters, module_url):
-    project_id, image_id, chain_result_set_id, input_filepath = parameters
 
-    image = Image.objects.get(id=image_id)
-    project = Project.objects.get(id=project_id)
-    chain_result_set = ChainModuleResultSet.objects.get(id=chain_result_set_id)
-    module = AiChainModule.objects.get(module_url=module_url)
+# the task of a cancelled run returns without failing, the rest of its chain (if any) is not run.
+# the fair slot of the run was freed by the cancel (see utility/project_runs.py)
+def stop_cancelled(task, project_id, image_id, run_id):
+    logger.info("run %s of project %s is cancelled, image %s stops at %s", run_id, project_id, image_id, task.name)
+    if task.request.chain:
+        task.request.chain = None
+    return None
 
-    with open(input_filepath, 'rb') as f:
-        files = {'file': f}
-        response = requests.post(module_url, files=files)
 
-    if response.status_code != 200:
-        raise Exception(f"Stage failed with status code {response.status_code}")
-    
-    result_zip = response.content
-
-    temp_zip_path = os.path.join(settings.MEDIA_ROOT, 'outputs', 'temp_results.zip')
-    with open(temp_zip_path, 'wb') as f:
+# stage: index of the module in the chain, names the output file kept as the input of the next stage
+# module: module_context() of the module, so it does not have to be fetched again (fetched by module_url otherwise)
+# a stage failing on a network error is retried, the stages before it are not run again
+# run_id: the project run of the chain, the chain stops (stop_cancelled) once it is no longer the current run
+# busy_retries: the retries of the stage so far because the module was saturated (see retry_when_busy)
+@shared_task(bind=True)
+def process_file_in_module(self, parameters, module_url, stage=None, module=None, run_id=None, busy_retries=0):
+    project_id, image_id, chain_result_set_id, input_filepath = parameters
+    if not project_runs.is_current(project_id, run_id):
+        return stop_cancelled(self, project_id, image_id, run_id)
+
+    # checkpoint: the stage is already done (e.g. the task was delivered again after its worker died)
+    if stage is not None:
+        done_artifact_path = (ChainModuleResult.objects
+                              .filter(result_set_id=chain_result_set_id, stage_index=stage)
+                              .values_list('artifact_path', flat=True).first())
+        if done_artifact_path and os.path.isfile(done_artifact_path):
+            return project_id, image_id, chain_result_set_id, done_artifact_path
+
+    if module is not None:
+        module = module_from_context(module)
+    else:
+        module = AiChainModule.objects.get(module_url=module_url)
+
+    try:
+        (result_zip, result), = call_module(module, [(None, None, input_filepath)])
+    except ModuleBusy as e:
+        raise retry_when_busy(self, e, busy_retries)
+    except requests.exceptions.RequestException as e:
+        raise retry_on_network_error(self, e, busy_retries)
+    # cancelled while the module was working
+    if not project_runs.is_current(project_id, run_id):
+        return stop_cancelled(self, project_id, image_id, run_id)
+
+    # the .json results are read from memory, only the output for the next stage is written,
+    # to a path of its own so concurrent tasks do not overwrite each other
+    if stage is None:
+        stage = uuid4().hex
+    output_filepath = chain_artifact_path(project_id, chain_result_set_id, stage)
+    with open(output_filepath, 'wb') as f:
         f.write(result_zip)
 
-    jsons = []
-
-    with ZipFile(temp_zip_path) as zObject:
-        filelist = zObject.infolist()
-
-        # gather images
-        filenames = [zInfo for zInfo in filelist
-                    if zInfo.filename.endswith(".json")]
-
-        for filename in filenames:
-            with zObject.open(filename.filename) as myJson:
-                jsons.append(json.loads(myJson.read()))
-
-    if len(jsons) == 0: 
-        jsons[0] = json.dumps({'msg':'No .json result was produced'})
-
     module_result = ChainModuleResult.objects.create(
-        project = project,
-        module = module,
+        project_id = project_id,
+        module_id = module.id,
         # image = image, # DO NOT set an image, unless you want the project to have the COMPLETE status before the chain actually comes to completion
 
-        # Since for now each module produces only one .json result file 
-        # and the currently used frontend expects one .json file per moule 
         # only the first (and most probably the only one) .json file is saved to database.
-        result = jsons[0],
-        result_set = chain_result_set
+        result = result,
+        result_set_id = chain_result_set_id,
+        stage_index = stage if isinstance(stage, int) else None,
+        artifact_path = output_filepath
     )
+    progress_events.stage_done(project_id, image_id, chain_result_set_id, stage, module.id)
 
-    # os.remove(temp_zip_path)
-    return project_id, image_id, chain_result_set_id, temp_zip_path
+    return project_id, image_id, chain_result_set_id, output_filepath
 
+# queue: the queue the tasks of this run go to (interactive or bulk lane)
+# fair_token: slot of the run in the fair scheduler (bulk lane only), released when the run finishes or fails
+# resume: continue the last chain of the image from its first missing stage (see find_checkpoint) instead of starting over
+# run_id: the project run this chain belongs to (see utility/project_runs.py)
 @shared_task
-def processing_chain(project_id, image_id, ai_chain_modules_list):
+def processing_chain(project_id, image_id, ai_chain_modules_list, queue=None, fair_token=None, resume=False, run_id=None):
+    if not project_runs.is_current(project_id, run_id):
+        release_if_fair(fair_token)
+        return None
 
     #stages = [
     #   "http://127.0.0.1:5001/localize",
     #   "http://127.0.0.1:5002/recognize"
     #]
 
-    stages = []
-    for module_id in ai_chain_modules_list:
-        module = AiChainModule.objects.get(id=module_id)
-        stages.append(module.module_url)
-    
-    image = Image.objects.get(id=image_id)
-    project = Project.objects.get(id=project_id)
-    image_name = image.name  # the image_name here is with extensions
-    image_old_name = image.old_name
-    image_file_path = image.image_url()
+    # the chain releases the fair slot once it exists, a missing module or image fails before that
+    try:
+        modules_by_id = AiChainModule.objects.prefetch_related('replicas').in_bulk(ai_chain_modules_list)
+        modules = [modules_by_id[module_id] for module_id in ai_chain_modules_list]
 
-    
-    image_local_filepath = image.image_local_path()
+        image = Image.objects.get(id=image_id)
+        project = Project.objects.get(id=project_id)
+        image_name = image.name  # the image_name here is with extensions
+        image_old_name = image.old_name
+        image_file_path = image.image_url()
 
-    chain_result_set = ChainModuleResultSet.objects.create(
-        project = project,
-        image_id = image_id
-    )
+
+        image_local_filepath = image.processing_path()
+
+        checkpoint = find_checkpoint(image_id, modules) if resume else None
+        if checkpoint is not None:
+            chain_result_set, first_stage, image_local_filepath = checkpoint
+        else:
+            chain_result_set = ChainModuleResultSet.objects.create(
+                project = project,
+                image_id = image_id
+            )
+            first_stage = 0
+    except Exception:
+        release_if_fair(fair_token)
+        raise
 
     chain_result_set_id = chain_result_set.id
+    parameters = project_id, image_id, chain_result_set_id, image_local_filepath
 
+    # the module and image data travel with the tasks instead of being fetched again at every stage
     tasks = []
-    for i, url in enumerate(stages):
-        if i == 0:
-            parameters = project_id, image_id, chain_result_set_id, image_local_filepath
-            task = process_file_in_module.s(parameters, url)
+    for i, module in enumerate(modules[first_stage:], start=first_stage):
+        if i == first_stage:
+            task = process_file_in_module.s(parameters, module.module_url, stage=i, module=module_context(module), run_id=run_id)
         else:
-            task = process_file_in_module.s(url)
+            task = process_file_in_module.s(module.module_url, stage=i, module=module_context(module), run_id=run_id)
         tasks.append(task)
     
-    final_task_task = final_task.s()
+    # all the stages were done already, only the final task is left
+    if tasks:
+        final_task_task = final_task.s(image_info=image_info(image), run_id=run_id)
+    else:
+        final_task_task = final_task.s(parameters, image_info=image_info(image), run_id=run_id)
     tasks.append(final_task_task)
 
-    pipeline = chain(tasks)()
+    if fair_token:
+        tasks.append(release_fair_slot.si(fair_token))
+    if queue:
+        tasks = [task.set(queue=queue) for task in tasks]
+
+    pipeline = chain(tasks)
+    if fair_token:
+        pipeline.link_error(release_fair_slot.si(fair_token))
+    pipeline = pipeline()
 
     return pipeline
 
+# the last chain of the image, if it did the first stages of the given modules: (chain result set, first missing stage,
+# artifact of the last done stage as input of the next one), None if there is nothing to continue
+def find_checkpoint(image_id, modules):
+    chain_result_set = ChainModuleResultSet.objects.filter(image_id=image_id).order_by('-id').first()
+    if chain_result_set is None:
+        return None
+
+    results = {result.stage_index: result for result in chain_result_set.results.all()
+               if result.stage_index is not None}
+    stage = 0
+    while (stage < len(modules) and stage in results
+           and results[stage].module_id == modules[stage].id
+           and results[stage].artifact_path and os.path.isfile(results[stage].artifact_path)):
+        stage += 1
+
+    if stage == 0:
+        return None
+    return chain_result_set, stage, results[stage - 1].artifact_path
+
+# the last dependency graph run of the image, if it did some of the modules of the graph: (chain result set,
+# ids of the modules done), None if there is nothing to continue. a module counts as done with its result and output
+# at the stage of the module in the graph, and all of its dependencies done
+def find_dag_checkpoint(image_id, graph):
+    chain_result_set = ChainModuleResultSet.objects.filter(image_id=image_id).order_by('-id').first()
+    if chain_result_set is None:
+        return None
+
+    modules = graph["modules"]
+    results = {result.module_id: result for result in chain_result_set.results.all()}
+    done = set()
+    changed = True
+    while changed:
+        changed = False
+        for module_id in modules:
+            result = results.get(module_id)
+            if (module_id not in done and result is not None and result.stage_index == modules.index(module_id)
+                    and result.artifact_path and os.path.isfile(result.artifact_path)
+                    and all(parent_id in done for parent_id in graph["dependencies"][str(module_id)])):
+                done.add(module_id)
+                changed = True
+
+    if not done:
+        return None
+    return chain_result_set, done
+
+# runs the modules of a dependency graph (see parse_chain_graph in utility/chain_utils.py) on an image:
+# the modules without dependencies start in parallel, every other module is started by the last of its dependencies to finish
+# resume: continue the last graph run of the image with the modules not done yet (see find_dag_checkpoint)
+@shared_task
+def processing_dag(project_id, image_id, graph, queue=None, fair_token=None, resume=False, run_id=None):
+    if not project_runs.is_current(project_id, run_id):
+        release_if_fair(fair_token)
+        return None
+
+    # the nodes release the fair slot once they exist, a missing module or image fails before that
+    try:
+        checkpoint = find_dag_checkpoint(image_id, graph) if resume else None
+        if checkpoint is not None:
+            chain_result_set, done = checkpoint
+            # results of modules not done (output gone, dependency redone) would be taken as done by the nodes
+            chain_result_set.results.exclude(module_id__in=done).delete()
+            # the cached result payloads still show them
+            result_payloads.invalidate(project_id)
+        else:
+            chain_result_set = ChainModuleResultSet.objects.create(
+                project_id = project_id,
+                image_id = image_id
+            )
+            done = set()
+
+        roots = [module_id for module_id in graph["modules"] if module_id not in done
+                 and all(parent_id in done for parent_id in graph["dependencies"][str(module_id)])]
+        if not roots:
+            if done:
+                # all the modules were done already, only the final task is left
+                last_output = chain_result_set.results.order_by('-id').values_list('artifact_path', flat=True).first()
+                image = Image.objects.get(id=image_id)
+                final_task.apply_async(((project_id, image_id, chain_result_set.id, last_output),),
+                                       {"image_info": image_info(image), "run_id": run_id}, queue=queue)
+            else:
+                chain_result_set.update_image_status()
+            release_if_fair(fair_token)
+            return None
+
+        # the module and image data travel with the node tasks instead of being fetched again by every node
+        image = Image.objects.get(id=image_id)
+        modules = AiChainModule.objects.prefetch_related('replicas').in_bulk(graph["modules"])
+        context = {
+            "image_path": image.processing_path(),
+            "image_info": image_info(image),
+            "modules": {str(module_id): module_context(module) for module_id, module in modules.items()},
+            "run_id": run_id
+        }
+    except Exception:
+        release_if_fair(fair_token)
+        raise
+
+    return group(dag_node_signature(project_id, image_id, chain_result_set.id, module_id, graph, queue, fair_token, context)
+                 for module_id in roots)()
+
+def dag_node_signature(project_id, image_id, chain_result_set_id, module_id, graph, queue, fair_token, context):
+    signature = process_dag_node.s(project_id, image_id, chain_result_set_id, module_id, graph,
+                                   queue=queue, fair_token=fair_token, context=context)
+    if queue:
+        signature.set(queue=queue)
+    if fair_token:
+        signature.on_error(release_fair_slot.si(fair_token))
+    return signature
+
+@shared_task(bind=True)
+def process_dag_node(self, project_id, image_id, chain_result_set_id, module_id, graph, queue=None, fair_token=None, context=None,
+                     busy_retries=0):
+    modules = graph["modules"]
+    dependencies = graph["dependencies"]
+    stage = modules.index(module_id)
+    parent_ids = dependencies[str(module_id)]
+
+    run_id = context.get("run_id")
+    if not project_runs.is_current(project_id, run_id):
+        return stop_cancelled(self, project_id, image_id, run_id)
+
+    # checkpoint: the node is already done (e.g. the task was delivered again after its worker died),
+    # its children were started by the first delivery
+    done_artifact_path = (ChainModuleResult.objects
+                          .filter(result_set_id=chain_result_set_id, stage_index=stage)
+                          .values_list('artifact_path', flat=True).first())
+    if done_artifact_path and os.path.isfile(done_artifact_path):
+        return project_id, image_id, chain_result_set_id, done_artifact_path
+
+    module = module_from_context(context["modules"][str(module_id)])
+
+    # input: the original image, the output of the only dependency or the merged outputs of all dependencies
+    if not parent_ids:
+        input_filepath = context["image_path"]
+    elif len(parent_ids) == 1:
+        input_filepath = chain_artifact_path(project_id, chain_result_set_id, modules.index(parent_ids[0]))
+    else:
+        input_filepath = merge_zips(
+            {f"module_{parent_id}": chain_artifact_path(project_id, chain_result_set_id, modules.index(parent_id))
+             for parent_id in parent_ids},
+            chain_artifact_path(project_id, chain_result_set_id, f"{stage}_input")
+        )
+
+    try:
+        (result_zip, result), = call_module(module, [(None, None, input_filepath)])
+    except ModuleBusy as e:
+        raise retry_when_busy(self, e, busy_retries)
+    except requests.exceptions.RequestException as e:
+        raise retry_on_network_error(self, e, busy_retries)
+    if not project_runs.is_current(project_id, run_id):
+        return stop_cancelled(self, project_id, image_id, run_id)
+    output_filepath = chain_artifact_path(project_id, chain_result_set_id, stage)
+    with open(output_filepath, 'wb') as f:
+        f.write(result_zip)
+
+    # the result set row is locked while storing the result and looking at the finished modules,
+    # so of several dependencies finishing at the same time exactly one sees the others done and starts the next module
+    with transaction.atomic():
+        chain_result_set = ChainModuleResultSet.objects.select_for_update().get(id=chain_result_set_id)
+        # a second delivery running at the same time as the first one stores and starts nothing
+        if chain_result_set.results.filter(stage_index=stage).exists():
+            return project_id, image_id, chain_result_set_id, output_filepath
+        ChainModuleResult.objects.create(
+            project_id = project_id,
+            module_id = module_id,
+            result = result,
+            result_set = chain_result_set,
+            stage_index = stage,
+            artifact_path = output_filepath
+        )
+        done = set(chain_result_set.results.values_list('module_id', flat=True))
+        transaction.on_commit(lambda: progress_events.stage_done(
+            project_id, image_id, chain_result_set_id, stage, module_id))
+
+        ready = [child_id for child_id in modules
+                 if module_id in dependencies[str(child_id)]
+                 and all(parent_id in done for parent_id in dependencies[str(child_id)])]
+        if ready:
+            transaction.on_commit(lambda: group(
+                dag_node_signature(project_id, image_id, chain_result_set_id, child_id, graph, queue, fair_token, context)
+                for child_id in ready).delay())
+        elif all(other_id in done for other_id in modules):
+            transaction.on_commit(lambda: final_task.apply_async(
+                ((project_id, image_id, chain_result_set_id, output_filepath),),
+                {"image_info": context["image_info"], "run_id": run_id}, queue=queue))
+            if fair_token:
+                transaction.on_commit(lambda: fair_scheduler.release(fair_token))
+
+    return project_id, image_id, chain_result_set_id, output_filepath
+
+# processes a group of images of a project in one task instead of one chain per image:
+# the database lookups are done once for the whole group, the images go through the modules stage by stage
+# and a module is called with up to "max_batch_size" images per request (one image per request by default)
+# acknowledged when it starts: a batch runs longer than the broker's visibility timeout,
+# redelivered it would process its images twice (start_rest continues a lost batch instead)
+@shared_task(acks_late=False)
+def processing_batch(project_id, image_ids, ai_chain_modules_list, queue=None, fair_token=None, resume=False, run_id=None):
+    try:
+        return run_batch(project_id, image_ids, ai_chain_modules_list, resume, run_id)
+    except project_runs.RunCancelled:
+        return stop_cancelled(processing_batch, project_id, image_ids, run_id)
+    finally:
+        release_if_fair(fair_token)
+
+
+def run_batch(project_id, image_ids, ai_chain_modules_list, resume=False, run_id=None):
+    project_runs.check(project_id, run_id)
+    modules_by_id = AiChainModule.objects.prefetch_related('replicas').in_bulk(ai_chain_modules_list)
+    modules = [modules_by_id[module_id] for module_id in ai_chain_modules_list]
+    images = Image.objects.filter(id__in=image_ids, project_id=project_id)
+
+    # image id -> [image, chain result set, input file of the next stage]
+    runs = {}
+    # image id -> first stage to run (> 0 when resuming the last chain of the image)
+    first_stages = {}
+    for image in images:
+        checkpoint = find_checkpoint(image.id, modules) if resume else None
+        if checkpoint is not None:
+            chain_result_set, first_stages[image.id], input_filepath = checkpoint
+        else:
+            chain_result_set = ChainModuleResultSet.objects.create(project_id=project_id, image=image)
+            first_stages[image.id], input_filepath = 0, image.processing_path()
+        runs[image.id] = [image, chain_result_set, input_filepath]
+
+    # the results and finished images are written in bulk: after every stage, and after every call of the last stage
+    result_buffer = ResultBuffer()
+    results_data = {}
+    for stage, module in enumerate(modules):
+        # the results of the stages done so far are kept when the run is cancelled
+        project_runs.check(project_id, run_id)
+        pending_runs = [run for run in runs.values() if first_stages[run[0].id] <= stage]
+        batch_size = max(module.max_batch_size, 1)
+
+        for start in range(0, len(pending_runs), batch_size):
+            batch = pending_runs[start:start + batch_size]
+            try:
+                # the batch task has the results of other images to keep, it waits for the module instead of retrying
+                module_outputs = call_module(module, batch, wait_seconds=settings.CHAIN_MODULE_BUSY_WAIT)
+            except Exception as e:
+                # a failed call only stops the images of this call, the other images go on
+                for image, chain_result_set, input_filepath in batch:
+                    runs.pop(image.id)
+                    results_data[image.id] = chain_result_data(image, False, f"Stage {module.name} failed: {e}")
+                    progress_events.image_done(project_id, image.id, success=False)
+                continue
+
+            for run, (result_zip, result) in zip(batch, module_outputs):
+                image, chain_result_set, input_filepath = run
+
+                output_filepath = chain_artifact_path(project_id, chain_result_set.id, stage)
+                with open(output_filepath, 'wb') as f:
+                    f.write(result_zip)
+                run[2] = output_filepath
+
+                result_buffer.add_result(
+                    project_id=project_id,
+                    module=module,
+                    result=result,
+                    result_set=chain_result_set,
+                    stage_index=stage,
+                    artifact_path=output_filepath
+                )
+
+                # the image is done after its last stage, signal it right away and not at the end of the batch
+                if stage == len(modules) - 1:
+                    result_buffer.finish_image(image)
+                    results_data[image.id] = chain_result_data(image, True)
+
+            if stage == len(modules) - 1:
+                result_buffer.flush()
+
+        result_buffer.flush()
+
+    # images without any module (left) to run
+    for image, chain_result_set, input_filepath in runs.values():
+        if image.id not in results_data:
+            result_buffer.finish_image(image)
+            results_data[image.id] = chain_result_data(image, True)
+    result_buffer.flush()
+    result_set_ids = [chain_result_set.id for image, chain_result_set, input_filepath in runs.values()]
+    transaction.on_commit(lambda: build_element_indexes.delay(result_set_ids))
+
+    return list(results_data.values())
+
+
+# runs a module on a batch of [image, chain result set, input file] runs,
+# returns the .zip output and the .json result of the module for every run.
+# inputs the module already processed are taken from the result cache, only the others are posted to the module
+def call_module(module, batch, wait_seconds=0):
+    if not settings.CHAIN_RESULT_CACHE:
+        return [(result_zip, first_json_result(read_zip_jsons(io.BytesIO(result_zip))))
+                for result_zip in post_to_module_batch(module, batch, wait_seconds)]
+
+    input_hashes = [result_cache.file_sha256(input_filepath) for image, chain_result_set, input_filepath in batch]
+    outputs = [result_cache.lookup(module, input_hash) for input_hash in input_hashes]
+
+    misses = [i for i, output in enumerate(outputs) if output is None]
+    if misses:
+        result_zips = post_to_module_batch(module, [batch[i] for i in misses], wait_seconds)
+        for i, result_zip in zip(misses, result_zips):
+            result = first_json_result(read_zip_jsons(io.BytesIO(result_zip)))
+            result_cache.store(module, input_hashes[i], result_zip, result)
+            outputs[i] = (result_zip, result)
+
+    return outputs
+
+
+# posts the input files of a batch of [image, chain result set, input file] runs to a module,
+# returns the .zip result of the module for every run.
+# the call holds one of the module's concurrency slots, waiting up to wait_seconds for it (ModuleBusy otherwise)
+def post_to_module_batch(module, batch, wait_seconds=0):
+    if len(batch) == 1:
+        def make_files():
+            f = open(batch[0][2], 'rb')
+            return {'file': f}, [f]
+
+        with module_slot(module, wait_seconds):
+            response = replicas.post(module, make_files)
+        check_module_response(module, response)
+        return [response.content]
+
+    def make_files():
+        opened_files = [open(input_filepath, 'rb') for image, chain_result_set, input_filepath in batch]
+        files = [('file', (batch_upload_name(image, input_filepath), f))
+                 for (image, chain_result_set, input_filepath), f in zip(batch, opened_files)]
+        return files, opened_files
+
+    with module_slot(module, wait_seconds):
+        response = replicas.post(module, make_files)
+
+    check_module_response(module, response)
+
+    stems = [Path(batch_upload_name(image, input_filepath)).stem for image, chain_result_set, input_filepath in batch]
+    result_zips = split_batch_zip(response.content, stems)
+    return [result_zips[stem] for stem in stems]
+
+
+def check_module_response(module, response):
+    # the module is overloaded: not a failure of the stage, it is tried again later
+    if response.status_code in (429, 503):
+        raise ModuleBusy(f"module {module.name} answered with status code {response.status_code}")
+    if response.status_code != 200:
+        raise Exception(f"Stage failed with status code {response.status_code}")
+
+
+# requeues a module task whose module is saturated, with some jitter so the waiting tasks do not come back all at once
+# celery counts all the retries of a task in request.retries, the retries because the module was busy and the ones
+# after a network error have limits of their own: the task keeps its busy retries in its "busy_retries" kwarg
+def retry_when_busy(task, exc, busy_retries):
+    countdown = settings.CHAIN_MODULE_BUSY_RETRY_DELAY * (1 + random.random())
+    network_retries = task.request.retries - busy_retries
+    return task.retry(exc=exc, countdown=countdown, kwargs={**task.request.kwargs, 'busy_retries': busy_retries + 1},
+                      max_retries=network_retries + settings.CHAIN_MODULE_BUSY_MAX_RETRIES)
+
+
+def retry_on_network_error(task, exc, busy_retries):
+    network_retries = task.request.retries - busy_retries
+    countdown = get_exponential_backoff_interval(factor=1, retries=network_retries, maximum=600, full_jitter=True)
+    return task.retry(exc=exc, countdown=countdown, max_retries=busy_retries + settings.CHAIN_STAGE_MAX_RETRIES)
+
+
+def chain_result_data(image, success, error_msg=""):
+    return {
+        "image_id": image.id,
+        "image_info": {
+            "name": image.name,
+            "old_name": image.old_name,
+            "image_url": image.image_url()
+        },
+        "success": success,
+        "error_msg": error_msg
+    }
+
+# thumbnail, preview and working copy of newly uploaded images (see utility/derivatives.py)
+@shared_task
+def generate_image_derivatives(image_ids):
+    done_ids = []
+    for image in Image.objects.filter(id__in=image_ids):
+        try:
+            derivatives.generate(image)
+            done_ids.append(image.id)
+        except Exception as e:
+            # the original is used instead
+            print(f"derivatives of image {image.id} not generated: {e}")
+    Image.objects.filter(id__in=done_ids).update(derivatives_ready=True)
+    return done_ids
+
+# resumable uploads nobody finished (see utility/image_upload.py), run periodically (CELERY_BEAT_SCHEDULE)
+@shared_task
+def remove_abandoned_uploads():
+    return image_upload.remove_abandoned_uploads()
+
+# spatial index of the detected elements of the finished images (see utility/spatial_index.py)
 @shared_task
-def final_task(parameters):
+def build_element_indexes(result_set_ids):
+    spatial_index.build_for_result_sets(result_set_ids)
+
+@shared_task
+def release_fair_slot(fair_token, *args):
+    fair_scheduler.release(fair_token)
+
+def release_if_fair(fair_token):
+    if fair_token:
+        fair_scheduler.release(fair_token)
+
+@shared_task
+def final_task(parameters, image_info=None, run_id=None):
     project_id, image_id, chain_result_set_id, input_filepath = parameters
-    image = Image.objects.get(id=image_id)
-    project = Project.objects.get(id=project_id)
-    image_name = image.name  # the image_name here is with extensions
-    image_old_name = image.old_name
-    image_file_path = image.image_url()
+    if not project_runs.is_current(project_id, run_id):
+        return stop_cancelled(final_task, project_id, image_id, run_id)
+    if image_info is None:
+        image = Image.objects.get(id=image_id)
+        image_info = {
+            "name": image.name,  # the image_name here is with extensions
+            "old_name": image.old_name,
+            "image_url": image.image_url()
+        }
 
     if input_filepath is not None:
         success = True
@@ -128,16 +595,15 @@ def final_task(parameters):
 
     result_data = {
         "image_id": image_id,
-        "image_info": {
-            "name": image_name,
-            "old_name": image_old_name,
-            "image_url": image_file_path
-        },
+        "image_info": image_info,
         "success": success,
         "error_msg": ""
     }
-    chain_result_set = ChainModuleResultSet.objects.get(id=chain_result_set_id)
-    chain_result_set.update_image_status()
+    # same as chain_result_set.update_image_status(), in one query (update() skips auto_now)
+    Image.objects.filter(id=image_id).update(has_result=True, updated_at=timezone.now())
+    if success:
+        transaction.on_commit(lambda: build_element_indexes.delay([chain_result_set_id]))
+    progress_events.image_done(project_id, image_id, success)
     
     return result_data
 
@@ -148,15 +614,35 @@ def process_image(project_id, image_id, ai_model_id):
     # Retrieve the image instance
     image = Image.objects.get(id=image_id)
     project = Project.objects.get(id=project_id)
+
+    cfg_file_path = prepare_cfg(project_id, image.name, ai_model_id)
+    # the ai result will be a boolean, True
+    ai_processing_successful = run_ai_model(cfg_file_path)
+
+    return save_ai_results(project, image, ai_model_id, ai_processing_successful)
+
+
+# processes several images of a project in one task, the localization runs in batches across all of their tiles
+@shared_task
+def process_images(project_id, image_ids, ai_model_id):
+    project = Project.objects.get(id=project_id)
+    images = list(Image.objects.filter(id__in=image_ids, project_id=project_id))
+
+    cfg_file_paths = {image.id: prepare_cfg(project_id, image.name, ai_model_id) for image in images}
+    ai_results = run_ai_models(list(cfg_file_paths.values()))
+
+    return [save_ai_results(project, image, ai_model_id, ai_results[cfg_file_paths[image.id]]) for image in images]
+
+
+# saves the json results of a processed image into the ResultSet model
+def save_ai_results(project, image, ai_model_id, ai_processing_successful):
+    project_id = project.id
+    image_id = image.id
     image_name = image.name  # the image_name here is with extensions
     image_old_name = image.old_name
     image_file_path = image.image_url()
     image_base_name = os.path.splitext(image_name)[0]
 
-    cfg_file_path = prepare_cfg(project_id, image_name, ai_model_id)
-    # the ai result will be a boolean, True
-    ai_processing_successful = run_ai_model(cfg_file_path)
-
     # Ergebnis-Dictionary vorbereiten
     result_data = {
         "image_id": image_id,
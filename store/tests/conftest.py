@@ -1,10 +1,15 @@
 # conftest.py
+import contextlib
+from unittest import mock
+
 import pytest
 from rest_framework.test import APIClient
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from model_bakery import baker
 
 from store.models import AiModel, Project, ResultSet, Image
+from store.utility import redis_client
 from django.conf import settings
 
 @pytest.fixture
@@ -69,4 +74,26 @@ def user_and_tokens(api_client):
         "user": user_data,
         "access_token": response.data['access'],
         "refresh_token": response.data['refresh']
-    }
\ No newline at end of file
+    }
+
+# the processing bookkeeping (fair scheduler, counters, ...) on an in-memory redis
+@pytest.fixture
+def fake_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    r = fakeredis.FakeRedis()
+    # the redis locks run lua scripts, the tests run in a single process anyway
+    r.lock = lambda *args, **kwargs: contextlib.nullcontext()
+    with mock.patch.object(redis_client, "_redis", r):
+        yield r
+
+
+# the result payloads (see utility/result_payloads.py) are cached in memory and not shared between the tests
+@pytest.fixture(autouse=True)
+def results_cache(settings):
+    settings.CACHES = {**settings.CACHES,
+                       settings.RESULT_PAYLOAD_CACHE: {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                                       "LOCATION": "results"}}
+    cache = caches[settings.RESULT_PAYLOAD_CACHE]
+    cache.clear()
+    yield cache
+    cache.clear()
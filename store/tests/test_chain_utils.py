@@ -0,0 +1,26 @@
+import json
+
+import pytest
+from model_bakery import baker
+
+from store.models import AiChainModule, AiChainModuleReplica
+from store.utility.chain_utils import module_context, module_from_context
+
+
+@pytest.mark.django_db
+class TestModuleContext:
+
+    def test_round_trip(self):
+        module = baker.make(AiChainModule, module_url="http://a", name="localizer", version="2", max_batch_size=4, max_concurrency=2)
+        baker.make(AiChainModuleReplica, module=module, url="http://b")
+        baker.make(AiChainModuleReplica, module=module, url="http://c", is_active=False)
+
+        # the context travels in the task messages
+        context = json.loads(json.dumps(module_context(module)))
+        rebuilt = module_from_context(context)
+
+        for field in ["id", "module_url", "name", "version", "max_batch_size", "max_concurrency"]:
+            assert getattr(rebuilt, field) == getattr(module, field)
+        assert rebuilt.replica_urls == ["http://b"]
+        # the context itself is left as is, a retried task builds the module again
+        assert context["replica_urls"] == ["http://b"]
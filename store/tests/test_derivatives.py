@@ -0,0 +1,46 @@
+import os
+
+import pytest
+from model_bakery import baker
+from PIL import Image as PILImage
+
+from store.models import Image
+from store.tasks import generate_image_derivatives
+
+
+def make_image(project, tmp_path, orientation=None):
+    os.makedirs(tmp_path / f"project_{project.id}", exist_ok=True)
+    picture = PILImage.new("RGB", (300, 200), "red")
+    exif = picture.getexif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    picture.save(tmp_path / f"project_{project.id}" / "abc.jpg", exif=exif)
+    return baker.make(Image, project=project, name="abc.jpg", image_file=f"project_{project.id}/abc.jpg")
+
+
+@pytest.mark.django_db
+class TestDerivatives:
+
+    def test_working_copy_before_the_derivatives(self, project, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        image = make_image(project, tmp_path)
+
+        # a chain started right after the upload gets the working copy as well
+        path = image.processing_path()
+        assert path.endswith(f"project_{project.id}/working/abc.png")
+        assert PILImage.open(path).size == (300, 200)
+
+        assert generate_image_derivatives([image.id]) == [image.id]
+        image.refresh_from_db()
+        assert image.processing_path() == path
+        assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith(".tmp")]
+
+    def test_working_copy_keeps_the_stored_orientation(self, project, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        image = make_image(project, tmp_path, orientation=6)
+
+        generate_image_derivatives([image.id])
+        # the positions detected on the working copy are positions on the original, the preview is shown upright
+        assert PILImage.open(image.processing_path()).size == (300, 200)
+        assert PILImage.open(tmp_path / f"project_{project.id}/previews/abc.jpg").size == (200, 300)
+        assert PILImage.open(tmp_path / f"project_{project.id}/thumbnails/abc.jpg").size == (171, 256)
@@ -0,0 +1,120 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from django.conf import settings
+from model_bakery import baker
+from rest_framework_simplejwt.tokens import AccessToken
+
+from store import events
+from store.utility import progress_events, redis_client
+
+
+def scope_of(project_id, token):
+    return {"type": "http", "path": f"/store/projects/{project_id}/events/", "query_string": f"token={token}".encode()}
+
+
+def run_events(scope, messages_in, after_start=None, seconds=1.0):
+    sent = []
+
+    async def run():
+        received = asyncio.Queue()
+
+        async def receive():
+            return await received.get()
+
+        async def send(message):
+            sent.append(message)
+
+        task = asyncio.ensure_future(events.project_events(scope, receive, send, events.match(scope)))
+        await asyncio.sleep(0.3)
+        if after_start is not None:
+            after_start()
+        await asyncio.sleep(seconds)
+        for message in messages_in:
+            await received.put(message)
+        await asyncio.wait_for(task, 3)
+
+    asyncio.run(run())
+    return sent
+
+
+class TestMatch:
+
+    def test_events_path(self):
+        assert events.match({"type": "http", "path": "/store/projects/12/events/"}) == 12
+        assert events.match({"type": "http", "path": "/store/projects/12/events"}) == 12
+
+    def test_other_paths(self):
+        assert events.match({"type": "http", "path": "/store/projects/12/"}) is None
+        assert events.match({"type": "http", "path": "/store/projects/abc/events/"}) is None
+        assert events.match({"type": "websocket", "path": "/store/projects/12/events/"}) is None
+
+
+# can_access runs in a thread of its own, the test data has to be committed
+@pytest.mark.django_db(transaction=True)
+class TestCanAccess:
+
+    def can_access(self, token, project_id):
+        return asyncio.run(events.can_access(token, project_id))
+
+    def test_owner(self, project, regular_user):
+        assert self.can_access(str(AccessToken.for_user(regular_user)), project.id)
+
+    def test_staff(self, project, admin_user):
+        assert self.can_access(str(AccessToken.for_user(admin_user)), project.id)
+
+    def test_other_user(self, project):
+        other_user = baker.make(settings.AUTH_USER_MODEL, is_staff=False)
+        assert not self.can_access(str(AccessToken.for_user(other_user)), project.id)
+
+    def test_inactive_user(self, project, regular_user):
+        token = str(AccessToken.for_user(regular_user))
+        regular_user.is_active = False
+        regular_user.save()
+        assert not self.can_access(token, project.id)
+
+    def test_invalid_token(self, project):
+        assert not self.can_access("not-a-token", project.id)
+
+    def test_old_connections_closed(self, project, regular_user):
+        with mock.patch("store.events.close_old_connections") as close_old_connections:
+            self.can_access(str(AccessToken.for_user(regular_user)), project.id)
+        assert close_old_connections.call_count == 2
+
+
+@pytest.mark.django_db(transaction=True)
+class TestProjectEvents:
+
+    def test_forbidden_without_access(self, project):
+        sent = run_events(scope_of(project.id, "bad"), [], seconds=0)
+        assert sent[0]["status"] == 403
+
+    def test_progress_events_streamed(self, project, regular_user, settings):
+        fakeredis = pytest.importorskip("fakeredis")
+        import fakeredis.aioredis
+        settings.PROGRESS_EVENTS_KEEPALIVE = 0.5
+        server = fakeredis.FakeServer()
+
+        def publish():
+            with mock.patch.object(redis_client, "_redis", fakeredis.FakeRedis(server=server)):
+                progress_events.image_done(project.id, 5)
+
+        with mock.patch("redis.asyncio.Redis.from_url", return_value=fakeredis.aioredis.FakeRedis(server=server)):
+            sent = run_events(scope_of(project.id, AccessToken.for_user(regular_user)), [{"type": "http.disconnect"}],
+                              after_start=publish, seconds=1.5)
+
+        assert sent[0]["status"] == 200
+        bodies = [message.get("body") for message in sent[1:]]
+        assert bodies[0] == b": connected\n\n"
+        assert any(body.startswith(b"data: ") and b'"image_id": 5' in body for body in bodies)
+        assert b": keep-alive\n\n" in bodies
+
+    def test_unavailable_without_redis(self, project, regular_user):
+        client = mock.MagicMock()
+        client.aclose = mock.AsyncMock()
+        client.pubsub.return_value.subscribe = mock.AsyncMock(side_effect=ConnectionError("redis is down"))
+        client.pubsub.return_value.aclose = mock.AsyncMock()
+        with mock.patch("redis.asyncio.Redis.from_url", return_value=client):
+            sent = run_events(scope_of(project.id, AccessToken.for_user(regular_user)), [], seconds=0)
+        assert sent[0]["status"] == 503
@@ -0,0 +1,82 @@
+import time
+from unittest import mock
+
+import pytest
+
+from store.tasks import processing_chain
+from store.utility import fair_scheduler
+
+
+@pytest.fixture
+def sent(fake_redis, settings):
+    settings.CHAIN_BULK_MAX_IN_FLIGHT = 2
+    sent = []
+
+    def send_task(name, args, kwargs, queue):
+        sent.append((args[0], kwargs["fair_token"]))
+        return mock.Mock(id=f"task-{args[0]}")
+
+    with mock.patch("store.utility.fair_scheduler.current_app") as app:
+        app.send_task.side_effect = send_task
+        yield sent
+
+
+def release_first(sent):
+    run, fair_token = sent.pop(0)
+    fair_scheduler.release(fair_token)
+    return run
+
+
+class TestFairScheduler:
+
+    def test_submit_dispatches_up_to_the_slots(self, sent):
+        for i in range(3):
+            fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", [f"a{i}"])
+        assert [run for run, fair_token in sent] == ["a0", "a1"]
+        assert fair_scheduler.in_flight_count() == 2
+        assert fair_scheduler.pending_counts() == {"1": 1}
+
+    def test_release_dispatches_the_next_run(self, sent):
+        for i in range(3):
+            fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", [f"a{i}"])
+        release_first(sent)
+        assert [run for run, fair_token in sent] == ["a1", "a2"]
+        assert fair_scheduler.pending_counts() == {}
+
+    def test_customers_take_turns_by_plan_weight(self, sent, settings):
+        settings.CHAIN_BULK_MAX_IN_FLIGHT = 1
+        for i in range(4):
+            fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", [f"a{i}"])
+        for i in range(4):
+            fair_scheduler.submit(2, "PRO", "store.tasks.processing_chain", [f"b{i}"])
+
+        order = [release_first(sent) for i in range(7)]
+        # a0 went out while customer 1 was alone. from then on a big project of one customer does not hold
+        # the other one back, PRO runs twice per turn
+        assert order == ["a0", "a1", "b0", "b1", "a2", "b2", "b3"]
+
+    def test_slots_of_lost_runs_expire(self, sent, fake_redis, settings):
+        fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", ["a0"])
+        fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", ["a1"])
+        fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", ["a2"])
+        fake_redis.zadd(fair_scheduler.KEY_IN_FLIGHT, {sent[0][1]: time.time() - settings.CHAIN_FAIR_SLOT_TIMEOUT - 1})
+
+        fair_scheduler.dispatch()
+        assert [run for run, fair_token in sent] == ["a0", "a1", "a2"]
+
+    def test_cancel_takes_the_runs_of_a_project_run_out(self, sent):
+        fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", ["a0"], {"run_id": "old"})
+        fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", ["a1"], {"run_id": "old"})
+        fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", ["a2"], {"run_id": "old"})
+        fair_scheduler.submit(1, "BASIC", "store.tasks.processing_chain", ["b0"], {"run_id": "new"})
+
+        assert sorted(fair_scheduler.cancel(1, "old")) == ["task-a0", "task-a1"]
+        # the freed slots go to the run left
+        assert [run for run, fair_token in sent] == ["a0", "a1", "b0"]
+        assert fair_scheduler.pending_counts() == {}
+
+    @pytest.mark.django_db
+    def test_chain_failing_before_it_exists_releases_its_slot(self, image):
+        with mock.patch("store.tasks.fair_scheduler.release") as release, pytest.raises(KeyError):
+            processing_chain(image.project_id, image.id, [12345], fair_token="token")
+        release.assert_called_once_with("token")
@@ -0,0 +1,37 @@
+import pytest
+from unittest import mock
+
+from store.utility import http_client
+
+
+@pytest.fixture(autouse=True)
+def clear_sessions():
+    http_client.clear()
+    yield
+    http_client.clear()
+
+
+class TestHttpClient:
+
+    def test_one_session_per_module_url(self):
+        session = http_client.get_session("http://module-a/run")
+        assert http_client.get_session("http://module-a/run") is session
+        assert http_client.get_session("http://module-b/run") is not session
+
+    def test_clear_drops_the_sessions(self):
+        session = http_client.get_session("http://module-a/run")
+        http_client.clear()
+        assert http_client.get_session("http://module-a/run") is not session
+
+    def test_read_timeouts_are_not_retried(self, settings):
+        settings.CHAIN_MODULE_MAX_RETRIES = 3
+        retry = http_client.get_session("http://module-a/run").get_adapter("http://module-a/run").max_retries
+        assert retry.read == 0
+        assert retry.connect == 3
+
+    def test_post_uses_the_timeouts(self, settings):
+        settings.CHAIN_MODULE_CONNECT_TIMEOUT = 2
+        settings.CHAIN_MODULE_READ_TIMEOUT = 30
+        with mock.patch("requests.Session.post") as post:
+            http_client.post_to_module("http://module-a/run", {"file": b""})
+        post.assert_called_once_with("http://module-a/run", files={"file": b""}, timeout=(2, 30))
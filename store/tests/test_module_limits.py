@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from celery.exceptions import Retry
+
+from store.tasks import process_file_in_module, retry_when_busy, retry_on_network_error
+from store.utility import module_limits
+from store.utility.module_limits import ModuleBusy
+
+
+def make_module(max_concurrency):
+    return SimpleNamespace(id=1, name="localizer", max_concurrency=max_concurrency)
+
+
+class TestModuleLimits:
+
+    def test_slots_up_to_max_concurrency(self, fake_redis):
+        module = make_module(2)
+        first = module_limits.try_acquire(module)
+        second = module_limits.try_acquire(module)
+        assert first and second
+        assert module_limits.try_acquire(module) is None
+        assert module_limits.in_use(module) == 2
+
+        module_limits.release(module, first)
+        assert module_limits.try_acquire(module) is not None
+
+    def test_late_call_with_an_earlier_start_does_not_take_a_slot(self, fake_redis):
+        module = make_module(1)
+        seconds, microseconds = fake_redis.time()
+        assert module_limits.try_acquire(module) is not None
+        # read the clock before the call above took the last slot, added after it
+        with mock.patch.object(fake_redis, "time", return_value=(seconds - 5, microseconds)):
+            assert module_limits.try_acquire(module) is None
+        assert module_limits.in_use(module) == 1
+
+    def test_slots_of_lost_calls_expire(self, fake_redis, settings):
+        module = make_module(1)
+        seconds, microseconds = fake_redis.time()
+        fake_redis.zadd(module_limits.KEY_SLOTS.format(module.id), {"lost": seconds - settings.CHAIN_MODULE_SLOT_TIMEOUT - 1})
+        assert module_limits.try_acquire(module) is not None
+
+    def test_slot_held_during_the_call(self, fake_redis):
+        module = make_module(1)
+        with module_limits.module_slot(module):
+            assert module_limits.in_use(module) == 1
+            with pytest.raises(ModuleBusy):
+                with module_limits.module_slot(module, wait_seconds=0):
+                    pass
+        assert module_limits.in_use(module) == 0
+
+    def test_no_limit_without_max_concurrency(self):
+        # redis is not even asked
+        with mock.patch("store.utility.module_limits.get_redis") as get_redis:
+            with module_limits.module_slot(make_module(0)):
+                pass
+        get_redis.assert_not_called()
+
+
+class TestStageRetries:
+
+    def make_task(self, retries, kwargs):
+        task = process_file_in_module
+        task.push_request(retries=retries, kwargs=kwargs, called_directly=False, is_eager=False)
+        return task
+
+    def test_busy_retries_keep_the_network_retries(self, settings):
+        settings.CHAIN_MODULE_BUSY_MAX_RETRIES = 60
+        settings.CHAIN_STAGE_MAX_RETRIES = 3
+        # 10 busy retries so far, no network error yet
+        task = self.make_task(retries=10, kwargs={"busy_retries": 10})
+        try:
+            with mock.patch.object(task, "signature_from_request") as signature:
+                with pytest.raises(Retry):
+                    retry_on_network_error(task, ConnectionError("down"), 10)
+                with pytest.raises(Retry):
+                    retry_when_busy(task, ModuleBusy("busy"), 10)
+            assert signature.call_args.args[2] == {"busy_retries": 11}
+        finally:
+            task.pop_request()
+
+    def test_limits_of_their_own(self, settings):
+        settings.CHAIN_MODULE_BUSY_MAX_RETRIES = 5
+        settings.CHAIN_STAGE_MAX_RETRIES = 3
+        # 5 busy retries and 3 network retries
+        task = self.make_task(retries=8, kwargs={"busy_retries": 5})
+        try:
+            with mock.patch.object(task, "signature_from_request"):
+                with pytest.raises(ModuleBusy):
+                    retry_when_busy(task, ModuleBusy("busy"), 5)
+                with pytest.raises(ConnectionError):
+                    retry_on_network_error(task, ConnectionError("down"), 5)
+        finally:
+            task.pop_request()
@@ -0,0 +1,113 @@
+from unittest import mock
+
+import pytest
+import requests
+from model_bakery import baker
+
+from store.models import AiChainModule, ChainModuleResult, ChainModuleResultSet
+from store.tasks import find_dag_checkpoint, process_dag_node, processing_dag
+from store.utility.chain_utils import module_context
+
+
+@pytest.mark.django_db
+class TestDagResume:
+
+    @pytest.fixture
+    def graph(self):
+        modules = baker.make(AiChainModule, _quantity=3)
+        first, second, third = [module.id for module in modules]
+        # third needs first and second
+        return {"modules": [first, second, third],
+                "dependencies": {str(first): [], str(second): [], str(third): [first, second]}}
+
+    def make_result(self, result_set, graph, module_id, tmp_path, output=True):
+        artifact_path = tmp_path / f"{module_id}.zip"
+        if output:
+            artifact_path.write_bytes(b"zip")
+        return baker.make(ChainModuleResult, project=result_set.project, result_set=result_set, module_id=module_id,
+                          stage_index=graph["modules"].index(module_id), artifact_path=str(artifact_path), result={})
+
+    def test_nothing_to_continue(self, image, graph):
+        assert find_dag_checkpoint(image.id, graph) is None
+
+    def test_modules_done_with_their_outputs(self, image, graph, tmp_path):
+        first, second, third = graph["modules"]
+        result_set = baker.make(ChainModuleResultSet, project=image.project, image=image)
+        self.make_result(result_set, graph, first, tmp_path)
+        self.make_result(result_set, graph, second, tmp_path, output=False)
+        assert find_dag_checkpoint(image.id, graph) == (result_set, {first})
+
+    def test_resume_starts_the_missing_modules(self, image, graph, tmp_path):
+        first, second, third = graph["modules"]
+        result_set = baker.make(ChainModuleResultSet, project=image.project, image=image)
+        self.make_result(result_set, graph, first, tmp_path)
+        self.make_result(result_set, graph, second, tmp_path, output=False)
+
+        with mock.patch("store.tasks.group") as group:
+            processing_dag(image.project_id, image.id, graph, resume=True)
+        started = [signature.args[3] for signature in group.call_args.args[0]]
+        assert started == [second]
+        # no new result set, the result without its output is done again
+        assert ChainModuleResultSet.objects.count() == 1
+        assert list(result_set.results.values_list("module_id", flat=True)) == [first]
+
+    def test_resume_of_a_finished_run(self, image, graph, tmp_path):
+        result_set = baker.make(ChainModuleResultSet, project=image.project, image=image)
+        for module_id in graph["modules"]:
+            self.make_result(result_set, graph, module_id, tmp_path)
+
+        with mock.patch("store.tasks.group") as group, mock.patch("store.tasks.final_task.apply_async") as final:
+            processing_dag(image.project_id, image.id, graph, resume=True)
+        assert group.call_count == 0
+        assert final.call_args.args[0][0][2] == result_set.id
+
+    def test_resume_outdates_the_cached_payloads(self, image, graph, tmp_path):
+        first, second, third = graph["modules"]
+        result_set = baker.make(ChainModuleResultSet, project=image.project, image=image)
+        self.make_result(result_set, graph, first, tmp_path)
+        self.make_result(result_set, graph, second, tmp_path, output=False)
+
+        with mock.patch("store.tasks.group"), mock.patch("store.tasks.result_payloads.invalidate") as invalidate:
+            processing_dag(image.project_id, image.id, graph, resume=True)
+        invalidate.assert_called_with(image.project_id)
+
+
+@pytest.mark.django_db
+class TestDagNode:
+
+    @pytest.fixture
+    def graph(self):
+        first, second = [module.id for module in baker.make(AiChainModule, _quantity=2)]
+        return {"modules": [first, second], "dependencies": {str(first): [], str(second): [first]}}
+
+    def context(self, graph, tmp_path):
+        modules = AiChainModule.objects.in_bulk(graph["modules"])
+        return {"image_path": str(tmp_path / "plan.png"), "image_info": {}, "run_id": None,
+                "modules": {str(module_id): module_context(module) for module_id, module in modules.items()}}
+
+    def test_node_delivered_again_is_not_run_again(self, image, graph, tmp_path, settings):
+        settings.MEDIA_ROOT = str(tmp_path)
+        first, second = graph["modules"]
+        result_set = baker.make(ChainModuleResultSet, project=image.project, image=image)
+        artifact_path = tmp_path / "0.zip"
+        artifact_path.write_bytes(b"zip")
+        baker.make(ChainModuleResult, project=image.project, result_set=result_set, module_id=first, stage_index=0,
+                   artifact_path=str(artifact_path), result={})
+
+        with mock.patch("store.tasks.call_module") as call_module, mock.patch("store.tasks.group") as group:
+            assert process_dag_node(image.project_id, image.id, result_set.id, first, graph,
+                                    context=self.context(graph, tmp_path)) == (image.project_id, image.id, result_set.id, str(artifact_path))
+        call_module.assert_not_called()
+        group.assert_not_called()
+        assert result_set.results.count() == 1
+
+    def test_node_retried_on_network_errors(self, image, graph, tmp_path):
+        first, second = graph["modules"]
+        result_set = baker.make(ChainModuleResultSet, project=image.project, image=image)
+
+        with mock.patch("store.tasks.call_module", side_effect=requests.exceptions.ConnectionError("refused")), \
+             mock.patch("store.tasks.retry_on_network_error", return_value=RuntimeError("retry")) as retry:
+            with pytest.raises(RuntimeError):
+                process_dag_node(image.project_id, image.id, result_set.id, first, graph, context=self.context(graph, tmp_path))
+        assert isinstance(retry.call_args.args[1], requests.exceptions.ConnectionError)
+        assert not result_set.results.exists()
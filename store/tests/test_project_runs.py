@@ -0,0 +1,47 @@
+from unittest import mock
+
+import pytest
+from model_bakery import baker
+
+from store.models import ChainModuleResult, ChainModuleResultSet, Project
+from store.tasks import final_task, process_file_in_module
+from store.utility import project_runs
+
+
+@pytest.mark.django_db
+class TestProjectRuns:
+
+    def test_current_run_from_the_cache(self, project, fake_redis, django_assert_num_queries):
+        project_runs.set_current(project.id, "run1")
+        with django_assert_num_queries(0):
+            assert project_runs.is_current(project.id, "run1")
+            assert not project_runs.is_current(project.id, "run0")
+            assert project_runs.is_current(project.id, None)
+
+        project_runs.set_current(project.id, None)
+        assert not project_runs.is_current(project.id, "run1")
+
+    def test_current_run_from_the_database_once(self, project, fake_redis, django_assert_num_queries):
+        Project.objects.filter(id=project.id).update(run_id="run1")
+        with django_assert_num_queries(1):
+            assert project_runs.is_current(project.id, "run1")
+            assert project_runs.is_current(project.id, "run1")
+
+    def test_current_run_without_redis(self, project):
+        Project.objects.filter(id=project.id).update(run_id="run1")
+        with mock.patch("store.utility.project_runs.get_redis", side_effect=ConnectionError("down")):
+            assert project_runs.is_current(project.id, "run1")
+            assert not project_runs.is_current(project.id, "run0")
+
+    def test_cancelled_tasks_return_without_failing(self, project, image, fake_redis):
+        project_runs.set_current(project.id, "run1")
+        result_set = baker.make(ChainModuleResultSet, project=project, image=image)
+        parameters = project.id, image.id, result_set.id, "input.zip"
+
+        with mock.patch("store.tasks.call_module") as call_module, \
+             mock.patch("store.tasks.progress_events") as progress_events:
+            assert process_file_in_module(parameters, "http://module", stage=0, run_id="run0") is None
+            assert final_task(parameters, image_info={}, run_id="run0") is None
+        call_module.assert_not_called()
+        progress_events.image_done.assert_not_called()
+        assert not ChainModuleResult.objects.filter(result_set=result_set).exists()
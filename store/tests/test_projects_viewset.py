@@ -2,10 +2,17 @@
 import pytest
 from rest_framework import status
 from django.conf import settings
-from store.models import Project, Image, AiModel
+from store.models import Project, Image, ImageUpload, AiModel
+from store.utility import progress_counters
+from store.utility.image_upload import remove_abandoned_uploads
+from django.utils import timezone
+from datetime import timedelta
 from model_bakery import baker
 
+import os
 import tempfile
+import time
+from unittest import mock
 from PIL import Image as PILImage
 
 @pytest.mark.django_db
@@ -20,6 +27,42 @@ class TestProjectsViewSet:
         assert response.status_code == status.HTTP_200_OK
         assert len(response.data) >= 3
 
+    def test_list_projects_paged(self, api_client, regular_user):
+        api_client.force_authenticate(user=regular_user)
+        projects = baker.make(Project, _quantity=3, customer=regular_user.customer)
+        baker.make(Image, _quantity=2, project=projects[2])
+
+        response = api_client.get("/store/projects/?page_size=2")
+        assert response.status_code == status.HTTP_200_OK
+        assert [project["id"] for project in response.data["results"]] == [projects[2].id, projects[1].id]
+        assert response.data["results"][0]["images_nr"] == 2
+        assert "images" not in response.data["results"][0]
+
+        response = api_client.get(response.data["next"])
+        assert [project["id"] for project in response.data["results"]] == [projects[0].id]
+        assert response.data["next"] is None
+
+    def test_list_projects_sparse_fields(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        response = api_client.get("/store/projects/?page_size=10&fields=id,status")
+        assert response.data["results"] == [{"id": project.id, "status": project.status}]
+
+    def test_list_projects_paged_query_count(self, api_client, regular_user, django_assert_num_queries):
+        api_client.force_authenticate(user=regular_user)
+        for _ in range(2):
+            project = baker.make(Project, customer=regular_user.customer)
+            baker.make(Image, _quantity=3, project=project)
+        # customer of the serializer context, the page
+        with django_assert_num_queries(2):
+            api_client.get("/store/projects/?page_size=10")
+
+        for _ in range(5):
+            project = baker.make(Project, customer=regular_user.customer)
+            baker.make(Image, _quantity=3, project=project)
+        with django_assert_num_queries(2):
+            response = api_client.get("/store/projects/?page_size=10")
+        assert len(response.data["results"]) == 7
+
     def test_retrieve_project_authenticated(self, api_client, regular_user, project):
         api_client.force_authenticate(user=regular_user)
         response = api_client.get(f"/store/projects/{project.id}/")
@@ -87,15 +130,279 @@ class TestProjectsViewSet:
 
         assert response.status_code == status.HTTP_201_CREATED
 
+    def test_upload_images_bulk(self, api_client, regular_user, project, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        api_client.force_authenticate(user=regular_user)
+
+        files = []
+        for i in range(2):
+            img = tempfile.NamedTemporaryFile(suffix=".jpg")
+            PILImage.new("RGB", (100, 100)).save(img, format='JPEG')
+            img.seek(0)
+            files.append(img)
+        text = tempfile.NamedTemporaryFile(suffix=".txt")
+        text.write(b"not an image")
+        text.seek(0)
+        files.append(text)
+
+        response = api_client.post(f"/store/projects/{project.id}/images/bulk/", {'images': files}, format='multipart')
+
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert response.data["bad_images"] == [text.name.split("/")[-1]]
+        images = Image.objects.filter(project=project)
+        assert len(images) == 2
+        for image, uploaded in zip(images.order_by('id'), files):
+            uploaded.seek(0)
+            with open(image.image_local_path(), 'rb') as stored:
+                assert stored.read() == uploaded.read()
+
 
     def test_view_image_authenticated(self, api_client, regular_user, project, image):
         api_client.force_authenticate(user=regular_user)
         response = api_client.get(f"/store/projects/{project.id}/images/{image.id}/")
         assert response.status_code == status.HTTP_200_OK
 
+    def test_view_image_derivative_urls(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        image = baker.make(Image, project=project, name="abc.jpg", image_file=f"project_{project.id}/abc.jpg")
+        response = api_client.get(f"/store/projects/{project.id}/images/{image.id}/")
+        # the original until the derivatives are made
+        assert response.data["thumbnail_url"] == response.data["image_url"]
+
+        image.derivatives_ready = True
+        image.save()
+        response = api_client.get(f"/store/projects/{project.id}/images/{image.id}/")
+        assert response.data["thumbnail_url"].endswith(f"project_{project.id}/thumbnails/abc.jpg")
+        assert response.data["preview_url"].endswith(f"project_{project.id}/previews/abc.jpg")
+
     def test_delete_image_authenticated(self, api_client, regular_user, project, image):
         api_client.force_authenticate(user=regular_user)
         response = api_client.delete(f"/store/projects/{project.id}/images/{image.id}/")
         assert response.status_code == status.HTTP_204_NO_CONTENT
         # Verify the image has been deleted
-        assert not Image.objects.filter(id=image.id).exists()
\ No newline at end of file
+        assert not Image.objects.filter(id=image.id).exists()
+
+
+    # start
+
+    def test_start_batched(self, api_client, regular_user, project, settings):
+        settings.CHAIN_INTERACTIVE_MAX_IMAGES = 0
+        api_client.force_authenticate(user=regular_user)
+        images = sorted(baker.make(Image, _quantity=5, project=project), key=lambda image: image.id)
+        with mock.patch("store.views.fair_scheduler.submit") as submit:
+            response = api_client.post(f"/store/projects/{project.id}/start/?batch_size=2", [1, 2], format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert {call.args[2] for call in submit.call_args_list} == {"store.tasks.processing_batch"}
+        dispatched = [call.args[3][1] for call in submit.call_args_list]
+        assert dispatched == [[images[0].id, images[1].id], [images[2].id, images[3].id], [images[4].id]]
+
+    def test_start_one_chain_per_image_by_default(self, api_client, regular_user, project, settings):
+        settings.CHAIN_INTERACTIVE_MAX_IMAGES = 0
+        api_client.force_authenticate(user=regular_user)
+        baker.make(Image, _quantity=3, project=project)
+        with mock.patch("store.views.fair_scheduler.submit") as submit:
+            response = api_client.post(f"/store/projects/{project.id}/start/", [1, 2], format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert [call.args[2] for call in submit.call_args_list] == ["store.tasks.processing_chain"] * 3
+        assert submit.call_args_list[0].args[:2] == (regular_user.customer.id, "BASIC")
+
+    def test_start_small_project_interactive_lane(self, api_client, regular_user, project, settings):
+        settings.CHAIN_INTERACTIVE_MAX_IMAGES = 3
+        api_client.force_authenticate(user=regular_user)
+        image = baker.make(Image, project=project)
+        with mock.patch("store.views.processing_chain.apply_async") as chain_apply, \
+             mock.patch("store.views.fair_scheduler.submit") as submit:
+            response = api_client.post(f"/store/projects/{project.id}/start/", [1, 2], format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert submit.call_count == 0
+        project.refresh_from_db()
+        assert response.data["run_id"] == project.run_id
+        chain_apply.assert_called_once_with([project.id, image.id, [1, 2]], {'run_id': project.run_id, 'queue': 'interactive'}, queue='interactive')
+
+    def test_start_dependency_graph(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        image = baker.make(Image, project=project)
+        graph = {"modules": [1, 2, 3], "dependencies": {"3": [1, 2]}}
+        with mock.patch("store.views.processing_dag.apply_async") as dag_apply:
+            response = api_client.post(f"/store/projects/{project.id}/start/", graph, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        expected_graph = {"modules": [1, 2, 3], "dependencies": {"1": [], "2": [], "3": [1, 2]}}
+        assert dag_apply.call_args.args[0] == [project.id, image.id, expected_graph]
+
+    def test_start_rest_resumes_dependency_graph(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        image = baker.make(Image, project=project)
+        graph = {"modules": [1, 2, 3], "dependencies": {"3": [1, 2]}}
+        with mock.patch("store.views.processing_dag.apply_async") as dag_apply:
+            response = api_client.post(f"/store/projects/{project.id}/start_rest/", graph, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert dag_apply.call_args.args[1]["resume"] is True
+
+    def test_start_dependency_graph_with_cycle(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        baker.make(Image, project=project)
+        graph = {"modules": [1, 2], "dependencies": {"1": [2], "2": [1]}}
+        with mock.patch("store.views.processing_dag.apply_async") as dag_apply:
+            response = api_client.post(f"/store/projects/{project.id}/start/", graph, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert dag_apply.call_count == 0
+
+    def test_start_rest_resumes_unprocessed_images(self, api_client, regular_user, project, settings):
+        settings.CHAIN_INTERACTIVE_MAX_IMAGES = 3
+        api_client.force_authenticate(user=regular_user)
+        baker.make(Image, project=project, has_result=True)
+        image = baker.make(Image, project=project, has_result=False)
+        with mock.patch("store.views.processing_chain.apply_async") as chain_apply:
+            response = api_client.post(f"/store/projects/{project.id}/start_rest/", [1, 2], format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        project.refresh_from_db()
+        chain_apply.assert_called_once_with([project.id, image.id, [1, 2]], {'resume': True, 'run_id': project.run_id, 'queue': 'interactive'}, queue='interactive')
+
+    def test_start_twice_joins_the_run_in_progress(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        baker.make(Image, project=project)
+        with mock.patch("store.views.processing_chain.apply_async") as chain_apply:
+            first = api_client.post(f"/store/projects/{project.id}/start/", [1, 2], format='json')
+            second = api_client.post(f"/store/projects/{project.id}/start/", [1, 2], format='json')
+        assert second.status_code == status.HTTP_202_ACCEPTED
+        assert second.data == {"message": "ALREADY PROCESSING", "run_id": first.data["run_id"]}
+        assert chain_apply.call_count == 1
+
+    def test_start_with_other_modules_preempts_the_run(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        baker.make(Image, project=project)
+        with mock.patch("store.views.processing_chain.apply_async") as chain_apply, \
+             mock.patch("store.views.project_runs.cancel") as cancel:
+            first = api_client.post(f"/store/projects/{project.id}/start/", [1, 2], format='json')
+            second = api_client.post(f"/store/projects/{project.id}/start/", [2], format='json')
+        assert chain_apply.call_count == 2
+        cancel.assert_called_once_with(project.customer_id, first.data["run_id"])
+        project.refresh_from_db()
+        assert project.run_id == second.data["run_id"] != first.data["run_id"]
+
+    def test_cancel(self, api_client, regular_user, project):
+        api_client.force_authenticate(user=regular_user)
+        baker.make(Image, project=project)
+        with mock.patch("store.views.processing_chain.apply_async"):
+            started = api_client.post(f"/store/projects/{project.id}/start/", [1, 2], format='json')
+        with mock.patch("store.views.project_runs.cancel") as cancel:
+            response = api_client.post(f"/store/projects/{project.id}/cancel/")
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        cancel.assert_called_once_with(project.customer_id, started.data["run_id"])
+        project.refresh_from_db()
+        assert project.run_id is None
+        assert project.status == 'PENDING'
+
+        response = api_client.post(f"/store/projects/{project.id}/cancel/")
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_progress_from_counters(self, api_client, regular_user, project, fake_redis):
+        api_client.force_authenticate(user=regular_user)
+        project.status = 'PROCESSING'
+        project.save()
+        progress_counters.reset(project.id, total=4, done=1)
+        progress_counters.image_done(project.id, 10)
+        progress_counters.stage_done(project.id, 0)
+        response = api_client.get(f"/store/projects/{project.id}/progress/")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == {"status": "PROCESSING", "total": 4, "done": 2, "failed": 0, "stages": {0: 1}}
+
+    def test_progress_failed_images_leave_project_pending(self, api_client, regular_user, project, fake_redis):
+        api_client.force_authenticate(user=regular_user)
+        project.status = 'PROCESSING'
+        project.save()
+        progress_counters.reset(project.id, total=4)
+        for image_id in [10, 11, 12]:
+            progress_counters.image_done(project.id, image_id)
+        progress_counters.image_done(project.id, 13, success=False)
+        response = api_client.get(f"/store/projects/{project.id}/progress/")
+        # the failed image is left to start_rest
+        assert response.data["status"] == "PENDING"
+        project.refresh_from_db()
+        assert project.status == "PENDING"
+
+    def test_progress_completes_project(self, api_client, regular_user, project, fake_redis):
+        api_client.force_authenticate(user=regular_user)
+        project.status = 'PROCESSING'
+        project.save()
+        progress_counters.reset(project.id, total=3)
+        progress_counters.image_done(project.id, 10)
+        progress_counters.image_done(project.id, 11, success=False)
+        # a task delivered again counts its image once, a failed image done later is not failed anymore
+        progress_counters.image_done(project.id, 10)
+        progress_counters.image_done(project.id, 11)
+        response = api_client.get(f"/store/projects/{project.id}/progress/")
+        assert response.data["done"] == 2
+        assert response.data["failed"] == 0
+        assert response.data["status"] == "PROCESSING"
+
+        progress_counters.image_done(project.id, 12)
+        response = api_client.get(f"/store/projects/{project.id}/progress/")
+        assert response.data == {"status": "COMPLETED", "total": 3, "done": 3, "failed": 0, "stages": {}}
+        project.refresh_from_db()
+        assert project.status == "COMPLETED"
+
+    def test_resumable_upload(self, api_client, regular_user, project, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        api_client.force_authenticate(user=regular_user)
+        content = b"0123456789" * 10
+
+        response = api_client.post(f"/store/projects/{project.id}/uploads/", {"name": "plan.png", "length": len(content)}, format='json')
+        assert response.status_code == status.HTTP_201_CREATED
+        url = f"/store/projects/{project.id}/uploads/{response.data['upload_id']}/"
+
+        response = api_client.patch(url, content[:40], content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0')
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert response['Upload-Offset'] == '40'
+
+        # the chunk is sent again, as after a dropped connection
+        response = api_client.patch(url, content[:40], content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0')
+        assert response.status_code == status.HTTP_409_CONFLICT
+        assert api_client.head(url)['Upload-Offset'] == '40'
+
+        response = api_client.post(f"{url}finalize/")
+        assert response.status_code == status.HTTP_409_CONFLICT
+        assert not Image.objects.filter(project=project).exists()
+
+        response = api_client.patch(url, content[40:], content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='40')
+        assert response['Upload-Offset'] == str(len(content))
+
+        response = api_client.post(f"{url}finalize/")
+        assert response.status_code == status.HTTP_201_CREATED
+        image = Image.objects.get(project=project)
+        assert image.old_name == "plan"
+        with open(image.image_local_path(), 'rb') as stored:
+            assert stored.read() == content
+
+        # sent again, the upload is gone
+        response = api_client.post(f"{url}finalize/")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        assert Image.objects.filter(project=project).count() == 1
+
+    def test_abandoned_uploads_removed(self, api_client, regular_user, project, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.IMAGE_UPLOAD_EXPIRY_HOURS = 1
+        api_client.force_authenticate(user=regular_user)
+        tokens = [api_client.post(f"/store/projects/{project.id}/uploads/", {"name": "plan.png", "length": 10}, format='json').data['upload_id']
+                  for _ in range(2)]
+        abandoned, active = ImageUpload.objects.get(token=tokens[0]), ImageUpload.objects.get(token=tokens[1])
+        ImageUpload.objects.filter(id=abandoned.id).update(updated_at=timezone.now() - timedelta(hours=2))
+        # a part file without its upload
+        orphan_path = os.path.join(os.path.dirname(active.part_path()), "orphan.part")
+        open(orphan_path, 'wb').close()
+        os.utime(orphan_path, (time.time() - 2 * 60 * 60,) * 2)
+
+        assert remove_abandoned_uploads() == 2
+        assert list(ImageUpload.objects.values_list('id', flat=True)) == [active.id]
+        assert not os.path.exists(abandoned.part_path()) and not os.path.exists(orphan_path)
+        assert os.path.exists(active.part_path())
+
+    def test_resumable_upload_chunk_beyond_length(self, api_client, regular_user, project, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        api_client.force_authenticate(user=regular_user)
+        response = api_client.post(f"/store/projects/{project.id}/uploads/", {"name": "plan.png", "length": 10}, format='json')
+        url = f"/store/projects/{project.id}/uploads/{response.data['upload_id']}/"
+
+        response = api_client.patch(url, b"x" * 11, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0')
+        assert response.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        assert api_client.get(url).data["offset"] == 0
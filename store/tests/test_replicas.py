@@ -0,0 +1,99 @@
+import time
+from unittest import mock
+
+import pytest
+import requests
+from model_bakery import baker
+
+from store.models import AiChainModule, AiChainModuleReplica
+from store.utility import replicas, module_limits
+
+
+def answer(content, delay=0):
+    time.sleep(delay)
+    return mock.Mock(status_code=200, content=content)
+
+
+def no_files():
+    return {}, []
+
+
+@pytest.fixture
+def module(fake_redis):
+    module = baker.make(AiChainModule, module_url="http://a", max_concurrency=0)
+    baker.make(AiChainModuleReplica, module=module, url="http://b")
+    return module
+
+
+@pytest.fixture
+def first_choice():
+    # the first of the equally busy endpoints instead of a random one
+    with mock.patch("store.utility.replicas.random.choice", side_effect=lambda urls: urls[0]):
+        yield
+
+
+@pytest.mark.django_db
+class TestReplicas:
+
+    def test_choose_least_outstanding(self, module, fake_redis):
+        fake_redis.zadd(replicas.KEY_OUTSTANDING.format(module.id, replicas.url_hash("http://a")),
+                        {"call": replicas.redis_time(fake_redis)})
+        assert replicas.choose(module, ["http://a", "http://b"]) == "http://b"
+
+    def test_calls_of_lost_workers_expire(self, module, fake_redis, settings, first_choice):
+        fake_redis.zadd(replicas.KEY_OUTSTANDING.format(module.id, replicas.url_hash("http://a")),
+                        {"lost": replicas.redis_time(fake_redis) - settings.CHAIN_MODULE_SLOT_TIMEOUT - 1})
+        assert replicas.choose(module, ["http://a", "http://b"]) == "http://a"
+
+    def test_failing_endpoint_is_ejected(self, module, settings, first_choice):
+        settings.CHAIN_REPLICA_EJECT_AFTER_FAILURES = 2
+        replicas.record_failure(module, "http://a")
+        assert not replicas.is_ejected(module, "http://a")
+        replicas.record_failure(module, "http://a")
+        assert replicas.is_ejected(module, "http://a")
+        assert replicas.choose(module, ["http://a", "http://b"]) == "http://b"
+
+    def test_success_resets_the_failures(self, module, settings):
+        settings.CHAIN_REPLICA_EJECT_AFTER_FAILURES = 2
+        replicas.record_failure(module, "http://a")
+        replicas.record_success(module, "http://a", 0.1)
+        replicas.record_failure(module, "http://a")
+        assert not replicas.is_ejected(module, "http://a")
+
+    def test_unreachable_endpoint_retried_on_the_next(self, module, first_choice):
+        def post(url, files):
+            if url == "http://a":
+                raise requests.exceptions.ConnectionError("down")
+            return answer(b"b")
+
+        with mock.patch("store.utility.replicas.post_to_module", side_effect=post):
+            assert replicas.post(module, no_files).content == b"b"
+
+    def hedged(self, settings, fake_redis, module):
+        settings.CHAIN_REPLICA_HEDGE_PERCENTILE = 50
+        settings.CHAIN_REPLICA_HEDGE_MIN_SAMPLES = 1
+        fake_redis.lpush(replicas.KEY_LATENCIES.format(module.id), 0.05)
+
+        def post(url, files):
+            return answer(b"slow", 0.5) if url == "http://a" else answer(b"fast")
+        return mock.patch("store.utility.replicas.post_to_module", side_effect=post)
+
+    def test_slow_call_is_hedged(self, module, settings, fake_redis, first_choice):
+        with self.hedged(settings, fake_redis, module):
+            assert replicas.post(module, no_files).content == b"fast"
+
+    def test_hedge_needs_a_free_slot(self, module, settings, fake_redis, first_choice):
+        module.max_concurrency = 1
+        with self.hedged(settings, fake_redis, module):
+            with module_limits.module_slot(module):
+                assert replicas.post(module, no_files).content == b"slow"
+
+    def test_hedge_holds_its_slot_until_both_answered(self, module, settings, fake_redis, first_choice):
+        module.max_concurrency = 2
+        with self.hedged(settings, fake_redis, module):
+            with module_limits.module_slot(module):
+                assert replicas.post(module, no_files).content == b"fast"
+            # the slow request still runs
+            assert module_limits.in_use(module) == 1
+            time.sleep(0.6)
+        assert module_limits.in_use(module) == 0
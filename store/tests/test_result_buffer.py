@@ -0,0 +1,60 @@
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from django.utils import timezone
+from model_bakery import baker
+
+from store.models import AiChainModule, ChainModuleResult, ChainModuleResultSet, Image
+from store.tasks import final_task
+from store.utility.result_buffer import ResultBuffer
+
+
+def make_old(image):
+    Image.objects.filter(id=image.id).update(updated_at=timezone.now() - timedelta(days=1))
+    image.refresh_from_db()
+    return image.updated_at
+
+
+@pytest.mark.django_db
+class TestResultBuffer:
+
+    def test_flush_writes_results_and_finished_images(self, project, image):
+        result_set = baker.make(ChainModuleResultSet, project=project, image=image)
+        module = baker.make(AiChainModule)
+        updated_at = make_old(image)
+        buffer = ResultBuffer(flush_size=10)
+
+        with mock.patch("store.utility.result_buffer.progress_events") as progress_events:
+            buffer.add_result(project_id=project.id, module=module, result={"stage": 0}, result_set=result_set, stage_index=0)
+            buffer.add_result(project_id=project.id, module=module, result={"stage": 1}, result_set=result_set, stage_index=1)
+            buffer.finish_image(image)
+            assert not ChainModuleResult.objects.exists()
+
+            buffer.flush()
+
+        assert list(ChainModuleResult.objects.order_by("stage_index").values_list("result", flat=True)) == [{"stage": 0}, {"stage": 1}]
+        image.refresh_from_db()
+        assert image.has_result
+        assert image.updated_at > updated_at
+        assert progress_events.stage_done.call_count == 2
+        progress_events.image_done.assert_called_once_with(project.id, image.id)
+        assert buffer.results == [] and buffer.finished_images == []
+
+    def test_flushes_when_full(self, project, image):
+        result_set = baker.make(ChainModuleResultSet, project=project, image=image)
+        buffer = ResultBuffer(flush_size=2)
+        with mock.patch("store.utility.result_buffer.progress_events"):
+            buffer.add_result(project_id=project.id, module=None, result={}, result_set=result_set)
+            assert ChainModuleResult.objects.count() == 0
+            buffer.add_result(project_id=project.id, module=None, result={}, result_set=result_set)
+        assert ChainModuleResult.objects.count() == 2
+
+    def test_final_task_updates_the_image_timestamp(self, project, image):
+        result_set = baker.make(ChainModuleResultSet, project=project, image=image)
+        updated_at = make_old(image)
+        with mock.patch("store.tasks.progress_events"):
+            final_task((project.id, image.id, result_set.id, "output.zip"), image_info={})
+        image.refresh_from_db()
+        assert image.has_result
+        assert image.updated_at > updated_at
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+from model_bakery import baker
+
+from store.models import AiChainModule
+from store.utility import result_cache
+
+
+@pytest.mark.django_db
+class TestResultCache:
+
+    @pytest.fixture(autouse=True)
+    def media_root(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+
+    def test_miss_then_hit(self, tmp_path):
+        module = baker.make(AiChainModule, version="1.0")
+        input_sha256 = "a" * 64
+        assert result_cache.lookup(module, input_sha256) is None
+
+        result_cache.store(module, input_sha256, b"zip", {"elements": []})
+        assert result_cache.lookup(module, input_sha256) == (b"zip", {"elements": []})
+        # only the output, no temporary file left behind
+        assert os.listdir(tmp_path / "chain_cache" / f"module_{module.id}") == [
+            os.path.basename(result_cache.cache_output_path(module, input_sha256))]
+
+    def test_other_input_is_a_miss(self):
+        module = baker.make(AiChainModule, version="1.0")
+        result_cache.store(module, "a" * 64, b"zip", {})
+        assert result_cache.lookup(module, "b" * 64) is None
+
+    def test_new_module_version_is_a_miss(self):
+        module = baker.make(AiChainModule, version="1.0")
+        result_cache.store(module, "a" * 64, b"zip", {})
+        module.version = "1.1"
+        module.save()
+        assert result_cache.lookup(module, "a" * 64) is None
+
+        result_cache.store(module, "a" * 64, b"zip 1.1", {"new": True})
+        assert result_cache.lookup(module, "a" * 64) == (b"zip 1.1", {"new": True})
+
+    def test_store_again_replaces_the_output(self):
+        module = baker.make(AiChainModule, version="1.0")
+        result_cache.store(module, "a" * 64, b"old", {})
+        result_cache.store(module, "a" * 64, b"new", {"again": True})
+        assert result_cache.lookup(module, "a" * 64) == (b"new", {"again": True})
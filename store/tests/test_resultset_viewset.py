@@ -1,10 +1,17 @@
 # store/tests/test_resultset_viewset.py
+import os
+from unittest import mock
+
 import pytest
 from rest_framework import status
 from model_bakery import baker
+from PIL import Image as PILImage
 from django.conf import settings
 from core.models import User
-from store.models import ResultSet, AiModel, Project, Customer, Image
+from store.models import (ResultSet, AiModel, Project, Customer, Image, ChainModuleResultSet, ChainModuleResult, AiChainModule,
+                          ElementIndexCell)
+from store.utility import spatial_index
+from store.utility.element_filters import ElementFilter
 
 
 @pytest.mark.django_db
@@ -33,3 +40,186 @@ class TestResultSetViewSet:
     # does not support creating resultsets via api.
 
 
+
+    # conditional GET
+
+    def test_retrieve_result_set_not_modified(self, api_client, regular_user, result_set):
+        api_client.force_authenticate(user=regular_user)
+        url = f"/store/projects/{result_set.project.id}/results/{result_set.image.id}/"
+        response = api_client.get(url)
+        etag = response['ETag']
+        assert 'no-cache' in response['Cache-Control']
+
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response['ETag'] == etag
+
+        result_set.result_detection = {"elements": []}
+        result_set.save()
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert response['ETag'] != etag
+
+    def test_list_result_sets_not_modified(self, api_client, project, ai_model, regular_user):
+        api_client.force_authenticate(user=regular_user)
+        baker.make(ResultSet, project=project, ai_model=ai_model, image=baker.make(Image, project=project))
+        url = f"/store/projects/{project.id}/results/"
+        etag = api_client.get(url)['ETag']
+        assert api_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_304_NOT_MODIFIED
+
+        baker.make(ResultSet, project=project, ai_model=ai_model, image=baker.make(Image, project=project))
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data) == 2
+
+    def test_retrieve_chain_result_set_not_modified(self, api_client, project, regular_user, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=regular_user)
+        image = baker.make(Image, project=project)
+        chain_result_set = baker.make(ChainModuleResultSet, project=project, image=image)
+        url = f"/store/projects/{project.id}/chainresults/{chain_result_set.id}/"
+        etag = api_client.get(url)['ETag']
+        assert api_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_304_NOT_MODIFIED
+
+        # a module finished, the cached payloads are outdated once it is committed
+        with django_capture_on_commit_callbacks(execute=True):
+            baker.make(ChainModuleResult, project=project, result_set=chain_result_set, module=baker.make(AiChainModule), result={})
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data["results"]) == 1
+
+    def test_chain_result_sets_served_from_cache(self, api_client, project, regular_user,
+                                                 django_assert_num_queries, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=regular_user)
+        chain_result_set = baker.make(ChainModuleResultSet, project=project, image=baker.make(Image, project=project))
+        url = f"/store/projects/{project.id}/chainresults/"
+        etag = api_client.get(url)['ETag']
+
+        # only the permission check, the payload and its ETag come from the cache
+        with django_assert_num_queries(1):
+            response = api_client.get(url)
+        assert response['ETag'] == etag
+        assert len(response.data) == 1
+
+        # a module finished
+        with django_capture_on_commit_callbacks(execute=True):
+            baker.make(ChainModuleResult, project=project, result_set=chain_result_set, module=baker.make(AiChainModule), result={})
+        response = api_client.get(url)
+        assert response['ETag'] != etag
+        assert len(response.data[0]["results"]) == 1
+
+    def test_filtered_chain_result_sets_not_cached(self, api_client, project, regular_user):
+        api_client.force_authenticate(user=regular_user)
+        baker.make(ChainModuleResultSet, project=project, image=baker.make(Image, project=project))
+        url = f"/store/projects/{project.id}/chainresults/"
+
+        # the key to store the payload under, None: not cached
+        with mock.patch("store.utility.conditional.result_payloads.store") as store:
+            assert api_client.get(url, {"bbox": "0,0,100,100"}).status_code == status.HTTP_200_OK
+            assert store.call_args.args[0] is None
+            assert api_client.get(url).status_code == status.HTTP_200_OK
+            assert store.call_args.args[0] is not None
+
+    def test_chain_result_elements_filtered(self, api_client, project, regular_user):
+        api_client.force_authenticate(user=regular_user)
+        chain_result_set = baker.make(ChainModuleResultSet, project=project, image=baker.make(Image, project=project))
+        elements = [
+            {"guid": "a", "class_id": "0", "confidence": "0.9", "bbox_xyxy_abs": [10, 10, 50, 20], "text": "Büro"},
+            {"guid": "b", "class_id": "0", "confidence": "0.6", "bbox_xyxy_abs": [15, 30, 60, 40], "text": "Flur"},
+            {"guid": "c", "class_id": "1", "confidence": "0.95", "bbox_xyxy_abs": [900, 900, 950, 920], "text": "Büro 2"},
+        ]
+        baker.make(ChainModuleResult, project=project, result_set=chain_result_set, module=baker.make(AiChainModule),
+                   result={"plan.png": {"visual_result_path": "visual/plan.png", "elements": elements}})
+        url = f"/store/projects/{project.id}/chainresults/{chain_result_set.id}/"
+
+        def guids(params):
+            response = api_client.get(url, params)
+            assert response.status_code == status.HTTP_200_OK
+            return [element["guid"] for element in response.data["results"][0]["result"]["plan.png"]["elements"]]
+
+        assert guids({}) == ["a", "b", "c"]
+        assert guids({"min_confidence": "0.8"}) == ["a", "c"]
+        assert guids({"bbox": "0,0,100,100"}) == ["a", "b"]
+        assert guids({"class": "1"}) == ["c"]
+        assert guids({"text": "büro", "bbox": "0,0,100,100"}) == ["a"]
+
+        response = api_client.get(url, {"class": "0", "element_fields": "guid,text"})
+        assert response.data["results"][0]["result"]["plan.png"] == {
+            "visual_result_path": "visual/plan.png",
+            "elements": [{"guid": "a", "text": "Büro"}, {"guid": "b", "text": "Flur"}],
+        }
+        assert api_client.get(url, {"bbox": "0,0,100"}).status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_chain_result_elements_from_spatial_index(self, api_client, project, regular_user, settings):
+        settings.ELEMENT_INDEX_CELL_SIZE = 100
+        api_client.force_authenticate(user=regular_user)
+        chain_result_set = baker.make(ChainModuleResultSet, project=project, image=baker.make(Image, project=project))
+        elements = [
+            {"guid": "a", "class_id": "0", "confidence": "0.9", "bbox_xyxy_abs": [10, 10, 50, 20], "text": "Büro"},
+            {"guid": "b", "class_id": "0", "confidence": "0.9", "bbox_xyxy_abs": [90, 90, 260, 110], "text": "Flur"},
+            {"guid": "c", "class_id": "0", "confidence": "0.9", "bbox_xyxy_abs": [900, 900, 950, 920], "text": "WC"},
+        ]
+        fields = [{"text_snippet_guids": ["a", "b"], "text_snippets": ["Büro", "Flur"], "class": None, "position": [10, 10, 260, 110]}]
+        result = baker.make(ChainModuleResult, project=project, result_set=chain_result_set, module=baker.make(AiChainModule),
+                            result={"plan.png": {"elements": elements, "fields": fields}})
+        url = f"/store/projects/{project.id}/chainresults/{chain_result_set.id}/elements/"
+
+        def hits(params):
+            response = api_client.get(url, params)
+            assert response.status_code == status.HTTP_200_OK
+            assert response.data["result_id"] == result.id
+            return [(item["kind"], item.get("guid")) for item in response.data["elements"]]
+
+        # the index is built with the first query
+        assert hits({"bbox": "0,0,99,99"}) == [("element", "a"), ("element", "b"), ("field", None)]
+        result.refresh_from_db()
+        assert result.element_index_cell_size == 100
+        assert hits({"point": "200,100"}) == [("element", "b"), ("field", None)]
+        assert hits({"point": "500,500"}) == []
+        assert hits({"bbox": "800,800,1000,1000", "text": "wc"}) == [("element", "c")]
+        assert len(hits({})) == 4
+        assert api_client.get(url, {"point": "1"}).status_code == status.HTTP_400_BAD_REQUEST
+        assert api_client.get(url, {"result": result.id}).status_code == status.HTTP_200_OK
+        assert api_client.get(url, {"result": result.id + 1}).status_code == status.HTTP_404_NOT_FOUND
+        assert api_client.get(url, {"result": "abc"}).status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_spatial_index_clamps_and_caps_boxes(self, project, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.ELEMENT_INDEX_CELL_SIZE = 100
+        settings.ELEMENT_INDEX_MAX_CELLS_PER_ITEM = 4
+        os.makedirs(tmp_path / f"project_{project.id}")
+        PILImage.new("RGB", (300, 200)).save(tmp_path / f"project_{project.id}" / "plan.png")
+        image = baker.make(Image, project=project, name="plan.png", image_file=f"project_{project.id}/plan.png")
+        elements = [
+            {"guid": "a", "bbox_xyxy_abs": [10, 10, 50, 20]},
+            # beyond the image on the right, a broken box far out
+            {"guid": "b", "bbox_xyxy_abs": [250, 150, 10 ** 9, 10 ** 9]},
+            {"guid": "c", "bbox_xyxy_abs": [-10 ** 9, -10 ** 9, -5, -5]},
+            # over the whole image
+            {"guid": "d", "bbox_xyxy_abs": [0, 0, 300, 200]},
+        ]
+        result = baker.make(ChainModuleResult, project=project, result_set=baker.make(ChainModuleResultSet, project=project, image=image),
+                            module=baker.make(AiChainModule), result={"plan.png": {"elements": elements}})
+
+        spatial_index.build(result.id)
+        cells = dict(((cell.cx, cell.cy), [item["guid"] for item in cell.elements])
+                     for cell in ElementIndexCell.objects.filter(result=result))
+        assert cells == {
+            (0, 0): ["a"],
+            (2, 1): ["b"],
+            (3, 1): ["b"],
+            (3, 2): ["b"],
+            (2, 2): ["b"],
+            spatial_index.WIDE_CELL: ["d"],
+        }
+
+        def guids(bbox):
+            return [item["guid"] for item in spatial_index.query(result.id, 100, ElementFilter(bbox=bbox))]
+
+        assert guids([0, 0, 60, 60]) == ["a", "d"]
+        assert guids([260, 160, 280, 180]) == ["b", "d"]
+        assert guids([400, 400, 500, 500]) == []
+
+        # the hits come from the cells, the result itself is not read again
+        with mock.patch("store.utility.spatial_index.indexed_items") as items:
+            assert guids([0, 0, 60, 60]) == ["a", "d"]
+        items.assert_not_called()
@@ -13,6 +13,8 @@ router.register("customers", views.CustomerViewSet, basename="customers")
 router.register("ais", views.AIsViewSet, basename="ais")
 # "projects/"
 router.register("projects", views.ProjectsViewSet, basename="projects")
+# "queue-metrics/"
+router.register("queue-metrics", views.QueueMetricsViewSet, basename="queue-metrics")
 # "images" functionality is defined under project as actions, here the nedted router for images is not used
 
 # for rested router: /projects/project_id/results/
@@ -6,10 +6,24 @@ import os
 from django.conf import settings
 
 from src.cleaner import Cleaner
-from src.localizer import Localizer
+from src.localizer import Localizer, inference_batched
 from src.recognizer import Recognizer
 from src.interpreter import Interpreter
 
+from . import model_pool
+
+
+# AI model files mapping based on ai_model_id
+# here will be a problem if you later add/delete the ai model
+AI_MODEL_WEIGHTS = {
+    1: 'best.pt',    # Assuming '1' corresponds to the 'best' model
+    2: 'epoch_299.pt'  # And '2' corresponds to the 'epoch_299' model
+}
+
+
+def get_model_weights_dir():
+    return os.path.join(settings.BASE_DIR, 'store', 'ai', 'model_weights', 'weights')
+
 
 # to generate the dynamic ymal file for running the ai models
 def prepare_cfg(project_id, image_name, ai_model_id):
@@ -20,19 +34,12 @@ def prepare_cfg(project_id, image_name, ai_model_id):
     # Define the base paths
     base_media_path = settings.MEDIA_ROOT  # BASE_DIR/media
     base_output_path = os.path.join(base_media_path, 'outputs', f'project_{project_id}')  # BASE_DIR/media/outputs/project_1
-    base_model_path = os.path.join(settings.BASE_DIR, 'store', 'ai', 'model_weights', 'weights')
+    base_model_path = get_model_weights_dir()
     original_ai_outputs_path = os.path.join(settings.BASE_DIR, 'store', 'ai', 'outputs')
 
 
-    # AI model files mapping based on ai_model_id
-    # here will be a problem if you later add/delete the ai model
-    ai_models = {
-        1: 'best.pt',    # Assuming '1' corresponds to the 'best' model
-        2: 'epoch_299.pt'  # And '2' corresponds to the 'epoch_299' model
-    }
-
     # Select the AI model file based on ai_model_id
-    model_file_name = ai_models.get(ai_model_id)
+    model_file_name = AI_MODEL_WEIGHTS.get(ai_model_id)
     if not model_file_name:
         raise ValueError(f'AI model with ID {ai_model_id} does not exist')
 
@@ -40,7 +47,10 @@ def prepare_cfg(project_id, image_name, ai_model_id):
     cfg = {
         'input': {
             'image': os.path.join(base_media_path, f'project_{project_id}', image_name),
-            'model': os.path.join(base_model_path, model_file_name)
+            'model': os.path.join(base_model_path, model_file_name),
+            'detection_backend': settings.AI_DETECTION_BACKEND,
+            'detection_batch_size': settings.AI_DETECTION_BATCH_SIZE,
+            'in_memory_tiles': settings.AI_DETECTION_IN_MEMORY
         },
         'paths': {
             "general": {
@@ -100,28 +110,41 @@ def prepare_cfg(project_id, image_name, ai_model_id):
 
 
 
+def load_cfg(cfg_path):
+    # Load the configuration
+    with open(cfg_path, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+
+    # Setup directories, clean up, etc.
+    cleaner = Cleaner(cfg)
+    cleaner.setup_dirs()
+    cleaner.clean_dirs()
+    return cfg
+
+
+def run_recognition_and_interpretation(cfg):
+    # Run recognizer with the PARSeq instance of the worker's model pool
+    recognizer = Recognizer(cfg, parseq=model_pool.get_parseq())
+    recognizer.inference(cfg["paths"]["text_detection"]["final_path"])
+
+    # Run interpreter
+    interpreter = Interpreter(cfg)
+    interpreter.inference(cfg["paths"]["text_recognition"]["final_path"])
+
+
 def run_ai_model(cfg_path):
     try:
-        # Load the configuration
-        with open(cfg_path, 'r') as cfg_file:
-            cfg = yaml.safe_load(cfg_file)
-
-        # Setup directories, clean up, etc.
-        cleaner = Cleaner(cfg)
-        cleaner.setup_dirs()
-        cleaner.clean_dirs()
+        cfg = load_cfg(cfg_path)
 
         # Load input image and run localizer
-        localizer = Localizer(cfg)
+        # the in-process backend uses the YOLOv7 detector of the worker's model pool
+        detector = None
+        if cfg["input"].get("detection_backend") == "inprocess":
+            detector = model_pool.get_detector(cfg["input"]["model"])
+        localizer = Localizer(cfg, detector=detector)
         localizer.inference([cfg["input"]["image"]])
 
-        # Run recognizer
-        recognizer = Recognizer(cfg)
-        recognizer.inference(cfg["paths"]["text_detection"]["final_path"])
-
-        # Run interpreter
-        interpreter = Interpreter(cfg)
-        interpreter.inference(cfg["paths"]["text_recognition"]["final_path"])
+        run_recognition_and_interpretation(cfg)
 
         # You might want to return some results or status from this function
         return True
@@ -131,6 +154,49 @@ def run_ai_model(cfg_path):
         return False
 
 
+# processes several images (e.g. of one project) at once: the tiles of all images are localized in shared batches
+# returns a dict cfg_path -> success like run_ai_model() does for a single image
+def run_ai_models(cfg_paths):
+    results = {}
+    try:
+        cfgs = {cfg_path: load_cfg(cfg_path) for cfg_path in cfg_paths}
+    except Exception as e:
+        print(f"AI model processing failed: {e}")
+        return {cfg_path: run_ai_model(cfg_path) for cfg_path in cfg_paths}
+
+    # only the in-process backend can batch across images, and only images localized with the same weights
+    cfgs_by_model = {}
+    for cfg_path, cfg in cfgs.items():
+        if cfg["input"].get("detection_backend") == "inprocess":
+            cfgs_by_model.setdefault(cfg["input"]["model"], []).append(cfg_path)
+        else:
+            results[cfg_path] = run_ai_model(cfg_path)
+
+    for model, model_cfg_paths in cfgs_by_model.items():
+        try:
+            detector = model_pool.get_detector(model)
+            localizers = [Localizer(cfgs[cfg_path], detector=detector) for cfg_path in model_cfg_paths]
+            inference_batched(
+                localizers,
+                [[cfgs[cfg_path]["input"]["image"]] for cfg_path in model_cfg_paths],
+                detector,
+                batch_size=cfgs[model_cfg_paths[0]]["input"].get("detection_batch_size", 1)
+            )
+        except Exception as e:
+            # a failed batch must not fail all of its images, retry them one by one
+            print(f"AI model batch processing failed: {e}")
+            results.update({cfg_path: run_ai_model(cfg_path) for cfg_path in model_cfg_paths})
+            continue
+
+        for cfg_path in model_cfg_paths:
+            try:
+                run_recognition_and_interpretation(cfgs[cfg_path])
+                results[cfg_path] = True
+            except Exception as e:
+                print(f"AI model processing failed: {e}")
+                results[cfg_path] = False
+
+    return results
 
 
 
@@ -138,6 +204,26 @@ def run_ai_model(cfg_path):
 
 
 
+# called once per celery worker process, loads the models of all the installed weights into the pool
+def warm_up_model_pool():
+    if not settings.AI_MODEL_POOL_PRELOAD:
+        return
+
+    weights_dir = get_model_weights_dir()
+    weights_paths = [os.path.join(weights_dir, file_name) for file_name in AI_MODEL_WEIGHTS.values()]
+    weights_paths = [path for path in weights_paths if os.path.isfile(path)]
+    # the integrated AI models are disabled if no weights are installed, nothing to warm up
+    if not weights_paths:
+        return
+
+    try:
+        model_pool.warm_up(weights_paths)
+    except Exception as e:
+        # a failed warm up must not kill the worker, the models are then loaded lazily by the first task
+        print(f"AI model pool warm up failed: {e}")
+
+
+
 
 """
 'paths': {
@@ -0,0 +1,153 @@
+"""
+helpers for running images through the AI chain modules (see tasks.py)
+"""
+import io
+import json
+import os
+from pathlib import Path
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+from django.conf import settings
+
+
+# where the output of a chain stage is kept as the input of the next stage,
+# unique per chain result set (one image run) and stage, so concurrent runs do not overwrite each other
+def chain_artifact_path(project_id, chain_result_set_id, stage):
+    artifact_dir = os.path.join(settings.MEDIA_ROOT, 'outputs', f'project_{project_id}', 'chain', f'result_set_{chain_result_set_id}')
+    os.makedirs(artifact_dir, exist_ok=True)
+    return os.path.join(artifact_dir, f'stage_{stage}.zip')
+
+
+# zip_source: path or file-like object of a module's .zip response
+def read_zip_jsons(zip_source):
+    jsons = []
+    with ZipFile(zip_source) as zObject:
+        # gather the .json results
+        filenames = [zInfo.filename for zInfo in zObject.infolist()
+                     if zInfo.filename.endswith(".json")]
+
+        for filename in filenames:
+            with zObject.open(filename) as myJson:
+                jsons.append(json.loads(myJson.read()))
+    return jsons
+
+
+# Since for now each module produces only one .json result file
+# and the currently used frontend expects one .json file per moule
+# only the first (and most probably the only one) .json file is saved to database.
+def first_json_result(jsons):
+    if len(jsons) == 0:
+        return {'msg': 'No .json result was produced'}
+    return jsons[0]
+
+
+# the name an input file is posted with in a batched module call, the module has to answer with a
+# zip containing one top level folder per input, named after the stem of this name
+def batch_upload_name(image, input_filepath):
+    return f"{Path(image.name).stem}{Path(input_filepath).suffix}"
+
+
+# writes a zip entry with a fixed timestamp: the same content always gives the same zip bytes,
+# so the zips built here hit the result cache (utility/result_cache.py) as the input of the next module
+def write_zip_entry(zip_file, name, data):
+    zInfo = ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    zInfo.compress_type = ZIP_DEFLATED
+    zip_file.writestr(zInfo, data)
+
+
+# splits the zip response of a batched module call into one zip per input (stem -> zip bytes),
+# each looking like the response of a single module call
+def split_batch_zip(zip_bytes, stems):
+    buffers = {stem: io.BytesIO() for stem in stems}
+    with ZipFile(io.BytesIO(zip_bytes)) as batch_zip:
+        outputs = {stem: ZipFile(buffer, 'w', ZIP_DEFLATED) for stem, buffer in buffers.items()}
+        for zInfo in batch_zip.infolist():
+            stem, _, inner_name = zInfo.filename.partition('/')
+            if stem in outputs and inner_name and not zInfo.is_dir():
+                write_zip_entry(outputs[stem], inner_name, batch_zip.read(zInfo.filename))
+        for output in outputs.values():
+            output.close()
+    return {stem: buffer.getvalue() for stem, buffer in buffers.items()}
+
+
+# the body of a processing start request is either a list of module ids (a linear chain, returns None)
+# or a dependency graph: {"modules": [1, 2, 3], "dependencies": {"3": [1, 2]}}
+# modules without dependencies get the original image, the others the output of their dependencies.
+# returns the graph with every module listed in "dependencies" (str keys, as after a json round trip of the task args)
+def parse_chain_graph(data):
+    if not isinstance(data, dict):
+        return None
+
+    try:
+        modules = [int(module_id) for module_id in data.get('modules', [])]
+        dependencies = {int(module_id): [int(parent_id) for parent_id in parent_ids]
+                        for module_id, parent_ids in data.get('dependencies', {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError("modules and dependencies have to be given as module ids")
+
+    if len(set(modules)) != len(modules):
+        raise ValueError("a module can appear only once in the graph")
+    for module_id, parent_ids in dependencies.items():
+        if module_id not in modules or any(parent_id not in modules for parent_id in parent_ids):
+            raise ValueError(f"the dependencies of module {module_id} refer to a module not listed in modules")
+
+    # topological sort, fails if there is a cycle
+    remaining = {module_id: set(dependencies.get(module_id, [])) for module_id in modules}
+    while remaining:
+        ready = [module_id for module_id, parent_ids in remaining.items() if not parent_ids]
+        if not ready:
+            raise ValueError("the dependencies contain a cycle")
+        for module_id in ready:
+            del remaining[module_id]
+        for parent_ids in remaining.values():
+            parent_ids.difference_update(ready)
+
+    return {
+        'modules': modules,
+        'dependencies': {str(module_id): dependencies.get(module_id, []) for module_id in modules}
+    }
+
+
+# input of a module depending on several modules: one zip with a top level folder "module_<id>"
+# holding the output of each of them
+def merge_zips(named_zip_paths, output_filepath):
+    with ZipFile(output_filepath, 'w', ZIP_DEFLATED) as merged:
+        for folder, zip_path in named_zip_paths.items():
+            with ZipFile(zip_path) as part:
+                for zInfo in part.infolist():
+                    if not zInfo.is_dir():
+                        write_zip_entry(merged, f"{folder}/{zInfo.filename}", part.read(zInfo.filename))
+    return output_filepath
+
+
+# the fields of a module the module tasks need, passed along in the task payload
+# instead of fetching the module again at every stage
+def module_context(module):
+    return {
+        'id': module.id,
+        'module_url': module.module_url,
+        'name': module.name,
+        'version': module.version,
+        'max_batch_size': module.max_batch_size,
+        'max_concurrency': module.max_concurrency,
+        'replica_urls': [replica.url for replica in module.replicas.all() if replica.is_active],
+    }
+
+
+# an unsaved AiChainModule built from module_context(), good for calling the module (see utility/replicas.py)
+def module_from_context(context):
+    from ..models import AiChainModule
+
+    context = dict(context)
+    replica_urls = context.pop('replica_urls', [])
+    module = AiChainModule(**context)
+    module.replica_urls = replica_urls
+    return module
+
+
+def image_info(image):
+    return {
+        "name": image.name,
+        "old_name": image.old_name,
+        "image_url": image.image_url()
+    }
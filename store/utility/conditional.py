@@ -0,0 +1,61 @@
+"""
+conditional GET of the result endpoints (see ResultSetViewSet and ChainModuleResultSetViewSet in views.py)
+
+the results never change after they are written, so a result endpoint answers with a strong ETag derived from the
+ids and timestamps of the rows it shows (read without their json results). a request with a matching If-None-Match
+gets an empty 304 instead of the results, which are then not read from the database and not serialized at all.
+"""
+import hashlib
+
+from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import result_payloads
+
+
+# parts: the ids/timestamps of the shown rows, the path with the query params makes the answers of different
+# params (e.g. filters) different representations
+def make_etag(request, parts):
+    digest = hashlib.sha256(repr((request.get_full_path(), list(parts))).encode()).hexdigest()
+    return quote_etag(digest[:40])
+
+
+def is_not_modified(request, etag):
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    return '*' in etags or etag in etags
+
+
+def with_cache_headers(response, etag):
+    response['ETag'] = etag
+    # private: the results are per user; no-cache: the browser keeps them, but asks (cheaply) whether they changed
+    patch_cache_control(response, **settings.RESULTS_CACHE_CONTROL)
+    return response
+
+
+# a 304 if the client has the current version, otherwise the response of get_data()
+def conditional_response(request, parts, get_data):
+    etag = make_etag(request, parts)
+    if is_not_modified(request, etag):
+        return with_cache_headers(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+    return with_cache_headers(Response(get_data()), etag)
+
+
+# same as conditional_response(), the ETag and the data of the response are kept in the result payload cache
+# (see result_payloads.py): get_parts() and get_data() only run when they are not cached
+def cached_conditional_response(request, project_id, get_parts, get_data):
+    cached, key = result_payloads.lookup(request, project_id)
+    if cached is not None:
+        etag = cached["etag"]
+        if is_not_modified(request, etag):
+            return with_cache_headers(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+        return with_cache_headers(Response(cached["data"]), etag)
+
+    etag = make_etag(request, get_parts())
+    if is_not_modified(request, etag):
+        return with_cache_headers(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+    data = get_data()
+    result_payloads.store(key, etag, data)
+    return with_cache_headers(Response(data), etag)
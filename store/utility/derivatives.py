@@ -0,0 +1,110 @@
+"""
+derivatives of the uploaded images, made once by a celery task after the upload ("generate_image_derivatives" in tasks.py)
+instead of every consumer decoding the full original:
+
+    thumbnail     project_<id>/thumbnails/<stem>.jpg, longest side IMAGE_THUMBNAIL_SIZE (lists, admin)
+    preview       project_<id>/previews/<stem>.jpg, longest side IMAGE_PREVIEW_SIZE (gallery, viewer)
+    working copy  project_<id>/working/<stem>.png, full size in RGB (or grayscale), input of the AI chain modules
+
+the derivatives keep the stem of the original, so the modules name their outputs the same for both.
+the original is decoded once, the preview is made from the working copy and the thumbnail from the preview.
+
+the working copy has the pixels of the original as stored (not turned by its EXIF orientation), so the positions the
+modules detect are the same for the working copy and the original. a chain started before the task got to an image
+makes the working copy itself ("working_copy_path"), the modules never get the original instead.
+the previews and thumbnails are shown upright, as the browsers show the original.
+"""
+import os
+from pathlib import Path
+from uuid import uuid4
+
+from django.conf import settings
+from PIL import Image as PILImage, ExifTags
+
+
+KINDS = {
+    # kind -> (folder, extension)
+    'thumbnail': ('thumbnails', 'jpg'),
+    'preview': ('previews', 'jpg'),
+    'working': ('working', 'png'),
+}
+
+# EXIF orientation -> transposition showing the image upright (as ImageOps.exif_transpose)
+ORIENTATIONS = {
+    2: PILImage.Transpose.FLIP_LEFT_RIGHT,
+    3: PILImage.Transpose.ROTATE_180,
+    4: PILImage.Transpose.FLIP_TOP_BOTTOM,
+    5: PILImage.Transpose.TRANSPOSE,
+    6: PILImage.Transpose.ROTATE_270,
+    7: PILImage.Transpose.TRANSVERSE,
+    8: PILImage.Transpose.ROTATE_90,
+}
+
+
+# path of a derivative relative to MEDIA_ROOT
+def derivative_name(image, kind):
+    folder, ext = KINDS[kind]
+    return os.path.join(f'project_{image.project_id}', folder, f"{Path(image.name).stem}.{ext}")
+
+
+def derivative_path(image, kind):
+    return os.path.join(settings.MEDIA_ROOT, derivative_name(image, kind))
+
+
+def derivative_url(image, kind):
+    return f"{settings.LOCALHOST_PORT_URL}{settings.MEDIA_URL}{derivative_name(image, kind)}"
+
+
+# written to a temporary file first, the task and a chain making the same working copy never read a half-written one
+def save(picture, image, kind, **params):
+    path = derivative_path(image, kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid4().hex}.tmp'
+    try:
+        picture.save(tmp_path, **params)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def working_copy(original):
+    return original.convert('L' if settings.IMAGE_WORKING_COPY_GRAYSCALE else 'RGB')
+
+
+def generate(image):
+    with PILImage.open(image.image_local_path()) as original:
+        working = working_copy(original)
+        # scans and photos can be stored rotated, with the orientation in their EXIF data
+        orientation = original.getexif().get(ExifTags.Base.Orientation)
+    save(working, image, 'working', format='PNG')
+
+    preview = working.copy()
+    preview.thumbnail((settings.IMAGE_PREVIEW_SIZE, settings.IMAGE_PREVIEW_SIZE))
+    if orientation in ORIENTATIONS:
+        preview = preview.transpose(ORIENTATIONS[orientation])
+    save(preview, image, 'preview', format='JPEG', quality=85)
+
+    preview.thumbnail((settings.IMAGE_THUMBNAIL_SIZE, settings.IMAGE_THUMBNAIL_SIZE))
+    save(preview, image, 'thumbnail', format='JPEG', quality=80)
+
+
+# the working copy of the image, made now if the derivatives task did not get to the image yet.
+# an original that cannot be decoded has no working copy, the modules get it as is (and report the error)
+def working_copy_path(image):
+    path = derivative_path(image, 'working')
+    if not os.path.isfile(path):
+        try:
+            with PILImage.open(image.image_local_path()) as original:
+                save(working_copy(original), image, 'working', format='PNG')
+        except OSError as e:
+            print(f"working copy of image {image.id} not made: {e}")
+            return image.image_local_path()
+    return path
+
+
+def remove(image):
+    for kind in KINDS:
+        path = derivative_path(image, kind)
+        if os.path.isfile(path):
+            os.remove(path)
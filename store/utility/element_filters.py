@@ -0,0 +1,104 @@
+"""
+server-side filtering of the detected elements in the results (see ElementFilterMixin in serilizers.py)
+
+the results of the localizer and the recognizer hold every element of an image, a dense drawing has thousands:
+
+    {"<image file>": {"elements": [{"guid", "class_id", "confidence", "bbox_xyxy_abs": [x1, y1, x2, y2], "text"}, ...]}}
+
+the query params of the result endpoints narrow the "elements" lists down to what the client shows:
+
+    class           class ids, comma separated (?class=0,2)
+    min_confidence  elements with at least this confidence (?min_confidence=0.8)
+    bbox            elements intersecting the viewport x1,y1,x2,y2 in image pixels (?bbox=0,0,1200,800)
+    text            elements whose text contains this, case-insensitive (?text=büro)
+    element_fields  keys kept of every element, comma separated (?element_fields=guid,bbox_xyxy_abs)
+
+the rest of a result (e.g. "visual_result_path", the "fields" of the interpreter) is returned as is.
+"""
+from rest_framework.exceptions import ValidationError
+
+
+class ElementFilter:
+
+    def __init__(self, classes=None, min_confidence=None, bbox=None, text=None, fields=None):
+        self.classes = classes
+        self.min_confidence = min_confidence
+        self.bbox = bbox
+        self.text = text
+        self.fields = fields
+
+    @classmethod
+    def from_query_params(cls, query_params):
+        classes = query_params.get("class")
+        min_confidence = query_params.get("min_confidence")
+        bbox = query_params.get("bbox")
+        text = query_params.get("text")
+        fields = query_params.get("element_fields")
+
+        try:
+            min_confidence = float(min_confidence) if min_confidence else None
+        except ValueError:
+            raise ValidationError({"min_confidence": "has to be a number"})
+        if bbox:
+            try:
+                bbox = [float(value) for value in bbox.split(",")]
+            except ValueError:
+                bbox = None
+            if bbox is None or len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+                raise ValidationError({"bbox": "has to be x1,y1,x2,y2 with x1 <= x2 and y1 <= y2"})
+
+        return cls(
+            classes=set(classes.split(",")) if classes else None,
+            min_confidence=min_confidence,
+            bbox=bbox or None,
+            text=text.lower() if text else None,
+            fields=fields.split(",") if fields else None,
+        )
+
+    def is_active(self):
+        return any(value is not None for value in
+                   [self.classes, self.min_confidence, self.bbox, self.text, self.fields])
+
+    def matches(self, element):
+        if self.classes is not None and str(element.get("class_id")) not in self.classes:
+            return False
+        if self.min_confidence is not None:
+            # the localizer writes the confidence as a string
+            try:
+                if float(element.get("confidence")) < self.min_confidence:
+                    return False
+            except (TypeError, ValueError):
+                return False
+        if self.bbox is not None:
+            box = element.get("bbox_xyxy_abs")
+            if not box or len(box) != 4:
+                return False
+            x1, y1, x2, y2 = self.bbox
+            if box[0] > x2 or box[2] < x1 or box[1] > y2 or box[3] < y1:
+                return False
+        if self.text is not None and self.text not in str(element.get("text") or "").lower():
+            return False
+        return True
+
+    def project(self, element):
+        if self.fields is None:
+            return element
+        return {key: element[key] for key in self.fields if key in element}
+
+    # the result with its "elements" lists filtered, wherever they are in it (the result itself is not changed)
+    def apply(self, result):
+        if not self.is_active():
+            return result
+        if isinstance(result, list):
+            return [self.apply(item) for item in result]
+        if not isinstance(result, dict):
+            return result
+
+        filtered = {}
+        for key, value in result.items():
+            if key == "elements" and isinstance(value, list):
+                filtered[key] = [self.project(element) for element in value
+                                 if isinstance(element, dict) and self.matches(element)]
+            else:
+                filtered[key] = self.apply(value)
+        return filtered
@@ -0,0 +1,131 @@
+"""
+fair-share scheduling of the bulk processing runs (see "dispatch_processing" in views.py)
+
+instead of sending all the tasks of a big project to the bulk queue at once, the runs (one per image
+or batch of images) are kept per customer in redis and only CHAIN_BULK_MAX_IN_FLIGHT of them are in
+the bulk queue at a time. free slots are handed out round-robin over the customers with pending runs,
+a customer gets as many runs per turn as the weight of their plan (CHAIN_PLAN_WEIGHTS).
+a slot is freed when its run finishes or fails ("release"), or after CHAIN_FAIR_SLOT_TIMEOUT seconds.
+the runs of a cancelled project run (see utility/project_runs.py) are taken out and their slots freed ("cancel").
+"""
+import json
+import time
+from uuid import uuid4
+
+from celery import current_app
+from django.conf import settings
+
+from .redis_client import get_redis
+
+
+KEY_RING = "fair:ring"  # customer ids with pending runs, in round-robin order
+KEY_ACTIVE = "fair:active"  # set of the customer ids in the ring
+KEY_WEIGHTS = "fair:weights"  # customer id -> runs per turn
+KEY_CREDITS = "fair:credits"  # customer id -> runs left in the current turn
+KEY_PENDING = "fair:pending:{}"  # pending runs of a customer
+KEY_IN_FLIGHT = "fair:in_flight"  # slot token -> dispatch time
+KEY_RUN_SLOTS = "fair:run_slots:{}"  # project run id -> slot token -> celery task id of the dispatched run
+KEY_LOCK = "fair:lock"
+
+
+def plan_weight(plan):
+    return settings.CHAIN_PLAN_WEIGHTS.get(plan, 1)
+
+
+# queues a run (celery task name, args and kwargs) of a customer, it gets the "queue" and "fair_token" kwargs when dispatched
+def submit(customer_id, plan, task_name, args, kwargs=None):
+    r = get_redis()
+    with r.lock(KEY_LOCK, timeout=30, blocking_timeout=10):
+        entry = {"task": task_name, "args": args, "kwargs": kwargs or {}}
+        r.rpush(KEY_PENDING.format(customer_id), json.dumps(entry))
+        r.hset(KEY_WEIGHTS, customer_id, plan_weight(plan))
+        if r.sadd(KEY_ACTIVE, customer_id):
+            r.rpush(KEY_RING, customer_id)
+        dispatch_locked(r)
+
+
+def release(fair_token):
+    r = get_redis()
+    with r.lock(KEY_LOCK, timeout=30, blocking_timeout=10):
+        r.zrem(KEY_IN_FLIGHT, fair_token)
+        dispatch_locked(r)
+
+
+def dispatch():
+    r = get_redis()
+    with r.lock(KEY_LOCK, timeout=30, blocking_timeout=10):
+        dispatch_locked(r)
+
+
+def dispatch_locked(r):
+    # slots of runs that never reported back (e.g. a killed worker) are freed after a while
+    r.zremrangebyscore(KEY_IN_FLIGHT, 0, time.time() - settings.CHAIN_FAIR_SLOT_TIMEOUT)
+    free_slots = settings.CHAIN_BULK_MAX_IN_FLIGHT - r.zcard(KEY_IN_FLIGHT)
+
+    while free_slots > 0:
+        customer_id = r.lindex(KEY_RING, 0)
+        if customer_id is None:
+            break
+        customer_id = customer_id.decode()
+        pending_key = KEY_PENDING.format(customer_id)
+
+        # the customer at the head of the ring keeps the turn until it used up its weight
+        credits = int(r.hget(KEY_CREDITS, customer_id) or 0)
+        if credits <= 0:
+            credits = int(r.hget(KEY_WEIGHTS, customer_id) or 1)
+
+        entry = r.lpop(pending_key)
+        if entry is not None:
+            entry = json.loads(entry)
+            fair_token = uuid4().hex
+            r.zadd(KEY_IN_FLIGHT, {fair_token: time.time()})
+            result = current_app.send_task(entry["task"], args=entry["args"],
+                                           kwargs={**entry.get("kwargs", {}), "queue": settings.CHAIN_BULK_QUEUE, "fair_token": fair_token},
+                                           queue=settings.CHAIN_BULK_QUEUE)
+            run_id = entry.get("kwargs", {}).get("run_id")
+            if run_id:
+                r.hset(KEY_RUN_SLOTS.format(run_id), fair_token, result.id)
+                r.expire(KEY_RUN_SLOTS.format(run_id), settings.CHAIN_FAIR_SLOT_TIMEOUT)
+            free_slots -= 1
+            credits -= 1
+
+        if not r.llen(pending_key):
+            # nothing left, out of the ring
+            r.lpop(KEY_RING)
+            r.srem(KEY_ACTIVE, customer_id)
+            r.hdel(KEY_CREDITS, customer_id)
+        elif credits <= 0:
+            # turn is over, to the end of the ring
+            r.lpop(KEY_RING)
+            r.rpush(KEY_RING, customer_id)
+            r.hdel(KEY_CREDITS, customer_id)
+        else:
+            r.hset(KEY_CREDITS, customer_id, credits)
+
+
+# takes the pending runs of a project run out and frees the slots of its dispatched runs,
+# returns the celery task ids of the dispatched runs (to revoke)
+def cancel(customer_id, run_id):
+    r = get_redis()
+    with r.lock(KEY_LOCK, timeout=30, blocking_timeout=10):
+        pending_key = KEY_PENDING.format(customer_id)
+        for entry in r.lrange(pending_key, 0, -1):
+            if json.loads(entry).get("kwargs", {}).get("run_id") == run_id:
+                r.lrem(pending_key, 0, entry)
+
+        slots = r.hgetall(KEY_RUN_SLOTS.format(run_id))
+        if slots:
+            r.zrem(KEY_IN_FLIGHT, *slots.keys())
+        r.delete(KEY_RUN_SLOTS.format(run_id))
+        dispatch_locked(r)
+    return [task_id.decode() for task_id in slots.values()]
+
+
+def pending_counts():
+    r = get_redis()
+    return {customer_id.decode(): r.llen(KEY_PENDING.format(customer_id.decode()))
+            for customer_id in r.smembers(KEY_ACTIVE)}
+
+
+def in_flight_count():
+    return get_redis().zcard(KEY_IN_FLIGHT)
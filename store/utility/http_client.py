@@ -0,0 +1,68 @@
+"""
+pooled HTTP client for the AI chain module calls (see tasks.py)
+
+every celery worker process keeps one requests.Session per module URL, so the TCP connection
+(and the TLS handshake for https modules) is set up once and reused by all the following
+stages calling the same module. the sessions are dropped when a new worker process starts
+(see "worker_process_init" in project/celery.py), a forked process must not share the sockets of its parent.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+
+_lock = threading.Lock()
+# module url -> requests.Session
+_sessions = {}
+
+
+def make_session():
+    retry = Retry(
+        total=settings.CHAIN_MODULE_MAX_RETRIES,
+        connect=settings.CHAIN_MODULE_MAX_RETRIES,
+        # a module that timed out reading may still be working on the upload, waiting CHAIN_MODULE_READ_TIMEOUT
+        # again for every retry would hold the call for far too long: read timeouts are left to the task retries
+        read=0,
+        backoff_factor=settings.CHAIN_MODULE_RETRY_BACKOFF,
+        status_forcelist=[502, 503, 504],
+        # the modules only compute a result from the posted file, so repeating a POST is safe
+        allowed_methods=None,
+        # give the last response back instead of raising, the tasks check the status code themselves
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.CHAIN_MODULE_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(module_url):
+    session = _sessions.get(module_url)
+    if session is None:
+        with _lock:
+            session = _sessions.get(module_url)
+            if session is None:
+                session = make_session()
+                _sessions[module_url] = session
+    return session
+
+
+# POST to a chain module through the pooled session of its URL, with the configured timeouts
+def post_to_module(module_url, files):
+    timeout = (settings.CHAIN_MODULE_CONNECT_TIMEOUT, settings.CHAIN_MODULE_READ_TIMEOUT)
+    return get_session(module_url).post(module_url, files=files, timeout=timeout)
+
+
+def clear():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
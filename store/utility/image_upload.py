@@ -0,0 +1,152 @@
+"""
+streaming upload of project images (see "images_bulk" in views.py)
+
+the default upload handlers keep every uploaded file in memory or in a temporary file, and the file is copied
+to MEDIA_ROOT only when its Image is saved. this upload handler writes the "images" of a multipart request
+straight to their final place in MEDIA_ROOT (project_<id>/<uuid>.<ext>) while the request is read:
+the chunks go to a writer thread, so receiving the next chunk does not wait for the disk.
+the Image rows are created by the view afterwards, all at once.
+
+the resumable uploads (see "uploads" in views.py) left without a chunk for IMAGE_UPLOAD_EXPIRY_HOURS are removed
+with their part files by a periodic task ("remove_abandoned_uploads").
+"""
+import glob
+import os
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.exceptions import ValidationError
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from django.utils import timezone
+
+from ..validators import check_image_size
+
+
+IMAGE_TYPES = ['png', 'jpg']
+# chunks received but not written yet, bounds the memory used when the disk is slower than the network
+MAX_PENDING_CHUNKS = 16
+
+
+# an uploaded image already stored in MEDIA_ROOT, stored_name is its path relative to MEDIA_ROOT
+class StoredImage(UploadedFile):
+
+    def __init__(self, stored_name, name, content_type, size):
+        super().__init__(file=None, name=name, content_type=content_type, size=size)
+        self.stored_name = stored_name
+
+
+class StreamingImageUploadHandler(FileUploadHandler):
+
+    def __init__(self, request, project_id, field_name='images'):
+        super().__init__(request)
+        self.project_id = project_id
+        self.images_field_name = field_name
+        self.project_dir = os.path.join(settings.MEDIA_ROOT, f'project_{project_id}')
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending_chunks = threading.BoundedSemaphore(MAX_PENDING_CHUNKS)
+        self.write_errors = []
+        # original names of the rejected files (not png/jpg, too big)
+        self.bad_images = []
+        # paths of the files written by this upload, removed if it does not complete
+        self.written_paths = []
+        self.file = None
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        if field_name != self.images_field_name:
+            return  # not an image, left to the default handlers
+
+        self.file = None
+        self.size = 0
+        image_ext = file_name.split(".")[-1].lower()
+        if image_ext not in IMAGE_TYPES:
+            self.bad_images.append(file_name)
+        else:
+            self.stored_name = os.path.join(f'project_{self.project_id}', f"{uuid4()}.{image_ext}")
+            self.path = os.path.join(settings.MEDIA_ROOT, self.stored_name)
+            os.makedirs(self.project_dir, exist_ok=True)
+            self.file = open(self.path, 'wb')
+            self.written_paths.append(self.path)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.field_name != self.images_field_name:
+            return raw_data
+        if self.file is None:
+            return None  # rejected file, its data is dropped
+
+        self.size += len(raw_data)
+        try:
+            check_image_size(self.size)
+        except ValidationError:
+            self.bad_images.append(self.file_name)
+            self.writer.submit(self.discard, self.file, self.path)
+            self.file = None
+            return None
+
+        self.pending_chunks.acquire()
+        self.writer.submit(self.write, self.file, raw_data)
+        return None
+
+    def write(self, file, data):
+        try:
+            file.write(data)
+        except OSError as e:
+            self.write_errors.append(e)
+        finally:
+            self.pending_chunks.release()
+
+    def discard(self, file, path):
+        file.close()
+        os.remove(path)
+
+    def file_complete(self, file_size):
+        if self.field_name != self.images_field_name or self.file is None:
+            return None
+        self.writer.submit(self.file.close)
+        self.file = None
+        return StoredImage(self.stored_name, self.file_name, self.content_type, self.size)
+
+    # waits for the last writes, raises if one of them failed
+    def upload_complete(self):
+        self.writer.shutdown(wait=True)
+        if self.write_errors:
+            self.remove_written_files()
+            raise self.write_errors[0]
+
+    def upload_interrupted(self):
+        self.writer.shutdown(wait=True)
+        self.remove_written_files()
+
+    def remove_written_files(self):
+        for path in self.written_paths:
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+# the resumable uploads without a chunk since IMAGE_UPLOAD_EXPIRY_HOURS, and the part files left without an upload
+# (e.g. the row was deleted by hand), returns the number of removed uploads and files
+def remove_abandoned_uploads():
+    from ..models import ImageUpload
+
+    expiry = timedelta(hours=settings.IMAGE_UPLOAD_EXPIRY_HOURS)
+    removed = 0
+    for upload in ImageUpload.objects.filter(updated_at__lt=timezone.now() - expiry):
+        upload.delete()
+        removed += 1
+
+    tokens = {str(token) for token in ImageUpload.objects.values_list('token', flat=True)}
+    for part_path in glob.glob(os.path.join(settings.MEDIA_ROOT, 'project_*', 'uploads', '*.part')):
+        token = os.path.basename(part_path)[:-len('.part')]
+        try:
+            if token not in tokens and os.path.getmtime(part_path) < time.time() - expiry.total_seconds():
+                os.remove(part_path)
+                removed += 1
+        except OSError as e:
+            print(f"part file {part_path} not removed: {e}")
+    return removed
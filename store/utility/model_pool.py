@@ -0,0 +1,67 @@
+"""
+process-resident pool of the integrated AI models
+
+loading YOLOv7 and PARSeq costs more than running them on a typical floor plan, so every celery
+worker process loads them once (see "worker_process_init" in project/celery.py) and all the
+"process_image" tasks running in that process reuse the same instances.
+
+the pool is lazy as well: if the models were not warmed up (e.g. a solo/threads pool where
+"worker_process_init" is never sent), the first task loads them and the following ones reuse them.
+"""
+import logging
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_parseq = None
+# weights path -> in-process yolov7 detector (src/detector.py)
+_detectors = {}
+
+
+def get_device():
+    import torch
+    return torch.device(settings.AI_MODEL_DEVICE)
+
+
+def get_parseq():
+    global _parseq
+    if _parseq is None:
+        with _lock:
+            if _parseq is None:
+                import torch
+                logger.info("model pool: loading PARSeq")
+                parseq = torch.hub.load('baudm/parseq', 'parseq', pretrained=True).eval()
+                _parseq = parseq.to(get_device())
+    return _parseq
+
+
+def get_detector(weights):
+    detector = _detectors.get(weights)
+    if detector is None:
+        with _lock:
+            detector = _detectors.get(weights)
+            if detector is None:
+                from src.detector import Detector
+
+                logger.info(f"model pool: loading YOLOv7 weights {weights}")
+                detector = Detector(weights, device=settings.AI_MODEL_DEVICE)
+                _detectors[weights] = detector
+    return detector
+
+
+# load all the given yolov7 weights and PARSeq into the current process
+def warm_up(weights_paths):
+    for weights in weights_paths:
+        get_detector(weights)
+    get_parseq()
+
+
+def clear():
+    global _parseq
+    with _lock:
+        _parseq = None
+        _detectors.clear()
@@ -0,0 +1,75 @@
+"""
+distributed concurrency limit of the AI chain modules (AiChainModule.max_concurrency)
+
+the calls running against a module hold a slot in a redis sorted set (token -> start time), shared by all the
+workers. a call takes a slot if at most max_concurrency calls are in the set once it is added, the add and the count
+run in one transaction (MULTI/EXEC). a call that finds the module saturated raises ModuleBusy, the tasks then retry later instead of failing
+(see tasks.py). slots of calls that never released them (e.g. a killed worker) expire after CHAIN_MODULE_SLOT_TIMEOUT seconds.
+"""
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+
+from .redis_client import get_redis
+
+
+KEY_SLOTS = "module_slots:{}"
+
+
+# the module is saturated (all its slots are taken or it answered 429/503), try again later
+class ModuleBusy(Exception):
+    pass
+
+
+def try_acquire(module):
+    r = get_redis()
+    key = KEY_SLOTS.format(module.id)
+    token = uuid4().hex
+    # the clock of redis, the workers' clocks may differ. only used to expire the slots: read before the transaction,
+    # it can be older than the start time of a call added meanwhile
+    seconds, microseconds = r.time()
+    now = seconds + microseconds / 1e6
+
+    pipe = r.pipeline(transaction=True)
+    pipe.zremrangebyscore(key, 0, now - settings.CHAIN_MODULE_SLOT_TIMEOUT)
+    pipe.zadd(key, {token: now})
+    pipe.zcard(key)
+    in_use = pipe.execute()[-1]
+
+    # the calls added before (in their own transaction) hold the slots. a call counted here that gives its slot
+    # up right after can make this one give up as well, never both take the last slot
+    if in_use <= module.max_concurrency:
+        return token
+    r.zrem(key, token)
+    return None
+
+
+def release(module, token):
+    get_redis().zrem(KEY_SLOTS.format(module.id), token)
+
+
+# holds a slot of the module while calling it, waits up to wait_seconds for a free one
+@contextmanager
+def module_slot(module, wait_seconds=0):
+    if not module.max_concurrency:
+        yield
+        return
+
+    deadline = time.time() + wait_seconds
+    token = try_acquire(module)
+    while token is None:
+        if time.time() >= deadline:
+            raise ModuleBusy(f"module {module.name} is saturated ({module.max_concurrency} concurrent calls)")
+        time.sleep(settings.CHAIN_MODULE_SLOT_POLL_INTERVAL)
+        token = try_acquire(module)
+
+    try:
+        yield
+    finally:
+        release(module, token)
+
+
+def in_use(module):
+    return get_redis().zcard(KEY_SLOTS.format(module.id))
@@ -0,0 +1,136 @@
+"""
+processing progress counters of a project, kept in one redis hash and two sets per project
+
+    total     images of the project
+    done      images with a result: the ones done before the last start, and the set of the images done since
+    failed    the set of the images whose run failed since the last start
+    stage_<i> completions of stage i (since the last start)
+
+the images of a run are counted by id, an image reported twice (e.g. a task delivered again) is counted once.
+
+the counters are set when a run starts (see "start" and "start_rest" in views.py), counted up by the tasks
+(see progress_events.py) and follow the uploaded and deleted images. a project without counters (a redis
+restart, a project never started) gets them from the database once, the status checks of the project
+(Project.update_status_based_on_images) and the progress endpoint then read only the counters.
+without redis the counters are left out and the images are counted in the database as before.
+"""
+import functools
+
+from .redis_client import get_redis
+
+
+KEY = "project_progress:{}"
+KEY_DONE = "project_progress:{}:done"  # ids of the images done since the last start
+KEY_FAILED = "project_progress:{}:failed"  # ids of the images failed since the last start
+STAGE_FIELD = "stage_{}"
+
+
+def key_name(project_id):
+    return KEY.format(project_id)
+
+
+def key_names(project_id):
+    return [KEY.format(project_id), KEY_DONE.format(project_id), KEY_FAILED.format(project_id)]
+
+
+# the counters are only bookkeeping, updating them never fails the calling request or task
+def never_fails(update):
+    @functools.wraps(update)
+    def wrapper(project_id, *args, **kwargs):
+        try:
+            update(project_id, *args, **kwargs)
+        except Exception as e:
+            print(f"progress counters of project {project_id} not updated: {e}")
+    return wrapper
+
+
+# a new run of the project: the images not to be processed again are done already, the stages start over
+@never_fails
+def reset(project_id, total, done=0):
+    r = get_redis()
+    pipe = r.pipeline()
+    pipe.delete(*key_names(project_id))
+    pipe.hset(key_name(project_id), mapping={"total": total, "done": done})
+    pipe.execute()
+
+
+def count_images(project):
+    from ..models import Image
+
+    images = Image.objects.filter(project=project)
+    return {"total": images.count(), "done": images.filter(has_result=True).count()}
+
+
+# {"total", "done", "failed", "stages": {stage: completions}}
+def get(project):
+    try:
+        r = get_redis()
+        pipe = r.pipeline()
+        pipe.hgetall(key_name(project.id))
+        pipe.scard(KEY_DONE.format(project.id))
+        pipe.scard(KEY_FAILED.format(project.id))
+        values, done_since_start, failed = pipe.execute()
+        if b"total" not in values:
+            # the image counters from the database, they include the images done since the start.
+            # the stage counters and the failed images (if any) are kept
+            pipe = r.pipeline()
+            pipe.hset(key_name(project.id), mapping=count_images(project))
+            pipe.delete(KEY_DONE.format(project.id))
+            pipe.hgetall(key_name(project.id))
+            values, done_since_start = pipe.execute()[-1], 0
+    except Exception as e:
+        print(f"progress counters of project {project.id} not available: {e}")
+        return {**count_images(project), "failed": 0, "stages": {}}
+
+    counts = {"total": 0, "done": 0, "failed": failed, "stages": {}}
+    for field, value in values.items():
+        field = field.decode()
+        if field.startswith("stage_"):
+            counts["stages"][int(field[len("stage_"):])] = int(value)
+        elif field in ("total", "done"):
+            counts[field] = int(value)
+    counts["done"] += done_since_start
+    return counts
+
+
+# uploads and deletions only change existing counters, a project without counters gets them with the next get()
+@never_fails
+def add_images(project_id, count):
+    r = get_redis()
+    if r.exists(key_name(project_id)):
+        r.hincrby(key_name(project_id), "total", count)
+
+
+@never_fails
+def remove_image(project_id, image_id, had_result):
+    r = get_redis()
+    if r.exists(key_name(project_id)):
+        pipe = r.pipeline()
+        pipe.hincrby(key_name(project_id), "total", -1)
+        pipe.srem(KEY_FAILED.format(project_id), image_id)
+        # done since the start, or before it
+        if not r.srem(KEY_DONE.format(project_id), image_id) and had_result:
+            pipe.hincrby(key_name(project_id), "done", -1)
+        pipe.execute()
+
+
+@never_fails
+def stage_done(project_id, stage):
+    if isinstance(stage, int):
+        get_redis().hincrby(key_name(project_id), STAGE_FIELD.format(stage), 1)
+
+
+@never_fails
+def image_done(project_id, image_id, success=True):
+    pipe = get_redis().pipeline()
+    if success:
+        pipe.sadd(KEY_DONE.format(project_id), image_id)
+        pipe.srem(KEY_FAILED.format(project_id), image_id)
+    else:
+        pipe.sadd(KEY_FAILED.format(project_id), image_id)
+    pipe.execute()
+
+
+@never_fails
+def clear(project_id):
+    get_redis().delete(*key_names(project_id))
@@ -0,0 +1,49 @@
+"""
+processing progress events of a project, published over redis pub/sub by the tasks
+and pushed to the browsers by the server-sent events endpoint (see store/events.py).
+the stage and image events are counted in the progress counters of the project as well (see progress_counters.py)
+
+events (json):
+    {"type": "stage", "project_id", "image_id", "result_set_id", "stage", "module_id"}  a module is done with an image
+    {"type": "image", "project_id", "image_id", "success"}                              an image is done
+"""
+import json
+
+from .redis_client import get_redis
+from . import progress_counters
+
+
+CHANNEL = "project_events:{}"
+
+
+def channel_name(project_id):
+    return CHANNEL.format(project_id)
+
+
+# never fails the calling task, the events are only a notification
+def publish(project_id, event):
+    event = {**event, "project_id": project_id}
+    try:
+        get_redis().publish(channel_name(project_id), json.dumps(event))
+    except Exception as e:
+        print(f"progress event of project {project_id} not published: {e}")
+
+
+def stage_done(project_id, image_id, chain_result_set_id, stage, module_id):
+    progress_counters.stage_done(project_id, stage)
+    publish(project_id, {
+        "type": "stage",
+        "image_id": image_id,
+        "result_set_id": chain_result_set_id,
+        "stage": stage,
+        "module_id": module_id,
+    })
+
+
+def image_done(project_id, image_id, success=True):
+    progress_counters.image_done(project_id, image_id, success)
+    publish(project_id, {
+        "type": "image",
+        "image_id": image_id,
+        "success": success,
+    })
@@ -0,0 +1,97 @@
+"""
+processing runs of a project (see "start", "start_rest" and "cancel" in views.py)
+
+every start of a project begins a new run with an id of its own (Project.run_id), passed along to all the tasks
+of the run. a task of a run that is no longer the current run of its project (cancelled, or preempted by a newer
+start) stops before calling a module and before writing a result, so an old run never mixes its outputs with the
+new one. cancelling a run also revokes its tasks not started yet and takes its runs waiting in the fair scheduler out.
+
+the tasks check their run before every module call, the current run of a project is cached in redis ("set_current",
+called while the project row is locked) instead of reading the project every time.
+"""
+from uuid import uuid4
+
+from celery import current_app
+
+from .redis_client import get_redis
+from . import fair_scheduler
+
+
+KEY_TASKS = "project_run_tasks:{}"  # run id -> celery task ids of the runs sent to the interactive lane
+TASKS_TTL = 24 * 60 * 60
+KEY_CURRENT = "project_run_current:{}"  # project id -> id of its current run, "" without one
+CURRENT_TTL = 24 * 60 * 60
+
+
+class RunCancelled(Exception):
+    pass
+
+
+def new_run_id():
+    return uuid4().hex
+
+
+# to be called with the project row locked, after changing its run id (None: no run in progress)
+def set_current(project_id, run_id):
+    try:
+        get_redis().set(KEY_CURRENT.format(project_id), run_id or "", ex=CURRENT_TTL)
+    except Exception as e:
+        print(f"current run of project {project_id} not cached: {e}")
+
+
+def current_from_db(project_id):
+    from ..models import Project
+
+    return Project.objects.filter(id=project_id).values_list('run_id', flat=True).first()
+
+
+# tasks sent without a run id (e.g. queued before the run tracking) are not checked
+def is_current(project_id, run_id):
+    if run_id is None:
+        return True
+    try:
+        r = get_redis()
+        current = r.get(KEY_CURRENT.format(project_id))
+        if current is None:
+            current = current_from_db(project_id) or ""
+            # nx: a run started meanwhile (set_current) is not overwritten with the run read before it
+            r.set(KEY_CURRENT.format(project_id), current, ex=CURRENT_TTL, nx=True)
+            return current == run_id
+        return current.decode() == run_id
+    except Exception as e:
+        print(f"current run of project {project_id} not cached: {e}")
+        return current_from_db(project_id) == run_id
+
+
+def check(project_id, run_id):
+    if not is_current(project_id, run_id):
+        raise RunCancelled(f"run {run_id} of project {project_id} is cancelled")
+
+
+# the tracking is only needed to revoke the tasks early, the tasks of a cancelled run stop by themselves (check)
+def track(run_id, task_ids):
+    if not task_ids:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        pipe.sadd(KEY_TASKS.format(run_id), *task_ids)
+        pipe.expire(KEY_TASKS.format(run_id), TASKS_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f"tasks of run {run_id} not tracked: {e}")
+
+
+# revokes the tasks of a run, to be called after the run is no longer the current run of its project
+def cancel(customer_id, run_id):
+    task_ids = []
+    try:
+        r = get_redis()
+        task_ids += [task_id.decode() for task_id in r.smembers(KEY_TASKS.format(run_id))]
+        r.delete(KEY_TASKS.format(run_id))
+        task_ids += fair_scheduler.cancel(customer_id, run_id)
+    except Exception as e:
+        print(f"tasks of run {run_id} not revoked: {e}")
+
+    if task_ids:
+        current_app.control.revoke(task_ids)
+    return task_ids
@@ -0,0 +1,46 @@
+"""
+time the processing tasks wait in their celery queue: the publish time is added to the message
+headers ("before_task_publish") and compared to the start of the task ("task_prerun"), see project/celery.py.
+the numbers are summed up per queue in redis.
+"""
+import logging
+import time
+
+from .redis_client import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+KEY_QUEUE_WAIT = "metrics:queue_wait:{}"
+KEY_QUEUES = "metrics:queues"
+
+
+def record_queue_wait(queue, seconds):
+    logger.info(f"queue wait: {queue} {seconds:.3f}s")
+    r = get_redis()
+    key = KEY_QUEUE_WAIT.format(queue)
+    pipe = r.pipeline()
+    pipe.sadd(KEY_QUEUES, queue)
+    pipe.hincrby(key, "count", 1)
+    pipe.hincrbyfloat(key, "total_seconds", seconds)
+    pipe.hset(key, "last_seconds", seconds)
+    pipe.hset(key, "last_at", time.time())
+    pipe.execute()
+    # not atomic with the above, good enough for a metric
+    if seconds > float(r.hget(key, "max_seconds") or 0):
+        r.hset(key, "max_seconds", seconds)
+
+
+def queue_wait_stats():
+    r = get_redis()
+    stats = {}
+    for queue in sorted(q.decode() for q in r.smembers(KEY_QUEUES)):
+        values = {k.decode(): float(v) for k, v in r.hgetall(KEY_QUEUE_WAIT.format(queue)).items()}
+        count = int(values.get("count", 0))
+        stats[queue] = {
+            "count": count,
+            "avg_seconds": values.get("total_seconds", 0) / count if count else 0,
+            "max_seconds": values.get("max_seconds", 0),
+            "last_seconds": values.get("last_seconds", 0),
+        }
+    return stats
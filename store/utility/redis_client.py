@@ -0,0 +1,27 @@
+"""
+shared redis connection of the processing bookkeeping (fair scheduler, queue metrics, ...),
+one client (with its own connection pool) per process
+"""
+import threading
+
+from django.conf import settings
+
+
+_lock = threading.Lock()
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        with _lock:
+            if _redis is None:
+                import redis
+                _redis = redis.Redis.from_url(settings.PROCESSING_REDIS_URL)
+    return _redis
+
+
+def clear():
+    global _redis
+    with _lock:
+        _redis = None
@@ -0,0 +1,212 @@
+"""
+load balancing of the AI chain module calls over the replicas of a module
+
+a module is served by its module_url and the URLs of its active AiChainModuleReplica entries. every call goes
+to the endpoint with the least outstanding requests (kept in redis over all the workers, a call not finished after
+CHAIN_MODULE_SLOT_TIMEOUT, e.g. of a killed worker, no longer counts). an endpoint
+failing CHAIN_REPLICA_EJECT_AFTER_FAILURES times in a row (connection errors, 5xx) is ejected for
+CHAIN_REPLICA_EJECT_SECONDS, a call failing to connect is retried on the next endpoint.
+with CHAIN_REPLICA_HEDGE_PERCENTILE set, a call slower than that percentile of the module's recent latencies
+is sent to a second endpoint as well and the first answer wins. the hedge takes a second slot of a module with a
+max_concurrency (see module_limits.py) and is left out when there is none, the slot is held until the slower
+request is answered too.
+
+a module without replicas is called directly, without any of the bookkeeping.
+"""
+import hashlib
+import random
+import threading
+import time
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait, FIRST_COMPLETED
+
+import requests
+from django.conf import settings
+
+from .http_client import post_to_module
+from .redis_client import get_redis
+from . import module_limits
+
+
+KEY_OUTSTANDING = "replica:outstanding:{}:{}"  # module id, url hash -> requests in progress (token -> start time)
+KEY_FAILURES = "replica:failures:{}"  # module id -> hash url hash -> failures in a row
+KEY_EJECTED = "replica:ejected:{}:{}"  # module id, url hash -> set while the url is ejected
+KEY_LATENCIES = "replica:latencies:{}"  # module id -> recent latencies in seconds
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.CHAIN_REPLICA_HEDGE_THREADS)
+    return _executor
+
+
+def endpoints(module):
+    # a module built from the task payload brings its replica urls along (see module_context in chain_utils.py)
+    replica_urls = getattr(module, 'replica_urls', None)
+    if replica_urls is None:
+        replica_urls = [replica.url for replica in module.replicas.all() if replica.is_active]
+    return [module.module_url] + replica_urls
+
+
+def url_hash(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+def is_ejected(module, url):
+    return get_redis().exists(KEY_EJECTED.format(module.id, url_hash(url)))
+
+
+def redis_time(r):
+    seconds, microseconds = r.time()
+    return seconds + microseconds / 1e6
+
+
+def outstanding_counts(module, urls):
+    r = get_redis()
+    expired = redis_time(r) - settings.CHAIN_MODULE_SLOT_TIMEOUT
+    pipe = r.pipeline()
+    for url in urls:
+        pipe.zremrangebyscore(KEY_OUTSTANDING.format(module.id, url_hash(url)), 0, expired)
+        pipe.zcard(KEY_OUTSTANDING.format(module.id, url_hash(url)))
+    return pipe.execute()[1::2]
+
+
+# the endpoint with the least outstanding requests, leaving out the ejected ones (unless all of them are)
+def choose(module, urls, exclude=()):
+    candidates = [url for url in urls if url not in exclude]
+    healthy = [url for url in candidates if not is_ejected(module, url)]
+    candidates = healthy or candidates
+
+    outstanding = outstanding_counts(module, candidates)
+    least = min(outstanding)
+    return random.choice([url for url, count in zip(candidates, outstanding) if count == least])
+
+
+def record_success(module, url, seconds):
+    r = get_redis()
+    pipe = r.pipeline()
+    pipe.hdel(KEY_FAILURES.format(module.id), url_hash(url))
+    pipe.lpush(KEY_LATENCIES.format(module.id), seconds)
+    pipe.ltrim(KEY_LATENCIES.format(module.id), 0, settings.CHAIN_REPLICA_LATENCY_WINDOW - 1)
+    pipe.execute()
+
+
+def record_failure(module, url):
+    r = get_redis()
+    failures = r.hincrby(KEY_FAILURES.format(module.id), url_hash(url), 1)
+    if failures >= settings.CHAIN_REPLICA_EJECT_AFTER_FAILURES:
+        r.set(KEY_EJECTED.format(module.id, url_hash(url)), 1, ex=settings.CHAIN_REPLICA_EJECT_SECONDS)
+        r.hdel(KEY_FAILURES.format(module.id), url_hash(url))
+        print(f"replica {url} of module {module.name} ejected for {settings.CHAIN_REPLICA_EJECT_SECONDS}s")
+
+
+# seconds after which a call is hedged, None if hedging is off or there are not enough samples yet
+def hedge_delay(module):
+    if settings.CHAIN_REPLICA_HEDGE_PERCENTILE is None:
+        return None
+    latencies = sorted(float(seconds) for seconds in get_redis().lrange(KEY_LATENCIES.format(module.id), 0, -1))
+    if len(latencies) < settings.CHAIN_REPLICA_HEDGE_MIN_SAMPLES:
+        return None
+    index = min(len(latencies) - 1, int(len(latencies) * settings.CHAIN_REPLICA_HEDGE_PERCENTILE / 100))
+    return latencies[index]
+
+
+def timed_post(module, url, make_files):
+    r = get_redis()
+    files, opened_files = make_files()
+    call_token = uuid4().hex
+    r.zadd(KEY_OUTSTANDING.format(module.id, url_hash(url)), {call_token: redis_time(r)})
+    start = time.time()
+    try:
+        response = post_to_module(url, files)
+    except requests.exceptions.RequestException:
+        record_failure(module, url)
+        raise
+    finally:
+        r.zrem(KEY_OUTSTANDING.format(module.id, url_hash(url)), call_token)
+        for f in opened_files:
+            f.close()
+
+    if response.status_code >= 500 and response.status_code != 503:
+        record_failure(module, url)
+    elif response.status_code == 200:
+        record_success(module, url, time.time() - start)
+    return response
+
+
+# the hedge holds its slot until both requests are answered, a request cannot be stopped once it is sent:
+# whichever of the two is still running after the call returned runs on this slot
+def release_when_done(module, slot_token, futures):
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            module_limits.release(module, slot_token)
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def hedged_post(module, url, urls, tried, make_files, hedge_after):
+    primary = get_executor().submit(timed_post, module, url, make_files)
+    try:
+        return primary.result(timeout=hedge_after)
+    except FuturesTimeout:
+        pass
+
+    # the call already holds a slot of the module (see post_to_module_batch in tasks.py), the hedge needs one more
+    slot_token = None
+    if module.max_concurrency:
+        slot_token = module_limits.try_acquire(module)
+        if slot_token is None:
+            return primary.result()
+
+    hedge_url = choose(module, urls, exclude=tried)
+    tried.append(hedge_url)
+    hedge = get_executor().submit(timed_post, module, hedge_url, make_files)
+    if slot_token is not None:
+        release_when_done(module, slot_token, [primary, hedge])
+
+    done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+    first = done.pop()
+    if first.exception() is None and first.result().status_code == 200:
+        return first.result()
+    # the first answer failed, the other one decides
+    return (hedge if first is primary else primary).result()
+
+
+# POSTs to an endpoint of the module, make_files() returns the files of the request and the opened files
+# to close afterwards (called once per attempt, a retried or hedged call needs its own file objects)
+def post(module, make_files):
+    urls = endpoints(module)
+    if len(urls) == 1:
+        files, opened_files = make_files()
+        try:
+            return post_to_module(urls[0], files)
+        finally:
+            for f in opened_files:
+                f.close()
+
+    hedge_after = hedge_delay(module)
+    tried = []
+    while True:
+        url = choose(module, urls, exclude=tried)
+        tried.append(url)
+        try:
+            if hedge_after is None or len(tried) == len(urls):
+                return timed_post(module, url, make_files)
+            return hedged_post(module, url, urls, tried, make_files, hedge_after)
+        except requests.exceptions.ConnectionError:
+            # not reachable, try the next endpoint
+            if len(tried) >= len(urls):
+                raise
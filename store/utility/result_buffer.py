@@ -0,0 +1,53 @@
+"""
+write-behind persistence of the chain results of the batch processing (see "processing_batch" in tasks.py):
+the results and the finished images are collected and written with one bulk_create / bulk_update per flush
+instead of one query per result and image.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ..models import ChainModuleResult, Image
+from . import progress_events, result_payloads
+
+
+class ResultBuffer:
+
+    def __init__(self, flush_size=None):
+        self.flush_size = flush_size or settings.CHAIN_RESULT_FLUSH_SIZE
+        self.results = []
+        self.finished_images = []
+
+    def add_result(self, **fields):
+        self.results.append(ChainModuleResult(**fields))
+        if len(self.results) >= self.flush_size:
+            self.flush()
+
+    # the image gets has_result with the next flush, together with (after) its last results
+    def finish_image(self, image):
+        image.has_result = True
+        # bulk_update() skips auto_now
+        image.updated_at = timezone.now()
+        self.finished_images.append(image)
+
+    def flush(self):
+        if not self.results and not self.finished_images:
+            return
+        with transaction.atomic():
+            if self.results:
+                ChainModuleResult.objects.bulk_create(self.results)
+            if self.finished_images:
+                Image.objects.bulk_update(self.finished_images, ['has_result', 'updated_at'])
+            # bulk_create skips ChainModuleResult.save()
+            for project_id in {result.project_id for result in self.results}:
+                result_payloads.invalidate(project_id)
+
+        # the progress events go out once the results can be read
+        for result in self.results:
+            progress_events.stage_done(result.project_id, result.result_set.image_id, result.result_set_id,
+                                       result.stage_index, result.module_id)
+        for image in self.finished_images:
+            progress_events.image_done(image.project_id, image.id)
+
+        self.results = []
+        self.finished_images = []
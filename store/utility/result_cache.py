@@ -0,0 +1,59 @@
+"""
+content-hash cache of the AI chain module results (see tasks.py)
+
+a module result is looked up by (sha256 of the input file, module, module version): on a hit the
+stored .json result and .zip output are used instead of posting the file to the module again.
+the cached outputs are kept in MEDIA_ROOT/chain_cache, outside of the project output dirs which
+are deleted when a project is started again.
+"""
+import hashlib
+import os
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from ..models import ChainModuleCacheEntry
+
+
+def file_sha256(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def cache_output_path(module, input_sha256):
+    cache_dir = os.path.join(settings.MEDIA_ROOT, 'chain_cache', f'module_{module.id}')
+    os.makedirs(cache_dir, exist_ok=True)
+    version_sha256 = hashlib.sha256(module.version.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{input_sha256}_{version_sha256}.zip')
+
+
+# returns (result zip bytes, result json) of a cached run of the module on this input, or None
+def lookup(module, input_sha256):
+    entry = ChainModuleCacheEntry.objects.filter(
+        input_sha256=input_sha256, module=module, module_version=module.version).first()
+    if entry is None or not os.path.isfile(entry.output_path):
+        return None
+
+    with open(entry.output_path, 'rb') as f:
+        return f.read(), entry.result
+
+
+def store(module, input_sha256, result_zip, result):
+    output_path = cache_output_path(module, input_sha256)
+    # written next to it and moved into place: a concurrent task storing the same output, or reading it,
+    # never sees a partly written file
+    tmp_path = f'{output_path}.{uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(result_zip)
+    os.replace(tmp_path, output_path)
+
+    try:
+        ChainModuleCacheEntry.objects.update_or_create(
+            input_sha256=input_sha256, module=module, module_version=module.version,
+            defaults={'result': result, 'output_path': output_path})
+    except IntegrityError:
+        pass  # stored by a concurrent task in the meantime
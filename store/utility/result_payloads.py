@@ -0,0 +1,77 @@
+"""
+cache of the rendered chain result payloads (see ChainModuleResultSetViewSet in views.py)
+
+serializing the chain result sets of a project reads every result with its module and image. the rendered payload
+of a request is kept in the "results" cache (RESULT_PAYLOAD_CACHE, redis with LRU eviction, shared by all the
+API processes) together with its ETag, so a hot result page is answered without reading the results again.
+
+the payloads of a project are keyed by a generation token of the project. writing a result set or a result
+(the tasks, see ChainModuleResultSet.save, ChainModuleResult.save and ResultBuffer.flush) gives the project a new
+token once the write is committed: all of its payloads are outdated at once and age out of the cache.
+without the cache the payloads are rendered for every request as before.
+
+the requests with element filters (see element_filters.py) are not cached: every viewport of a client would be a
+payload of its own, pushing the unfiltered payloads of the other clients out of the cache.
+"""
+import hashlib
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .element_filters import ElementFilter
+
+
+KEY_GENERATION = "result_payloads:generation:{}"  # project id -> generation token
+KEY_PAYLOAD = "result_payloads:{}:{}:{}"  # project id, generation token, request path hash -> {"etag", "data"}
+
+
+def get_cache():
+    return caches[settings.RESULT_PAYLOAD_CACHE]
+
+
+def generation(project_id):
+    token = get_cache().get(KEY_GENERATION.format(project_id))
+    if token is None:
+        # the first request of the project, or the token was evicted: a new one, no older payload can match it
+        token = uuid4().hex
+        if not get_cache().add(KEY_GENERATION.format(project_id), token, timeout=None):
+            token = get_cache().get(KEY_GENERATION.format(project_id)) or token
+    return token
+
+
+def payload_key(request, project_id):
+    path_hash = hashlib.sha256(request.get_full_path().encode()).hexdigest()[:32]
+    return KEY_PAYLOAD.format(project_id, generation(project_id), path_hash)
+
+
+# {"etag", "data"} of the request or None, and the key to store the rendered payload under (None without cache)
+def lookup(request, project_id):
+    if ElementFilter.from_query_params(request.query_params).is_active():
+        return None, None
+    try:
+        key = payload_key(request, project_id)
+        return get_cache().get(key), key
+    except Exception as e:
+        print(f"result payload cache not available: {e}")
+        return None, None
+
+
+def store(key, etag, data):
+    if key is None:
+        return
+    try:
+        get_cache().set(key, {"etag": etag, "data": data})
+    except Exception as e:
+        print(f"result payload not cached: {e}")
+
+
+def invalidate(project_id):
+    def new_generation():
+        try:
+            get_cache().set(KEY_GENERATION.format(project_id), uuid4().hex, timeout=None)
+        except Exception as e:
+            print(f"result payloads of project {project_id} not invalidated: {e}")
+    # a request between the write and its commit would cache the payload without the write
+    transaction.on_commit(new_generation)
@@ -0,0 +1,143 @@
+"""
+spatial index over the detected elements of a chain result (see "elements" of ChainModuleResultSetViewSet in views.py)
+
+the elements ("elements" of the localizer and recognizer, with their bbox_xyxy_abs) and the fields of the
+interpreter (room stamps, with their position) of a result are put into a uniform grid of square cells,
+ELEMENT_INDEX_CELL_SIZE pixels wide. every cell is a row of ElementIndexCell with the items intersecting it, found
+through the database index on (result, cx, cy): a viewport or a point only reads the rows of the cells it covers,
+not the whole result.
+
+the boxes are clamped to the image, a box beyond it (or a broken one from a module) does not make cells of its own.
+an item over more than ELEMENT_INDEX_MAX_CELLS_PER_ITEM cells (e.g. a room stamp over the whole drawing) is kept
+in one row outside the grid (WIDE_CELL) instead, read by every query.
+
+the index of a result set is built for its last result by a task once the chain of the image is done
+("build_element_indexes" in tasks.py), a result not indexed yet (e.g. from before the index) gets it with its first query.
+"""
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from PIL import Image as PILImage
+
+from ..models import ChainModuleResult, ElementIndexCell
+
+
+# the cells of the grid are >= 0, the boxes are clamped to the image
+WIDE_CELL = (-1, -1)
+
+
+# [{"kind": "element" | "field", "image": <image file>, "index": <position in its list>, "bbox_xyxy_abs", ...}]
+def indexed_items(result):
+    items = []
+    if not isinstance(result, dict):
+        return items
+    for image_name, image_result in result.items():
+        if not isinstance(image_result, dict):
+            continue
+        for index, element in enumerate(image_result.get("elements") or []):
+            if isinstance(element, dict) and is_box(element.get("bbox_xyxy_abs")):
+                items.append({**element, "kind": "element", "image": image_name, "index": index})
+        for index, field in enumerate(image_result.get("fields") or []):
+            if isinstance(field, dict) and is_box(field.get("position")):
+                items.append({**field, "bbox_xyxy_abs": field["position"],
+                              "kind": "field", "image": image_name, "index": index})
+    return items
+
+
+def is_box(box):
+    return isinstance(box, (list, tuple)) and len(box) == 4 and all(isinstance(v, (int, float)) for v in box)
+
+
+def cell_range(low, high, cell_size):
+    return math.floor(low / cell_size), math.floor(high / cell_size)
+
+
+# (width, height) of the image of the result, read from the header of the file. None if it cannot be read
+def image_size(result):
+    try:
+        with PILImage.open(result.result_set.image.image_local_path()) as picture:
+            return picture.size
+    except Exception as e:
+        print(f"size of the image of result {result.id} not read: {e}")
+        return None
+
+
+# the box inside the image (without its size: inside the positive quadrant), None if nothing of it is left
+def clamp_box(box, size):
+    x1, x2 = sorted([box[0], box[2]])
+    y1, y2 = sorted([box[1], box[3]])
+    width, height = size if size is not None else (math.inf, math.inf)
+    if x2 < 0 or y2 < 0 or x1 > width or y1 > height:
+        return None
+    return max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+
+
+def cells_of(box, cell_size):
+    x_first, x_last = cell_range(box[0], box[2], cell_size)
+    y_first, y_last = cell_range(box[1], box[3], cell_size)
+    if (x_last - x_first + 1) * (y_last - y_first + 1) > settings.ELEMENT_INDEX_MAX_CELLS_PER_ITEM:
+        return [WIDE_CELL]
+    return [(cx, cy) for cx in range(x_first, x_last + 1) for cy in range(y_first, y_last + 1)]
+
+
+def item_key(item):
+    return item["kind"], item["image"], item["index"]
+
+
+def build(result_id):
+    with transaction.atomic():
+        # locked, two first queries of the same result build it once
+        result = ChainModuleResult.objects.select_for_update().select_related('result_set__image').get(id=result_id)
+        if result.element_index_cell_size is not None:
+            return result.element_index_cell_size
+
+        cell_size = settings.ELEMENT_INDEX_CELL_SIZE
+        size = image_size(result)
+        cells = {}
+        for item in indexed_items(result.result):
+            box = clamp_box(item["bbox_xyxy_abs"], size)
+            if box is None:
+                continue
+            for cell in cells_of(box, cell_size):
+                cells.setdefault(cell, []).append(item)
+
+        ElementIndexCell.objects.bulk_create(
+            [ElementIndexCell(result_id=result_id, cx=cx, cy=cy, elements=items) for (cx, cy), items in cells.items()],
+            batch_size=500)
+        ChainModuleResult.objects.filter(id=result_id).update(element_index_cell_size=cell_size)
+        return cell_size
+
+
+# the index of the last result of the sets, a set failing is left to its first query
+def build_for_result_sets(result_set_ids):
+    for result_set_id in result_set_ids:
+        try:
+            result_id = (ChainModuleResult.objects.filter(result_set_id=result_set_id)
+                         .order_by('-id').values_list('id', flat=True).first())
+            if result_id is not None:
+                build(result_id)
+        except Exception as e:
+            print(f"element index of result set {result_set_id} not built: {e}")
+
+
+# the items of the result intersecting element_filter.bbox (all of them without) and matching the rest of the filter
+# (see element_filters.py), in the order of the result
+def query(result_id, cell_size, element_filter):
+    cells = ElementIndexCell.objects.filter(result_id=result_id)
+    if cell_size is None:
+        cell_size = build(result_id)
+    if element_filter.bbox is not None:
+        x1, y1, x2, y2 = element_filter.bbox
+        cells = cells.filter(Q(cx__range=cell_range(x1, x2, cell_size), cy__range=cell_range(y1, y2, cell_size))
+                             | Q(cx=WIDE_CELL[0], cy=WIDE_CELL[1]))
+
+    # an item over several cells is in each of them
+    items = {}
+    for cell_items in cells.values_list('elements', flat=True):
+        for item in cell_items:
+            key = item_key(item)
+            if key not in items and element_filter.matches(item):
+                items[key] = item
+    return [element_filter.project(items[key]) for key in sorted(items)]
@@ -1,6 +1,18 @@
+from django.conf import settings
 from django.core.exceptions import ValidationError
 
-def simgle_image_size_vsalidator(file):
-    max_size_mb = 5
-    if file.size > max_size_mb * 1024 * 1024:
-        raise ValidationError(f"Files cannot be larger than {max_size_mb} MB")
\ No newline at end of file
+# the size of an uploaded image is accounted while it is received, chunk by chunk (see utility/image_upload.py and the
+# resumable uploads in views.py), instead of validating the complete file after it was received and stored:
+# an upload going over the limit is stopped at the chunk crossing it
+
+def check_image_size(received_size, max_size_mb=None):
+    max_size_mb = max_size_mb or settings.IMAGE_MAX_SIZE_MB
+    if received_size > max_size_mb * 1024 * 1024:
+        raise ValidationError(f"Files cannot be larger than {max_size_mb} MB")
+
+
+# a chunk of a resumable upload: has to fit into the length announced when the upload was created
+def check_upload_chunk(upload, received_size):
+    if upload.offset + received_size > upload.length:
+        raise ValidationError(f"the upload is {upload.length} bytes long, the chunk goes beyond it")
+    check_image_size(upload.offset + received_size, settings.IMAGE_RESUMABLE_MAX_SIZE_MB)
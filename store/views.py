@@ -27,17 +27,28 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework.mixins import (CreateModelMixin, ListModelMixin,
                                    RetrieveModelMixin,
                                    DestroyModelMixin, UpdateModelMixin)
-from rest_framework.viewsets import GenericViewSet, ReadOnlyModelViewSet
+from rest_framework.viewsets import GenericViewSet, ReadOnlyModelViewSet, ViewSet
 
 # inside
-from .models import ChainModuleResultSet, Customer, AiModel, Project, Image, ResultSet, AiChainModule
+from .models import ChainModuleResult, ChainModuleResultSet, Customer, AiModel, Project, Image, ImageUpload, ResultSet, AiChainModule
 from .serilizers import (CustomerModelSerializer, PatchCustomerModelSerilizer,
                          AisModelSerilizer, ProjectsModelSerilizer,
                          CreateProjectsModelSerilizer, UpdateProjectsModelSerilizer,
-                         ImageModelSerializer, ResultSetModelSerializer, AiChainModuleSerializer, ChainModuleResultModelSerializer, ChainModuleResultSetModelSerializer)
+                         ImageModelSerializer, ResultSetModelSerializer, AiChainModuleSerializer, ChainModuleResultModelSerializer, ChainModuleResultSetModelSerializer,
+                         ProjectListSerializer)
+from .pagination import ProjectCursorPagination
 from .permissions import IsAdminOrReadOnly
 from .utility.ai_utils import prepare_cfg, run_ai_model
-from .tasks import process_image, update_project_status, processing_chain
+from .utility.chain_utils import parse_chain_graph
+from .utility.image_upload import StreamingImageUploadHandler, IMAGE_TYPES
+from .validators import check_image_size, check_upload_chunk
+from django.core.exceptions import ValidationError
+from .utility import fair_scheduler, queue_metrics, progress_counters, project_runs
+from .utility.conditional import conditional_response, cached_conditional_response
+from .utility.element_filters import ElementFilter
+from .utility import spatial_index
+from .utility import result_payloads
+from .tasks import process_image, update_project_status, processing_chain, processing_batch, processing_dag, generate_image_derivatives
 
 
 
@@ -120,21 +131,47 @@ class AIsViewSet(CreateModelMixin, RetrieveModelMixin, ListModelMixin, GenericVi
 # supports DELETE-Detail -> /store/projects/1
 # grand all permissions for al while developing
 class ProjectsViewSet(ModelViewSet):
-    http_method_names = ['get', 'post', 'patch', 'delete']
+    http_method_names = ['get', 'head', 'post', 'patch', 'delete']
     # the basic permission is to be authenticated(angemeldet),
     permission_classes = [IsAuthenticated]
+    # opt-in, see is_paged_list()
+    pagination_class = ProjectCursorPagination
 
     def get_queryset(self):
         user = self.request.user
+        # the progress endpoint is polled, it only needs the project row
+        if self.action == "progress":
+            if user.is_staff:
+                return Project.objects.all()
+            return Project.objects.filter(customer__user_id=user.id)
+        # the pages of the list leave the images out
+        if self.is_paged_list():
+            queryset = Project.objects.annotate(images_nr=Count("images")).select_related("customer__user")
+            if user.is_staff:
+                return queryset
+            return queryset.filter(customer__user_id=user.id)
         # if you are admin/stuffed(inside workers), you are free to check all the
         if user.is_staff:
-            return Project.objects.annotate(images_nr=Count("images")).select_related("customer").prefetch_related("images").all()
+            return Project.objects.annotate(images_nr=Count("images")).select_related("customer__user").prefetch_related("images").all()
         # Use get_object_or_404 to get the customer ID or return a 404 response if not found
         # BAD! this violates "command or query principle"
         customer = Customer.objects.only("id").get(user_id=user.id)
-        return Project.objects.annotate(images_nr=Count("images")).select_related("customer").prefetch_related("images").filter(customer_id=customer.id)
+        return Project.objects.annotate(images_nr=Count("images")).select_related("customer__user").prefetch_related("images").filter(customer_id=customer.id)
+
+    # the list is paged (cursor pagination, ProjectListSerializer) when asked for with "?page_size=N" or "?cursor=...",
+    # the plain list with all the images of every project stays the default
+    def is_paged_list(self):
+        return self.action == "list" and self.paginator.is_requested(self.request)
+
+    def paginate_queryset(self, queryset):
+        if not self.is_paged_list():
+            return None
+        return super().paginate_queryset(queryset)
+
     # serilizer classs
     def get_serializer_class(self):
+        if self.is_paged_list():
+            return ProjectListSerializer
         if self.action == "create":
             return CreateProjectsModelSerilizer
         # "partial_update" is for patch
@@ -241,12 +278,161 @@ class ProjectsViewSet(ModelViewSet):
             if good_images:
                 # Serialize the list of created image instances
                 serializer = ImageModelSerializer(good_images, many=True)
+                progress_counters.add_images(project.id, len(good_images))
+                self.generate_derivatives(good_images)
                 self.get_object().update_status_based_on_images()
                 if bad_images:
                     return Response({"data": serializer.data, "error": True, "error_msg": "part of the images are uploaded but some images does not have extensions 'png' or 'jpg',please upload PART again", "bad_images": bad_images}, status=status.HTTP_202_ACCEPTED)
                 return Response({"data": serializer.data, "error": False, "error_msg": "", "bad_images": bad_images}, status=status.HTTP_201_CREATED)
             return Response({"data": "", "error": True, "error_msg": "no images have extensions 'png' or 'jpg', please upload ALL again", "bad_images": bad_images}, status=status.HTTP_400_BAD_REQUEST)
 
+    # same as POST "images", for big uploads: the files are written to their place while the request is read
+    # (see utility/image_upload.py) instead of being buffered first, and the images are created with one query
+    # Example: http://127.0.0.1:8001/store/projects/1/images/bulk
+    @action(detail=True, methods=["POST"], url_path='images/bulk', parser_classes=[MultiPartParser])
+    def images_bulk(self, request, pk=None):
+        project = self.get_object()
+
+        # has to be set before the request body is read
+        upload_handler = StreamingImageUploadHandler(request._request, project.id)
+        request._request.upload_handlers = [upload_handler]
+        stored_images = request.FILES.getlist('images')
+        bad_images = upload_handler.bad_images
+
+        if not stored_images:
+            return Response({"data": "", "error": True, "error_msg": "no images have extensions 'png' or 'jpg', please upload ALL again", "bad_images": bad_images}, status=status.HTTP_400_BAD_REQUEST)
+
+        images = [Image(project_id=project.id, name=os.path.basename(stored_image.stored_name),
+                        old_name=stored_image.name.split(".")[0], image_file=stored_image.stored_name,
+                        type=stored_image.stored_name.split(".")[-1])
+                  for stored_image in stored_images]
+        Image.objects.bulk_create(images)
+        # bulk_create does not give back the ids on MySQL
+        good_images = Image.objects.filter(project_id=project.id, name__in=[image.name for image in images])
+
+        serializer = ImageModelSerializer(good_images, many=True)
+        progress_counters.add_images(project.id, len(images))
+        self.generate_derivatives(good_images)
+        project.update_status_based_on_images()
+        if bad_images:
+            return Response({"data": serializer.data, "error": True, "error_msg": "part of the images are uploaded but some images does not have extensions 'png' or 'jpg' or are too big, please upload PART again", "bad_images": bad_images}, status=status.HTTP_202_ACCEPTED)
+        return Response({"data": serializer.data, "error": False, "error_msg": "", "bad_images": bad_images}, status=status.HTTP_201_CREATED)
+
+    # resumable upload of a big image, in chunks (tus-style):
+    # 1. POST {"name": "plan.png", "length": <bytes>} to /store/projects/1/uploads -> "upload_id"
+    # 2. PATCH the chunks to /store/projects/1/uploads/<upload_id> with the header "Upload-Offset: <bytes sent so far>",
+    #    after a dropped connection HEAD/GET the upload for the offset to continue from
+    # 3. POST /store/projects/1/uploads/<upload_id>/finalize creates the image
+    @action(detail=True, methods=["POST"], url_path='uploads')
+    def uploads(self, request, pk=None):
+        project = self.get_object()
+        name = str(request.data.get('name', ''))
+        image_ext = name.split(".")[-1].lower()
+        if image_ext not in IMAGE_TYPES:
+            return Response({"error": True, "error_msg": "only images with extensions 'png' or 'jpg' can be uploaded"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            length = int(request.data.get('length'))
+            if length <= 0:
+                raise ValueError(length)
+            check_image_size(length, settings.IMAGE_RESUMABLE_MAX_SIZE_MB)
+        except (TypeError, ValueError):
+            return Response({"error": True, "error_msg": "the length of the file in bytes is missing"}, status=status.HTTP_400_BAD_REQUEST)
+        except ValidationError as e:
+            return Response({"error": True, "error_msg": e.messages[0]}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        upload = ImageUpload.objects.create(project=project, old_name=name.split(".")[0], type=image_ext, length=length)
+        os.makedirs(os.path.dirname(upload.part_path()), exist_ok=True)
+        open(upload.part_path(), 'wb').close()
+        response = self.upload_response(upload, status.HTTP_201_CREATED)
+        response['Location'] = request.build_absolute_uri(f"{upload.token}/")
+        return response
+
+    @action(detail=True, methods=["GET", "HEAD", "PATCH", "DELETE"], url_path='uploads/(?P<upload_id>[0-9a-f-]+)')
+    def upload_detail(self, request, pk=None, upload_id=None):
+        project = self.get_object()
+
+        if request.method in ('GET', 'HEAD'):
+            upload = get_object_or_404(ImageUpload, token=upload_id, project_id=project.id)
+            return self.upload_response(upload)
+
+        # the upload row is locked while its part file is written or removed,
+        # requests for the same upload (a chunk sent twice, a finalize) wait for each other
+        with transaction.atomic():
+            upload = get_object_or_404(ImageUpload.objects.select_for_update(), token=upload_id, project_id=project.id)
+            if request.method == 'DELETE':
+                upload.delete()
+                return Response(status=status.HTTP_204_NO_CONTENT)
+            return self.upload_chunk(request, upload)
+
+    # PATCH: the chunk is appended at the offset received so far, a chunk sent for another offset is refused
+    # (e.g. sent again after a dropped connection, when its start was already received)
+    def upload_chunk(self, request, upload):
+        try:
+            chunk_offset = int(request.headers.get('Upload-Offset'))
+        except (TypeError, ValueError):
+            return Response({"error": True, "error_msg": "the header Upload-Offset is missing"}, status=status.HTTP_400_BAD_REQUEST)
+        if chunk_offset != upload.offset:
+            return self.upload_response(upload, status.HTTP_409_CONFLICT)
+
+        received_size = 0
+        try:
+            # the chunk is accounted as it is read, the limits hold even without (or with a wrong) Content-Length
+            check_upload_chunk(upload, int(request.headers.get('Content-Length') or 0))
+            with open(upload.part_path(), 'r+b') as part:
+                part.seek(upload.offset)
+                stream = request.stream  # None for an empty chunk
+                for block in iter(lambda: stream.read(64 * 1024) if stream else b'', b''):
+                    received_size += len(block)
+                    check_upload_chunk(upload, received_size)
+                    part.write(block)
+                part.truncate()
+        except ValidationError as e:
+            # the part keeps the chunks received before
+            with open(upload.part_path(), 'r+b') as part:
+                part.truncate(upload.offset)
+            return Response({"error": True, "error_msg": e.messages[0]}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        # updated_at too, an upload still receiving chunks is not abandoned (see remove_abandoned_uploads)
+        upload.offset = chunk_offset + received_size
+        upload.save(update_fields=['offset', 'updated_at'])
+        return self.upload_response(upload, status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=["POST"], url_path='uploads/(?P<upload_id>[0-9a-f-]+)/finalize')
+    def upload_finalize(self, request, pk=None, upload_id=None):
+        project = self.get_object()
+        # locked, a finalize sent again waits for the first one and finds the upload gone (404)
+        with transaction.atomic():
+            upload = get_object_or_404(ImageUpload.objects.select_for_update(), token=upload_id, project_id=project.id)
+            if upload.offset != upload.length or not os.path.isfile(upload.part_path()):
+                return self.upload_response(upload, status.HTTP_409_CONFLICT)
+
+            # the received file becomes the image file, it is moved and not copied
+            image_name = f"{uuid4()}.{upload.type}"
+            image_file = os.path.join(f'project_{project.id}', image_name)
+            os.replace(upload.part_path(), os.path.join(settings.MEDIA_ROOT, image_file))
+            image = Image.objects.create(project_id=project.id, name=image_name, old_name=upload.old_name, image_file=image_file, type=upload.type)
+            upload.delete()
+
+        progress_counters.add_images(project.id, 1)
+        self.generate_derivatives([image])
+        project.update_status_based_on_images()
+        serializer = ImageModelSerializer(image)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    # thumbnails, previews and working copies are made in the background, the uploaded images are served until then
+    def generate_derivatives(self, images):
+        image_ids = [image.id for image in images]
+        transaction.on_commit(lambda: generate_image_derivatives.delay(image_ids))
+
+    # the state of a resumable upload, in the body and in the tus headers
+    def upload_response(self, upload, response_status=status.HTTP_200_OK):
+        data = {"upload_id": upload.token, "offset": upload.offset, "length": upload.length}
+        response = Response(None if response_status == status.HTTP_204_NO_CONTENT else data, status=response_status)
+        response['Upload-Offset'] = upload.offset
+        response['Upload-Length'] = upload.length
+        response['Cache-Control'] = 'no-store'
+        return response
+
     # modifying images are not allowed
     @action(detail=True, methods=['GET', 'DELETE'], url_path='images/(?P<image_id>\d+)')
     def image_detail(self, request, pk=None, image_id=None):
@@ -259,6 +445,9 @@ class ProjectsViewSet(ModelViewSet):
 
         elif request.method == 'DELETE':
             image.delete()
+            progress_counters.remove_image(project.id, image.id, image.has_result)
+            # the result sets of the image lose it
+            result_payloads.invalidate(project.id)
             return Response({"message": f"image with id {image_id} is deleted"}, status=status.HTTP_204_NO_CONTENT)
 
 
@@ -276,6 +465,15 @@ class ProjectsViewSet(ModelViewSet):
         ai_model_name = project.ai_model.name
 
         ai_chain_module_list = request.data
+        try:
+            parse_chain_graph(ai_chain_module_list)
+        except ValueError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # sets the project status, the run in progress (if any) is stopped before its output is deleted
+        run_id = self.begin_run(project, ai_chain_module_list)
+        if run_id is None:
+            return Response({"message": "ALREADY PROCESSING", "run_id": project.run_id}, status=status.HTTP_202_ACCEPTED)
 
         # the related output path
         output_path = os.path.join(settings.MEDIA_ROOT, 'outputs', f'project_{project_id}')
@@ -284,17 +482,11 @@ class ProjectsViewSet(ModelViewSet):
         if os.path.exists(output_path):
             shutil.rmtree(output_path)
 
-        # set the project status
-        project.status = Project.STATUS_CHOICES[1][0]  # 'PROCESSING'
-        project.save()
+        images = project.images.all()
+        progress_counters.reset(project_id, total=len(images))
+        task_ids = self.dispatch_processing(request, project, images, ai_chain_module_list)
 
-        task_ids = []
-        for image in project.images.all():
-            #task = process_image.delay(project_id, image.id, ai_model_id)
-            task = processing_chain.delay(project_id, image.id, ai_chain_module_list)
-            task_ids.append(task.id)
-
-        return Response({"message": "GOT IT, START PROCESSING"}, status=status.HTTP_202_ACCEPTED)
+        return Response({"message": "GOT IT, START PROCESSING", "run_id": run_id}, status=status.HTTP_202_ACCEPTED)
 
     # Processing a single image by calling: http://127.0.0.1:8001/store/projects/4/start_rest
     @action(detail=True, methods=["POST"], url_path='start_rest')
@@ -306,6 +498,10 @@ class ProjectsViewSet(ModelViewSet):
         ai_model_name = project.ai_model.name
 
         ai_chain_module_list = request.data
+        try:
+            parse_chain_graph(ai_chain_module_list)
+        except ValueError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         # Filter images that have not been processed yet
         unprocessed_images = project.images.filter(has_result=False)
@@ -315,16 +511,106 @@ class ProjectsViewSet(ModelViewSet):
             return Response({"message": "NO REST IMAGES TO PROCESS"}, status=status.HTTP_202_ACCEPTED)
 
         # set the project status
-        project.status = Project.STATUS_CHOICES[1][0]  # 'PROCESSING'
-        project.save()
+        run_id = self.begin_run(project, ai_chain_module_list)
+        if run_id is None:
+            return Response({"message": "ALREADY PROCESSING", "run_id": project.run_id}, status=status.HTTP_202_ACCEPTED)
+
+        # the processed images stay done
+        total = len(project.images.all())
+        progress_counters.reset(project_id, total=total, done=total - len(unprocessed_images))
 
-        task_ids = []
-        for image in unprocessed_images:
-            # task = process_image.delay(project_id, image.id, ai_model_id, True)
-            task = processing_chain.delay(project_id, image.id, ai_chain_module_list)
-            task_ids.append(task.id)
+        # the images continue from the last stage their previous run got done
+        task_ids = self.dispatch_processing(request, project, unprocessed_images, ai_chain_module_list, resume=True)
 
-        return Response({"message": "GOT IT, START PROCESSING"}, status=status.HTTP_202_ACCEPTED)
+        return Response({"message": "GOT IT, START PROCESSING", "run_id": run_id}, status=status.HTTP_202_ACCEPTED)
+
+    # stops the run in progress: its tasks not started yet are revoked, the others stop before their next module call
+    # Example: http://127.0.0.1:8001/store/projects/4/cancel
+    @action(detail=True, methods=["POST"], url_path='cancel')
+    def cancel(self, request, pk=None):
+        project = self.get_object()
+        with transaction.atomic():
+            locked_project = Project.objects.select_for_update().get(id=project.id)
+            run_id = locked_project.run_id
+            if run_id is None or locked_project.status != 'PROCESSING':
+                return Response({"message": "NO RUN IN PROGRESS"}, status=status.HTTP_400_BAD_REQUEST)
+            locked_project.run_id = None
+            locked_project.run_modules = None
+            locked_project.status = Project.STATUS_CHOICES[0][0]  # 'PENDING'
+            locked_project.save()
+            project_runs.set_current(project.id, None)
+
+        project_runs.cancel(project.customer_id, run_id)
+        locked_project.update_status_based_on_images()
+        return Response({"message": "CANCELLED", "run_id": run_id}, status=status.HTTP_202_ACCEPTED)
+
+    # starts a new run of the project (status PROCESSING) and returns its id. a start with the same modules as the run
+    # in progress joins it (returns None), a start with other modules preempts it: the old run is cancelled
+    def begin_run(self, project, ai_chain_module_list):
+        with transaction.atomic():
+            locked_project = Project.objects.select_for_update().get(id=project.id)
+            # a finished run is not in progress any more, even if nobody looked at the project since
+            locked_project.update_status_based_on_images()
+            old_run_id = locked_project.run_id
+            if (old_run_id is not None and locked_project.status == 'PROCESSING'
+                    and locked_project.run_modules == ai_chain_module_list):
+                project.run_id = old_run_id
+                return None
+
+            project.run_id = project_runs.new_run_id()
+            project.run_modules = ai_chain_module_list
+            project.status = Project.STATUS_CHOICES[1][0]  # 'PROCESSING'
+            project.save()
+            project_runs.set_current(project.id, project.run_id)
+
+        if old_run_id is not None:
+            project_runs.cancel(project.customer_id, old_run_id)
+        return project.run_id
+
+    # one "processing_chain" per image, or with "?batch_size=N" (default: CHAIN_BATCH_SIZE) one "processing_batch" task per N images,
+    # a dependency graph of modules (instead of a list) runs as one "processing_dag" per image.
+    # small runs take the fast interactive lane, the runs of bigger ones are shared fairly between the customers in the bulk lane
+    # resume: continue the last chains of the images from their first missing stage (start_rest)
+    def dispatch_processing(self, request, project, images, ai_chain_module_list, resume=False):
+        project_id = project.id
+        # in upload order, the batches do not depend on the order the database returns the images in
+        image_ids = sorted(image.id for image in images)
+
+        try:
+            batch_size = int(request.query_params.get('batch_size', settings.CHAIN_BATCH_SIZE))
+        except ValueError:
+            batch_size = settings.CHAIN_BATCH_SIZE
+
+        graph = parse_chain_graph(ai_chain_module_list)
+        kwargs = {'resume': True} if resume else {}
+        kwargs['run_id'] = project.run_id
+        if graph is not None:
+            runs = [(processing_dag, [project_id, image_id, graph], kwargs) for image_id in image_ids]
+        elif batch_size <= 1:
+            runs = [(processing_chain, [project_id, image_id, ai_chain_module_list], kwargs) for image_id in image_ids]
+        else:
+            runs = [(processing_batch, [project_id, image_ids[start:start + batch_size], ai_chain_module_list], kwargs)
+                    for start in range(0, len(image_ids), batch_size)]
+
+        if len(image_ids) <= settings.CHAIN_INTERACTIVE_MAX_IMAGES:
+            queue = settings.CHAIN_INTERACTIVE_QUEUE
+            task_ids = [task.apply_async(args, {**kwargs, 'queue': queue}, queue=queue).id for task, args, kwargs in runs]
+            project_runs.track(project.run_id, task_ids)
+            return task_ids
+
+        customer = project.customer
+        for task, args, kwargs in runs:
+            fair_scheduler.submit(customer.id, customer.plan, task.name, args, kwargs)
+        return []
+
+    # the processing progress of the project from its counters, without touching its images
+    # Example: http://127.0.0.1:8000/store/projects/{project_id}/progress
+    @action(detail=True, methods=["GET"], url_path='progress')
+    def progress(self, request, pk=None):
+        project = self.get_object()
+        project.update_status_based_on_images()
+        counts = progress_counters.get(project)
+        return Response({"status": project.status, **counts})
 
     # Get all chain modules
     # Example: http://127.0.0.1:8000/store/projects/{project_id}/modules
@@ -354,6 +640,20 @@ class ChainModuleResultSetViewSet(ReadOnlyModelViewSet):
 
         return ChainModuleResultSet.objects.filter(project_id=project_id)
 
+    # the results of a set are only added, never changed: the ids of the sets and their results make the ETag.
+    # the rendered payloads are cached until the next result of the project is written (see utility/result_payloads.py)
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+
+        def versions():
+            return (list(queryset.order_by('id').values_list('id', flat=True)),
+                    list(ChainModuleResult.objects.filter(result_set__in=queryset).order_by('id').values_list('result_set_id', 'id')))
+
+        def data():
+            return self.get_serializer(queryset.select_related('image').prefetch_related('results__module', 'results__image'), many=True).data
+
+        return cached_conditional_response(request, self.kwargs.get('project_pk'), versions, data)
+
     def retrieve(self, request, *args, **kwargs):
         project_id = self.kwargs.get('project_pk')
         result_set_id = kwargs.get('pk')
@@ -363,9 +663,47 @@ class ChainModuleResultSetViewSet(ReadOnlyModelViewSet):
             raise PermissionDenied("You do not have permission to access this project's results.")
 
         queryset = ChainModuleResultSet.objects.filter(project_id=project_id, id=result_set_id)
-        result_set = get_object_or_404(queryset)
-        serializer = self.get_serializer(result_set)
-        return Response(serializer.data)
+
+        def versions():
+            result_set = get_object_or_404(queryset)
+            return result_set.id, list(ChainModuleResult.objects.filter(result_set=result_set).order_by('id').values_list('id', flat=True))
+
+        def data():
+            result_set = get_object_or_404(queryset.select_related('image').prefetch_related('results__module', 'results__image'))
+            return self.get_serializer(result_set).data
+
+        return cached_conditional_response(request, project_id, versions, data)
+
+    # the elements and fields (room stamps) of a result intersecting a viewport (?bbox=x1,y1,x2,y2) or under a point
+    # (?point=x,y), read from the spatial index of the result (see utility/spatial_index.py). the last result of the
+    # set by default, another one with ?result=<id>. the other element filters (class, text, ...) apply as well
+    @action(detail=True, methods=['get'])
+    def elements(self, request, project_pk=None, pk=None):
+        result_set = get_object_or_404(self.get_queryset(), id=pk)
+        element_filter = ElementFilter.from_query_params(request.query_params)
+        point = request.query_params.get('point')
+        if point:
+            try:
+                x, y = [float(value) for value in point.split(',')]
+            except ValueError:
+                return Response({"error": True, "error_msg": "point has to be x,y"}, status=status.HTTP_400_BAD_REQUEST)
+            element_filter.bbox = [x, y, x, y]
+
+        results = ChainModuleResult.objects.filter(result_set=result_set)
+        result_id = request.query_params.get('result')
+        if result_id:
+            if not result_id.isdigit():
+                return Response({"error": True, "error_msg": "result has to be the id of a result"}, status=status.HTTP_400_BAD_REQUEST)
+            results = results.filter(id=int(result_id))
+        result = results.order_by('-id').values('id', 'element_index_cell_size').first()
+        if result is None:
+            return Response({"error": True, "error_msg": "the result set has no such result"}, status=status.HTTP_404_NOT_FOUND)
+
+        # results are never changed, the result and the query make the ETag
+        return conditional_response(request, [result['id']], lambda: {
+            "result_id": result['id'],
+            "elements": spatial_index.query(result['id'], result['element_index_cell_size'], element_filter),
+        })
 
 
 
@@ -393,6 +731,12 @@ class ResultSetViewSet(ReadOnlyModelViewSet):
         # Filter by the user's customer-related projects
         return ResultSet.objects.filter(project_id=project_id, project__customer__user=user)
 
+    # the ETag comes from the ids and update times of the result sets, their json results are only read when needed
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        versions = list(queryset.order_by('id').values_list('id', 'updated_at'))
+        return conditional_response(request, versions, lambda: self.get_serializer(queryset, many=True).data)
+
     # DIY the retrieve response(means retrieve only one item), response according to the image id
     def retrieve(self, request, *args, **kwargs):
         """
@@ -407,9 +751,8 @@ class ResultSetViewSet(ReadOnlyModelViewSet):
 
         # Hier wird angenommen, dass der 'pk' in der URL die Image-ID und nicht die ResultSet-ID ist.
         queryset = ResultSet.objects.filter(project_id=project_id, image_id=image_id)
-        result_set = get_object_or_404(queryset)
-        serializer = self.get_serializer(result_set)
-        return Response(serializer.data)
+        version = get_object_or_404(queryset.values_list('id', 'updated_at'))
+        return conditional_response(request, version, lambda: self.get_serializer(get_object_or_404(queryset)).data)
 
 
 
@@ -427,3 +770,18 @@ class ResultSetViewSet(ReadOnlyModelViewSet):
 
 
 
+
+
+#>>>>>>>>>>>>>>>>>>>>>>>>>>>QueueMetricsViewSet>>>>>>>>>>>>>>>>>>
+
+# Example: http://127.0.0.1:8000/store/queue-metrics/
+class QueueMetricsViewSet(ViewSet):
+    permission_classes = [IsAdminUser]
+
+    # queue wait per celery queue and the state of the fair scheduler of the bulk lane
+    def list(self, request):
+        return Response({
+            "queue_wait": queue_metrics.queue_wait_stats(),
+            "bulk_in_flight": fair_scheduler.in_flight_count(),
+            "bulk_pending_by_customer": fair_scheduler.pending_counts(),
+        })